@@ -0,0 +1,42 @@
+import gzip
+import time
+import cStringIO
+
+from libs import log
+from libs import config
+from libs import stats
+
+# Gzipped copies of response bodies that every client gets byte for byte, made
+# once per station update instead of once per response like Tornado's gzip
+# setting does.  When a body gets dropped at the next update, what it saved
+# goes into the gzip_broadcast_saved and gzip_broadcast_cpu stats.
+
+# key -> { "body": gzipped body, "length": plain length, "cpu": seconds spent compressing, "served": responses }
+_bodies = {}
+
+def accepts_gzip(request):
+	# The same test Tornado's GZipContentEncoding uses
+	return request.supports_http_1_1() and "gzip" in request.headers.get("Accept-Encoding", "")
+
+def compress(body):
+	value = cStringIO.StringIO()
+	gzip_file = gzip.GzipFile(mode = "w", fileobj = value, compresslevel = config.get("api_gzip_level"))
+	gzip_file.write(body)
+	gzip_file.close()
+	return value.getvalue()
+
+def get_gzipped(key, body):
+	if not key in _bodies:
+		started = time.clock()
+		_bodies[key] = { "body": compress(body), "length": len(body), "cpu": time.clock() - started, "served": 0 }
+	_bodies[key]['served'] += 1
+	return _bodies[key]['body']
+
+def clear(key):
+	if not key in _bodies:
+		return
+	shared = _bodies.pop(key)
+	saved = (shared['length'] - len(shared['body'])) * shared['served']
+	stats.record("gzip_broadcast_saved", saved, base = 1024)
+	stats.record("gzip_broadcast_cpu", shared['cpu'])
+	log.debug("gzip", "%s: %s bytes saved over %s responses for %.1fms of compression." % (key, saved, shared['served'], shared['cpu'] * 1000))
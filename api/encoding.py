@@ -0,0 +1,65 @@
+import tornado.escape
+
+try:
+	import simplejson as _json
+	# Left to itself simplejson writes namedtuples as objects, where json writes arrays
+	_options = { "namedtuple_as_object": False }
+except ImportError:
+	import json as _json
+	_options = {}
+
+# JSON encoding for API output.  dumps() gives exactly what tornado.escape.json_encode
+# does, through simplejson's C encoder when it's installed.  encode() also takes
+# pre-encoded fragments out of a cache: values wrapped in Shared get encoded once and
+# reused by every response they go into until clear_fragments() is called on the next
+# station update.  Nothing else is cached, since nothing else is known not to change.
+
+# id(shared value) -> (value, encoded), holding on to the value so its id can't be reused
+_fragments = {}
+
+class Shared(object):
+	"""
+	Wraps a value that every client gets the same object of until the next station update,
+	such as what's in cache.local for a station.  It mustn't change until then.
+	"""
+	def __init__(self, value):
+		self.value = value
+
+def _default(obj):
+	if hasattr(obj, "to_dict"):
+		return tornado.escape.recursive_unicode(obj.to_dict())
+	raise TypeError("%r is not JSON serializable" % (obj,))
+
+def dumps(value):
+	# Same steps as Tornado takes: rebuilding the dicts with unicode keys can change their
+	# order, and "</" gets escaped so JSON can sit inside a <script> tag
+	return _json.dumps(tornado.escape.recursive_unicode(value), default = _default, **_options).replace("</", "<\\/")
+
+def _fragment(value):
+	key = id(value)
+	if not key in _fragments:
+		_fragments[key] = (value, dumps(value))
+	return _fragments[key][1]
+
+def encode(value, depth = 2):
+	"""
+	Encodes an API response.  Fragments are looked for at the top level and one level down,
+	in the dicts and lists a response is made of, and anything deeper is left to dumps().
+	"""
+	if isinstance(value, Shared):
+		return _fragment(value.value)
+	elif depth == 0:
+		return dumps(value)
+	elif isinstance(value, dict):
+		for key in value:
+			if not isinstance(key, basestring):
+				return dumps(value)
+		# Keys come out in the order recursive_unicode would leave them in
+		value = dict((tornado.escape.to_unicode(key), item) for key, item in value.iteritems())
+		return "{%s}" % ", ".join([ "%s: %s" % (dumps(key), encode(item, depth - 1)) for key, item in value.iteritems() ])
+	elif isinstance(value, (list, tuple)):
+		return "[%s]" % ", ".join([ encode(item, depth - 1) for item in value ])
+	return dumps(value)
+
+def clear_fragments():
+	_fragments.clear()
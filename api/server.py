@@ -18,6 +18,9 @@ from libs import log
 from libs import config
 from libs import dict_compare
 from libs import db
+from libs import bus
+from libs import cache
+from libs import stats
 
 request_classes = [(r"/api/", api.help.IndexRequest), (r"/api/help/", api.help.IndexRequest), (r"/api/help/(.+)", api.help.HelpRequest)]
 testable_requests = []
@@ -39,6 +42,31 @@ def test_post(klass):
 	testable_requests.append({ "method": "POST", "class": klass })
 	api.help.add_help_class("POST", klass, klass.url)
 	
+class Application(tornado.web.Application):
+	def __call__(self, request):
+		# Where the DB and memcache timers stood when the request came in, for log_request
+		request.timers_at_start = stats.get_times()
+		return tornado.web.Application.__call__(self, request)
+
+def log_request(handler):
+	"""
+	Records every request to a handle_url class into that URL's histograms in libs.stats:
+	api_<url> for wall time, api_<url>_size for bytes sent, and api_<url>_db and api_<url>_cache
+	for the time spent in each while it ran.
+	"""
+	if not getattr(handler, "url", None):
+		return
+	name = "api_%s" % handler.url
+	stats.record(name, handler.request.request_time())
+	if "Content-Length" in handler._headers:
+		stats.record("%s_size" % name, int(handler._headers["Content-Length"]), base = 64)
+	# An asynchronous request shares the IOLoop with everything that ran while it waited,
+	# so the timers only say anything about requests that finished in one go
+	if handler._auto_finish and hasattr(handler.request, "timers_at_start"):
+		times = stats.get_times()
+		for timer in ("db", "cache"):
+			stats.record("%s_%s" % (name, timer), times.get(timer, 0) - handler.request.timers_at_start.get(timer, 0))
+
 class TestShutdownRequest(api.web.RequestHandler):
 	auth_required = False
 	def get(self, _unused):
@@ -67,20 +95,24 @@ class APIServer(object):
 			os.remove(log_file)
 		log.init(log_file, config.get("log_level"))
 		log.debug("start", "Server booting, port %s." % port_no)
-		db.open()
+		db.open(timed = True)
+		cache.open(timed = True)
 		
 		# Fire ze missiles!
-		app = tornado.web.Application(request_classes)
+		app = Application(request_classes, gzip = config.get("api_gzip"), log_function = log_request)
 		http_server = tornado.httpserver.HTTPServer(app, xheaders = True)
 		http_server.listen(port_no)
 		for request in request_classes:
 			log.debug("start", "   Handler: %s" % str(request))
 		for sid in config.station_ids:
 			cache.update_local_cache_for_sid(sid)
+		if config.get("bus_dir"):
+			bus.listen(port_no)
 		log.info("start", "Server bootstrapped and ready to go.")
 		self.ioloop = tornado.ioloop.IOLoop.instance()
 		self.ioloop.start()
 		http_server.stop()
+		bus.close()
 		log.info("stop", "Server has been shutdown.")
 		log.close()
 
@@ -2,6 +2,7 @@ from rainwave.user import User
 from api import fieldtypes
 from libs import config
 import api.returns
+from api import encoding
 
 import tornado.web
 import tornado.escape
@@ -44,8 +45,6 @@ class RequestHandler(tornado.web.RequestHandler):
 
 	# Called by Tornado, allows us to setup our request as we wish. User handling, form validation, etc. take place here.
 	def prepare(self):
-		self._startclock = time.clock()
-
 		if self.return_name == False:
 			self.return_name = self.__class__.url + "_result"
 		else:
@@ -76,20 +75,22 @@ class RequestHandler(tornado.web.RequestHandler):
 				else:
 					self.args[field] = parsed
 		
+		# Authorization needs the station, so it's read before the user is
+		self.sid = None
+		if "sid" in self.request.arguments:
+			self.sid = fieldtypes.integer(self.get_argument("sid"))
+		
 		self.user = None
 		if request_ok:
 			if self.auth_required and not self.rainwave_auth():
 				self.finish()
+				return
 		
-		if self.sid_required and not "id" in self.request.arguments:
-			self.append("error", api.returns.ErrorReturn(-1000, "Missing station ID argument."))
-			request_ok = False
-		elif "id" in self.request.arguments:
-			self.sid = int(self.request.arguments("sid"))
-		elif self.user:
+		if not self.sid and self.user:
 			self.sid = self.user.sid
-		else:
+		if not self.sid:
 			self.append("error", api.returns.ErrorReturn(-1000, "Missing station ID argument."))
+			request_ok = False
 
 		# Now we strictly enforce valid station IDs.
 		if not self.sid in config.station_ids or self.sid == 0:
@@ -147,7 +148,7 @@ class RequestHandler(tornado.web.RequestHandler):
 			self._output.append({ key: hash })
 		else:
 			self._output[key] = hash
-		if "code" in hash:
+		if isinstance(hash, dict) and "code" in hash:
 			return hash["code"]
 		return True
 
@@ -155,10 +156,7 @@ class RequestHandler(tornado.web.RequestHandler):
 	def finish(self, chunk=None):
 		self.set_header("Content-Type", "application/javascript")
 		if hasattr(self, "_output"):
-			if hasattr(self, "_startclock"):
-				exectime = time.clock() - self._startclock
-			else:
-				exectime = -1
-			self.append("api_info", { "exectime": exectime, "time": round(time.time()) })
-			self.write(tornado.escape.json_encode(self._output))
+			# How long requests take is in api.server.log_request's stats, not sent to clients
+			self.append("api_info", { "time": round(time.time()) })
+			self.write(encoding.encode(self._output))
 		super(RequestHandler, self).finish(chunk)
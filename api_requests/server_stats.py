@@ -0,0 +1,20 @@
+import tornado.web
+
+from api import encoding
+from api.server import handle_url
+from libs import stats
+
+@handle_url("stats")
+class StatsRequest(tornado.web.RequestHandler):
+	"""
+	Per-URL timing and size histograms from this API process, see api.server.log_request.
+	Only answers to 127.0.0.1.
+	"""
+	def prepare(self):
+		if not self.request.remote_ip == "127.0.0.1":
+			self.set_status(403)
+			self.finish()
+
+	def get(self):
+		self.set_header("Content-Type", "application/json")
+		self.write(encoding.dumps(stats.to_dict("api_")))
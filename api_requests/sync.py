@@ -1,14 +1,202 @@
+import time
+import functools
+
 import tornado.web
+import tornado.ioloop
 
+from api import encoding
+from api import compression
 from api.web import RequestHandler
 from api.server import test_get
 from api.server import test_post
 from api.server import handle_url
 
+from libs import bus
 from libs import cache
+from libs import config
+from libs import log
+from libs import shared_cache
+from libs import stats
 from rainwave import playlist
+from rainwave import user
+
+class SessionRegistry(object):
+	"""
+	Parked Sync requests, indexed by station, user and IP so that adding, removing
+	or finding a client costs the same however many are waiting.
+	"""
+	def __init__(self):
+		self.by_sid = {}
+		self.by_user = {}
+		self.by_ip = {}
+		# session -> (sid, user_id, ip)
+		self.keys = {}
+
+	def _index_add(self, index, key, session):
+		if not key in index:
+			index[key] = set()
+		index[key].add(session)
+
+	def _index_remove(self, index, key, session):
+		if key in index:
+			index[key].discard(session)
+			if len(index[key]) == 0:
+				del index[key]
+
+	def add(self, session, sid, user_id, ip):
+		self.remove(session)
+		self.keys[session] = (sid, user_id, ip)
+		self._index_add(self.by_sid, sid, session)
+		self._index_add(self.by_ip, ip, session)
+		# Guests all share user ID 1, there's nothing to target there
+		if user_id > 1:
+			self._index_add(self.by_user, user_id, session)
+
+	def remove(self, session):
+		if not session in self.keys:
+			return False
+		sid, user_id, ip = self.keys.pop(session)
+		self._index_remove(self.by_sid, sid, session)
+		self._index_remove(self.by_user, user_id, session)
+		self._index_remove(self.by_ip, ip, session)
+		return True
+
+	def pop_all(self, sessions):
+		sessions = list(sessions)
+		for session in sessions:
+			self.remove(session)
+		return sessions
+
+	def pop_sid(self, sid):
+		return self.pop_all(self.by_sid.get(sid, []))
+
+	def pop_user(self, user_id):
+		return self.pop_all(self.by_user.get(user_id, []))
+
+	def pop_ip(self, ip):
+		return self.pop_all(self.by_ip.get(ip, []))
+
+	def count(self, sid = None):
+		if sid == None:
+			return len(self.keys)
+		return len(self.by_sid.get(sid, []))
+
+sessions = SessionRegistry()
+# Server-sent event streams, which stay registered for as long as they're connected
+push_sessions = SessionRegistry()
+# sid -> the station update as an encoded event, built once per song change for every stream
+_station_events = {}
+# sid -> the sync_station response body, likewise
+_station_bodies = {}
+# sid -> shared_cache version this process last took a snapshot at
+_shared_versions = {}
+
+def _sse_event(event, data):
+	return "event: %s\ndata: %s\n\n" % (event, encoding.encode(data))
+
+def _shared(value):
+	if value == None:
+		return None
+	return encoding.Shared(value)
 
-sessions = {}
+def get_station_payload(sid):
+	# All of it is this station's cache.local data, the same for every client until the next update,
+	# so the encoder reuses what it made of it
+	return {
+		"album_diff": _shared(cache.get_local_station(sid, "album_diff")),
+		"calendar": _shared(cache.local.get("calendar")),
+		"listeners_current": _shared(cache.get_local_station(sid, "listeners_current")),
+		"sched_current": _shared(cache.get_local_station(sid, "sched_current")),
+		"sched_next": _shared(cache.get_local_station(sid, "sched_next")) or [],
+		"sched_history": _shared(cache.get_local_station(sid, "sched_history")) or [],
+		"sync_versions": cache.get_local_station(sid, "sync_versions")
+	}
+
+def get_station_event(sid):
+	if not sid in _station_events:
+		started = time.time()
+		_station_events[sid] = _sse_event("station", get_station_payload(sid))
+		stats.record("sync_push_encode", time.time() - started)
+	return _station_events[sid]
+
+def get_station_body(sid):
+	if not sid in _station_bodies:
+		# The time is when the update was built, the body being the same for everyone until the next one
+		_station_bodies[sid] = encoding.encode({ "sync_station": get_station_payload(sid), "api_info": { "time": round(time.time()) } })
+	return _station_bodies[sid]
+
+def fan_out(sid, pending, started = None):
+	"""
+	Answers parked sessions a chunk at a time, handing the IOLoop back between chunks
+	so a song change on a busy station doesn't hold up every other request in the process.
+	"""
+	if not started:
+		started = time.time()
+		stats.record("sync_fanout_sessions_sid%s" % sid, len(pending), base = 1)
+	chunk_started = time.time()
+	for i in range(0, min(config.get("sync_fanout_chunk_size"), len(pending))):
+		session = pending.pop()
+		# Closed while waiting for its turn
+		if session.closed:
+			continue
+		try:
+			session.update(True)
+		except Exception as e:
+			log.exception("sync", "Could not update a session on sid %s." % sid, e)
+	stats.record("sync_fanout_chunk", time.time() - chunk_started)
+	if len(pending) > 0:
+		tornado.ioloop.IOLoop.instance().add_callback(functools.partial(fan_out, sid, pending, started))
+	else:
+		stats.record("sync_fanout_sid%s" % sid, time.time() - started)
+
+def update_station(sid, known = None):
+	if not known and config.get("shared_cache_dir"):
+		# A snapshot we've already taken has nothing new for this update, which must have gone to
+		# memcache alone (see schedule.reconcile), so only read one if the version has moved
+		version = shared_cache.get_version(sid)
+		if version != _shared_versions.get(sid):
+			_shared_versions[sid] = version
+			known = shared_cache.read(sid)
+	cache.update_local_cache_for_sid(sid, known)
+	encoding.clear_fragments()
+	_station_events.pop(sid, None)
+	_station_bodies.pop(sid, None)
+	compression.clear("sync_station_sid%s" % sid)
+	fan_out(sid, sessions.pop_sid(sid) + list(push_sessions.by_sid.get(sid, [])))
+
+def update_user(user_id):
+	for session in sessions.pop_user(user_id) + list(push_sessions.by_user.get(user_id, [])):
+		session.update_user()
+
+def update_ip(ip):
+	for session in sessions.pop_ip(ip) + list(push_sessions.by_ip.get(ip, [])):
+		session.update_user()
+
+def _on_station_updated(payload, station):
+	update_station(payload['sid'], station)
+
+def _on_user_updated(payload, bulk):
+	user.invalidate_auth(payload['user_id'], payload.get('api_key'))
+	update_user(payload['user_id'])
+
+def _on_ip_updated(payload, bulk):
+	update_ip(payload['ip_address'])
+
+bus.subscribe("station_updated", _on_station_updated)
+bus.subscribe("user_updated", _on_user_updated)
+bus.subscribe("ip_updated", _on_ip_updated)
+
+def get_held_versions(argument):
+	"""
+	Parses the "versions" argument, "<section>:<version>,...", that clients send back with
+	the sync_versions of their last response so sections they already have can be left out.
+	"""
+	held = {}
+	for pair in argument.split(","):
+		section, sep, version = pair.partition(":")
+		if sep and version.isdigit():
+			held[section] = int(version)
+	return held
 
 @handle_url("sync_update_all")
 class SyncUpdateAll(tornado.web.RequestHandler):
@@ -20,6 +208,15 @@ class SyncUpdateAll(tornado.web.RequestHandler):
 			self._rw_update_clients = False
 			self.set_status(403)
 			self.finish()
+			return
+		# This isn't an api.web.RequestHandler, so nothing else reads the sid for us
+		sid = self.get_argument("sid", "")
+		if not sid.isdigit() or not int(sid) in config.station_ids:
+			self._rw_update_clients = False
+			self.set_status(400)
+			self.finish()
+			return
+		self.sid = int(sid)
 			
 	def get(self):
 		if self._rw_update_clients:
@@ -28,11 +225,7 @@ class SyncUpdateAll(tornado.web.RequestHandler):
 	def on_finish(self):
 		if not self._rw_update_clients:
 			return
-		cache.update_local_cache_for_sid(self.sid)
-		
-		for session in sessions[self.sid]:
-			session.update(True)
-		sessions[self.sid] = []
+		update_station(self.sid)
 		
 @handle_url("sync_update_user")
 class SyncUpdateUser(tornado.web.RequestHandler):
@@ -53,13 +246,9 @@ class SyncUpdateUser(tornado.web.RequestHandler):
 		if not self._rw_update_clients:
 			return
 
-		user_id = long(self.request.arguments['user_id'])
-		for sid in sessions:
-			for session in sessions[sid]:
-				if session.user.id == user_id:
-					session.update_user()
-					sessions[sid].remove(session)
-					return
+		user_id = long(self.get_argument("user_id"))
+		user.invalidate_auth(user_id, self.get_argument("api_key", None))
+		update_user(user_id)
 			
 @handle_url("sync_update_ip")
 class SyncUpdateIP(tornado.web.RequestHandler):
@@ -80,17 +269,12 @@ class SyncUpdateIP(tornado.web.RequestHandler):
 		if not self._rw_update_clients:
 			return
 		
-		ip_address = long(self.request.arguments['ip_address'])
-		for sid in sessions:
-			for session in sessions[sid]:
-				if session.request.remote_ip == ip_address:
-					session.update_user()
-					sessions[sid].remove(session)
-					return
+		update_ip(self.get_argument("ip_address"))
 
 @handle_url("sync")
 class Sync(RequestHandler):
 	auth_required = True
+	closed = False
 	
 	@tornado.web.asynchronous
 	def post(self):
@@ -98,9 +282,11 @@ class Sync(RequestHandler):
 		if "init" in self.request.arguments:
 			self.update()
 		else:
-			if not self.sid in sessions:
-				sessions[sid] = []
-			sessions[self.user.sid].append(self)
+			sessions.add(self, self.sid, self.user.id, self.request.remote_ip)
+
+	def on_connection_close(self):
+		self.closed = True
+		sessions.remove(self)
 		
 	def update(self, use_local_cache = False):
 		# Front-load all non-animated content ahead of the schedule content
@@ -111,27 +297,86 @@ class Sync(RequestHandler):
 		self.user.refresh(use_local_cache)
 		self.append("user", self.user.get_public_dict())
 		
+		if use_local_cache:
+			versions = cache.get_local_station(self.sid, "sync_versions") or {}
+		else:
+			versions = cache.get_station(self.sid, "sync_versions") or {}
+		held = get_held_versions(self.get_argument("versions", ""))
+		def changed(section):
+			return not section in versions or held.get(section) != versions[section]
+		
 		if 'playlist' in self.request.arguments:
 			self.append("all_albums", playlist.fetch_all_albums(self.user))
 		elif 'artist_list' in self.request.arguments:
 			self.append("artist_list", playlist.fetch_all_artists(self.sid))
-		elif 'init' not in self.request.arguments:
-			self.append("album_diff", cache.get_local_station(self.sid, 'album_diff'))
+		elif 'init' not in self.request.arguments and changed("album_diff"):
+			self.append("album_diff", _shared(cache.get_local_station(self.sid, 'album_diff')))
 		
-		if use_local_cache:
-			self.append("requests_all", cache.get_local_station(self.sid, "request_all"))
-		else:
-			self.append("requests_all", cache.get_station(self.sid, "request_all"))
+		if changed("requests_all"):
+			if use_local_cache:
+				self.append("requests_all", _shared(cache.get_local_station(self.sid, "request_line")))
+			else:
+				self.append("requests_all", cache.get_station(self.sid, "request_line"))
 		self.append("requests_user", self.user.get_requests())
-		self.append("calendar", cache.local["calendar"])
-		self.append("listeners_current", cache.get_local_station(self.sid, "listeners_current"))
+		self.append("calendar", _shared(cache.local["calendar"]))
+		if changed("listeners_current"):
+			self.append("listeners_current", _shared(cache.get_local_station(self.sid, "listeners_current")))
 		
-		self.append("sched_current", self.user.make_event_jsonable(cache.get_local_station(self.sid, "sched_current"), use_local_cache))
-		self.append("sched_next", self.user.make_events_jsonable(cache.get_local_station(self.sid, "sched_next"), use_local_cache))
-		self.append("sched_history", self.user.make_event_jsonable(cache.get_local_station(self.sid, "sched_history"), use_local_cache))
+		if changed("sched_current"):
+			self.append("sched_current", self.user.make_event_jsonable(cache.get_local_station(self.sid, "sched_current"), use_local_cache))
+		if changed("sched_next"):
+			self.append("sched_next", self.user.make_events_jsonable(cache.get_local_station(self.sid, "sched_next"), use_local_cache))
+		if changed("sched_history"):
+			self.append("sched_history", self.user.make_event_jsonable(cache.get_local_station(self.sid, "sched_history"), use_local_cache))
+		self.append("sync_versions", versions)
 		self.finish()
 	
 	def update_user(self):
 		self.user.refresh()
 		self.append("user", self.user.get_public_dict())
 		self.finish()
+
+@handle_url("sync_push")
+class PushSync(RequestHandler):
+	auth_required = True
+	closed = False
+	description = "A text/event-stream of the station, sent as a 'station' event on every song change, and the user, sent as a 'user' event whenever it changes.  Stays open until the client disconnects."
+
+	@tornado.web.asynchronous
+	def get(self):
+		self.set_header("Content-Type", "text/event-stream")
+		self.set_header("Cache-Control", "no-cache")
+		self._write_user()
+		self.update(True)
+		push_sessions.add(self, self.sid, self.user.id, self.request.remote_ip)
+
+	def on_connection_close(self):
+		self.closed = True
+		push_sessions.remove(self)
+
+	def update(self, use_local_cache = False):
+		self.write(get_station_event(self.sid))
+		self.flush()
+
+	def update_user(self):
+		self.user.refresh()
+		self._write_user()
+		self.flush()
+
+	def _write_user(self):
+		self.write(_sse_event("user", self.user.get_private_jsonable()))
+
+@handle_url("sync_station")
+class SyncStation(RequestHandler):
+	auth_required = False
+	description = "The station half of a Sync response: schedule, listeners, album changes and the calendar.  The same for every client until the next song change, so it's cheap to fetch on start-up or after a missed update."
+
+	def get(self):
+		body = get_station_body(self.sid)
+		self.set_header("Content-Type", "application/json")
+		self.set_header("Vary", "Accept-Encoding")
+		if config.get("api_gzip") and compression.accepts_gzip(self.request):
+			self.set_header("Content-Encoding", "gzip")
+			body = compression.get_gzipped("sync_station_sid%s" % self.sid, body)
+		# Straight out, RequestHandler.finish would encode it all over again
+		tornado.web.RequestHandler.finish(self, body)
@@ -0,0 +1,290 @@
+import time
+import threading
+import functools
+
+import tornado.ioloop
+
+from backend import work_queue
+from libs import db
+from libs import log
+from libs import cache
+from libs import config
+from libs import stats
+from rainwave import listeners
+
+# The backend's own copy of r4_listeners, fed by Icecast's listener_add and
+# listener_remove callbacks (see relaysetup.py) and kept honest by polling the
+# relays (see libs/icecast.py and reconcile).  It's the only thing that writes
+# r4_listeners, apart from the API recording votes.  Lookups come out of memory,
+# writes to r4_listeners are batched onto a worker, and compact snapshots are
+# published to memcache for the API processes:
+#   listeners_internal           user_id -> the listener columns User.refresh wants
+#   sid<sid>_listener_counts     as listeners.get_listener_counts returns
+
+# listener_id -> listener row
+_listeners = {}
+# (relay, listener_icecast_id) -> listener_id
+_by_icecast = {}
+# user_id -> set of listener_ids, registered users only
+_by_user = {}
+# IP -> set of listener_ids
+_by_ip = {}
+# (query, params) tuples not yet in r4_listeners
+_pending = []
+_pending_lock = threading.Lock()
+# Highest listener_id handed out, only touched on the registry worker
+_last_id = 0
+_flush_queued = False
+_periodic = None
+
+def _index_add(index, key, listener_id):
+	if not key in index:
+		index[key] = set()
+	index[key].add(listener_id)
+
+def _index_remove(index, key, listener_id):
+	if key in index:
+		index[key].discard(listener_id)
+		if len(index[key]) == 0:
+			del index[key]
+
+def _queue_write(query, params):
+	_pending_lock.acquire()
+	_pending.append((query, params))
+	_pending_lock.release()
+
+def load():
+	global _last_id
+	# Purged listeners too, so reconcile can delete them if they're still gone
+	for row in db.c.fetch_all("SELECT * FROM r4_listeners") or []:
+		_register(row)
+		_last_id = max(_last_id, row['listener_id'])
+	log.debug("registry", "Loaded %s listeners." % len(_listeners))
+
+def _register(row):
+	_listeners[row['listener_id']] = row
+	_by_icecast[(row['listener_relay'], row['listener_icecast_id'])] = row['listener_id']
+	_index_add(_by_ip, row['listener_ip'], row['listener_id'])
+	if row['user_id'] > 1:
+		_index_add(_by_user, row['user_id'], row['listener_id'])
+
+def _reserve_ids(count):
+	"""
+	Returns the first of count new listener_ids.  Only call this on the registry worker.
+	"""
+	global _last_id
+	# SQLite's get_next_id can't see rows still waiting to be flushed
+	first = max(db.c.get_next_id("r4_listeners", "listener_id"), _last_id + 1)
+	_last_id = first + count - 1
+	return first
+
+def _prepare_add(mount):
+	"""
+	The DB lookups a new listener needs, run on the registry worker to keep them off the IOLoop.
+	Returns (listener_id, user_id).
+	"""
+	return (_reserve_ids(1), get_user_id_for_mount(mount))
+
+def queue_add(sid, relay, icecast_id, ip, agent, mount, callback = None):
+	"""
+	Registers a listener once the registry worker has looked up their ID and who they are.
+	callback gets the new row on the IOLoop, or None if the lookups failed.
+	"""
+	work_queue.add("registry", "listener_add", _prepare_add, mount,
+		callback = functools.partial(_on_prepared, sid, relay, icecast_id, ip, agent, callback))
+
+def _on_prepared(sid, relay, icecast_id, ip, agent, callback, prepared):
+	row = None
+	if prepared:
+		row = add(sid, relay, icecast_id, ip, agent, prepared[1], prepared[0])
+	if callback:
+		callback(row)
+
+def queue_remove(relay, icecast_id, callback = None):
+	# Through the same queue as adds, so a remove can't overtake the add it undoes
+	work_queue.add("registry", "listener_remove", _noop,
+		callback = functools.partial(_on_removed, relay, icecast_id, callback))
+
+def _noop():
+	pass
+
+def _on_removed(relay, icecast_id, callback, result):
+	row = remove(relay, icecast_id)
+	if callback:
+		callback(row)
+
+def add(sid, relay, icecast_id, ip, agent, user_id, listener_id):
+	# Icecast retries a listener_add it didn't get an answer to, don't double up
+	if (relay, icecast_id) in _by_icecast:
+		remove(relay, icecast_id)
+	row = {
+		"listener_id": listener_id,
+		"sid": sid,
+		"listener_ip": ip,
+		"listener_relay": relay,
+		"listener_agent": agent,
+		"listener_icecast_id": icecast_id,
+		"listener_lock": False,
+		"listener_lock_sid": None,
+		"listener_lock_counter": 0,
+		"listener_purge": False,
+		"listener_voted_entry": None,
+		"user_id": user_id
+	}
+	_register(row)
+	_queue_write("INSERT INTO r4_listeners (listener_id, sid, listener_ip, listener_relay, listener_agent, listener_icecast_id, user_id) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+		(row['listener_id'], sid, ip, relay, agent, icecast_id, user_id))
+	return row
+
+def remove(relay, icecast_id):
+	listener_id = _by_icecast.pop((relay, icecast_id), None)
+	if not listener_id:
+		return None
+	row = _listeners.pop(listener_id)
+	_index_remove(_by_ip, row['listener_ip'], listener_id)
+	_index_remove(_by_user, row['user_id'], listener_id)
+	_queue_write("DELETE FROM r4_listeners WHERE listener_id = %s", (listener_id,))
+	return row
+
+def _set_purge(row, purge):
+	row['listener_purge'] = purge
+	_queue_write("UPDATE r4_listeners SET listener_purge = %s WHERE listener_id = %s", (purge, row['listener_id']))
+
+def reconcile(relay, sid, clients):
+	"""
+	Brings the registry in line with what a relay reported for one mount, clients being
+	Icecast client ID -> { "ip", "agent" }.  Listeners the callbacks missed are added as
+	guests, since the relay doesn't report the mount they tuned in with.  Listeners gone
+	from the relay are marked purged, and removed if they're still gone on the next pass.
+	"""
+	existing = {}
+	for (row_relay, icecast_id), listener_id in _by_icecast.items():
+		if row_relay == relay and _listeners[listener_id]['sid'] == sid:
+			existing[icecast_id] = _listeners[listener_id]
+
+	adds = [ (icecast_id, client) for icecast_id, client in clients.iteritems() if not icecast_id in existing ]
+	changes = { "added": len(adds), "purged": 0, "returned": 0, "deleted": 0 }
+	for icecast_id, row in existing.iteritems():
+		if icecast_id in clients:
+			if row['listener_purge']:
+				_set_purge(row, False)
+				changes['returned'] += 1
+		elif row['listener_purge']:
+			remove(relay, icecast_id)
+			changes['deleted'] += 1
+		else:
+			_set_purge(row, True)
+			changes['purged'] += 1
+	if len(adds) > 0:
+		work_queue.add("registry", "listener_reconcile", _reserve_ids, len(adds),
+			callback = functools.partial(_on_reserved, sid, relay, adds))
+	return changes
+
+def reconcile_relay(relay, clients_by_sid):
+	"""
+	Takes one poll's worth of results from libs.icecast, sid -> clients.
+	"""
+	started = time.time()
+	for sid, clients in clients_by_sid.iteritems():
+		changes = reconcile(relay, sid, clients)
+		log.debug("icecast_sync", "%s sid %s: %s" % (relay, sid, changes))
+	stats.record("icecast_reconcile", time.time() - started)
+
+def _on_reserved(sid, relay, adds, first_id):
+	if not first_id:
+		return
+	for i, (icecast_id, client) in enumerate(adds):
+		# A listener_add callback may have beaten us to it
+		if not (relay, icecast_id) in _by_icecast:
+			add(sid, relay, icecast_id, client['ip'], client['agent'], 1, first_id + i)
+
+def get(listener_id):
+	return _listeners.get(listener_id)
+
+def get_by_user(user_id):
+	return [ _listeners[listener_id] for listener_id in _by_user.get(user_id, []) ]
+
+def get_by_ip(ip):
+	return [ _listeners[listener_id] for listener_id in _by_ip.get(ip, []) ]
+
+def get_user_id_for_mount(mount):
+	"""
+	Tuning in with a listen key appends "?<user_id>:<radio_listen_key>" to the mount.
+	Anyone without a valid one listens as a guest.
+	"""
+	if mount.find("?") == -1 or mount.find(":") == -1:
+		return 1
+	user_id, listen_key = mount[mount.find("?") + 1:].split(":", 1)
+	if not user_id.isdigit() or int(user_id) <= 1:
+		return 1
+	if db.c.fetch_var("SELECT radio_listen_key FROM phpbb_users WHERE user_id = %s", (int(user_id),)) != listen_key:
+		return 1
+	return int(user_id)
+
+def start():
+	global _periodic
+	_periodic = tornado.ioloop.PeriodicCallback(queue_flush, config.get("listener_flush_interval") * 1000)
+	_periodic.start()
+
+def stop():
+	if _periodic:
+		_periodic.stop()
+
+def queue_flush():
+	# Adds and removes share the queue, so its length can't tell us whether a flush is already waiting
+	global _flush_queued
+	if not _flush_queued:
+		_flush_queued = True
+		work_queue.add("registry", "flush", flush, callback = _publish)
+
+def flush():
+	"""
+	Writes everything queued since the last flush in one transaction and returns
+	listener_id -> listener_voted_entry for listeners that have voted, which the API
+	records straight into r4_listeners.
+	"""
+	global _pending
+	_pending_lock.acquire()
+	pending = _pending
+	_pending = []
+	_pending_lock.release()
+	if len(pending) > 0:
+		db.c.start_transaction()
+		try:
+			for query, params in pending:
+				db.c.update(query, params)
+			db.c.commit()
+		except Exception as e:
+			db.c.rollback()
+			log.exception("registry", "Could not write %s listener changes." % len(pending), e)
+	votes = {}
+	for row in db.c.fetch_all("SELECT listener_id, listener_voted_entry FROM r4_listeners WHERE listener_voted_entry IS NOT NULL") or []:
+		votes[row['listener_id']] = row['listener_voted_entry']
+	return votes
+
+def _publish(votes):
+	# Back on the IOLoop, where the registry gets changed, so nothing moves under us here
+	global _flush_queued
+	_flush_queued = False
+	internal = {}
+	stations = {}
+	for sid in config.station_ids:
+		stations[sid] = []
+	for listener_id, row in _listeners.iteritems():
+		# None means the flush failed, keep what we had
+		if votes != None:
+			row['listener_voted_entry'] = votes.get(listener_id)
+		if row['sid'] in stations:
+			stations[row['sid']].append(row)
+		if row['user_id'] > 1 and not row['listener_purge']:
+			internal[row['user_id']] = {
+				"listener_id": listener_id,
+				"sid": row['sid'],
+				"listener_lock": row['listener_lock'],
+				"listener_lock_sid": row['listener_lock_sid'],
+				"listener_lock_counter": row['listener_lock_counter'],
+				"listener_voted_entry": row['listener_voted_entry']
+			}
+	cache.set("listeners_internal", internal)
+	for sid, rows in stations.iteritems():
+		cache.set_station(sid, "listener_counts", listeners.count_listeners(rows))
@@ -1,38 +1,147 @@
+import time
+import base64
+
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
 import tornado.process
 import tornado.options
+import tornado.escape
 
+from backend import work_queue
+from backend import trim
+from backend import registry
+from backend import sync_to_front
 from rainwave import schedule
 from libs import log
 from libs import config
 from libs import db
+from libs import cache
+from libs import stats
+from libs import icecast
+import relaysetup
 
 class AdvanceScheduleRequest(tornado.web.RequestHandler):
+	@tornado.web.asynchronous
 	def get(self, sid):
 		self.sid = None
-		if int(sid) in config.station_ids:
-			self.sid = int(sid)
-			schedule.advance_station(sid)
-			self.write(schedule.get_current_file())
-	
+		self._started = time.time()
+		if not int(sid) in config.station_ids:
+			self.finish()
+			return
+		# Too far behind to take another advance (and the post_process that follows it), Liquidsoap will ask again.
+		if work_queue.is_full(int(sid)):
+			log.warn("advance", "Station %s's queue is full, refusing to advance." % sid)
+			self.set_status(503)
+			self.finish()
+			return
+		self.sid = int(sid)
+
+		# Fast path: the station's worker is idle and the next event is ready, swap it in right here.
+		if schedule.is_prepared(self.sid):
+			ran, filename = work_queue.run_now(self.sid, schedule.advance_station, self.sid)
+			if ran:
+				self._write_filename(filename)
+				return
+		# Otherwise the station is still post-processing or has fallen behind - this is our backpressure.
+		# Advance once its worker catches up, without holding up the IOLoop (and other stations) meanwhile.
+		work_queue.add(self.sid, "advance", schedule.advance_station, self.sid, callback = self._write_filename)
+
+	def _write_filename(self, filename):
+		stats.record("advance_sid%s" % self.sid, time.time() - self._started)
+		if filename:
+			self.write(filename)
+		else:
+			# The advance job failed, don't hand Liquidsoap an empty filename as if it were fine
+			self.set_status(500)
+		self.finish()
+
 	def on_finish(self):
 		if self.sid:
-			schedule.post_process(self.sid)
+			work_queue.add(self.sid, "post_process", schedule.post_process, self.sid)
+
+class IcecastCallbackRequest(tornado.web.RequestHandler):
+	"""
+	Icecast's url auth sends the username and password options of the mount's
+	<authentication> block (see relaysetup.py) as HTTP basic auth.
+	"""
+	def prepare(self):
+		expected = "Basic %s" % base64.b64encode("%s:%s" % (config.get("icecast_auth_user"), config.get("icecast_auth_password")))
+		if self.request.headers.get("Authorization") != expected:
+			raise tornado.web.HTTPError(403)
+
+	def get_relay(self):
+		return "%s:%s" % (self.get_argument("server", ""), self.get_argument("port", ""))
+
+class ListenerAddRequest(IcecastCallbackRequest):
+	@tornado.web.asynchronous
+	def post(self, sid):
+		sid = int(sid)
+		if not sid in config.station_ids:
+			self.finish()
+			return
+		registry.queue_add(sid, self.get_relay(), int(self.get_argument("client")), self.get_argument("ip", None), self.get_argument("agent", None),
+			self.get_argument("mount", ""), callback = self._on_added)
+
+	def _on_added(self, row):
+		# Icecast only lets the listener through when it sees this header.  If we couldn't
+		# get to the DB they still get to listen, they just won't be counted.
+		self.set_header("icecast-auth-user", "1")
+		self.finish()
+
+class ListenerRemoveRequest(IcecastCallbackRequest):
+	def post(self, sid):
+		registry.queue_remove(self.get_relay(), int(self.get_argument("client")))
+
+class UserUpdatedRequest(tornado.web.RequestHandler):
+	"""
+	For the site to call whenever a user's phpbb_users row or API keys change, with
+	user_id and, if only one key changed, api_key.  Drops what memcache and the API
+	processes hold on to for the user.
+	"""
+	def post(self):
+		if not self.request.remote_ip == "127.0.0.1":
+			raise tornado.web.HTTPError(403)
+		user_id = int(self.get_argument("user_id"))
+		cache.set_user_id(user_id, "db_data", None)
+		sync_to_front.sync_frontend_user_id(user_id, self.get_argument("api_key", None))
+
+class StatsRequest(tornado.web.RequestHandler):
+	def get(self):
+		self.set_header("Content-Type", "application/json")
+		self.write(tornado.escape.json_encode(stats.to_dict()))
+
+def _get_mounts():
+	# Only the mounts of stations this install runs
+	mounts = {}
+	for station in relaysetup.STATIONS.itervalues():
+		if station['station_num'] in config.station_ids:
+			mounts[station['station_num']] = station['station_mount']
+	return mounts
 
 def start():
-	log.init(log_file, config.get("log_level"))
-	log.debug("start", "Server booting, port %s." % port_no)
-	db.open()
-	
+	log.debug("start", "Server booting, port %s." % config.get("backend_port"))
+	db.open(per_thread = True)
+	cache.open(per_thread = True)
+
 	app = tornado.web.Application([
-		(r"/advance/([0-9]+)", AdvanceScheduleRequest)
+		(r"/advance/([0-9]+)", AdvanceScheduleRequest),
+		(r"/sync/([0-9]+)/listener_add", ListenerAddRequest),
+		(r"/sync/([0-9]+)/listener_remove", ListenerRemoveRequest),
+		(r"/sync/user_updated", UserUpdatedRequest),
+		(r"/stats", StatsRequest)
 		])
-	
+
 	server = tornado.httpserver.HTTPServer(app)
 	server.listen(int(config.get("backend_port")), address='127.0.0.1')
-	
+
 	schedule.load()
-	
+	registry.load()
+	registry.start()
+	if config.get("relays"):
+		icecast.start(_get_mounts(), registry.reconcile_relay)
+	for sid in config.station_ids:
+		work_queue.add(sid, "reconcile", schedule.reconcile, sid)
+	trim.start()
+
 	tornado.ioloop.IOLoop.instance().start()
@@ -1,26 +1,74 @@
+import time
 import urllib
-import httplib
+import functools
 
+import tornado.ioloop
+import tornado.httpclient
+
+from libs import bus
 from libs import log
 from libs import config
+from libs import stats
+
+# Tells every API process to push fresh data to its parked Sync clients.
+# Requests go out from the IOLoop, to every API process at once, so callers
+# on a work_queue worker never wait on them and a hung API process only
+# times out its own request.  Delivery times and failures are recorded per
+# API port as sync_to_front_<port> and sync_to_front_failures_<port>.
+#
+# With bus_dir configured, notifications go over libs.bus instead and carry
+# the data the API processes would otherwise fetch from memcache.
+
+_http_client = None
+
+def _get_client():
+	global _http_client
+	if not _http_client:
+		# Enough for one round of notifications to every API process without queueing
+		_http_client = tornado.httpclient.AsyncHTTPClient(max_clients = max(10, config.get("api_num_processes") * 4))
+	return _http_client
 
-def sync_frontend_all(sid):
-	headers = ({"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain text/html text/javascript application/json application/javascript" })
-	params = urllib.urlencode({ "sid": sid })
-	for i in range(0, config.get("num_processes")):
-		conn = httplib.HTTPConnection('localhost', config.get("base_port") + i)
-		conn.request("GET", "/api/sync_update_all", params, headers)
+def _notify(url, params):
+	# Safe to call from any thread
+	tornado.ioloop.IOLoop.instance().add_callback(functools.partial(_send_all, url, urllib.urlencode(params)))
+
+def _send_all(url, query):
+	for i in range(0, config.get("api_num_processes")):
+		port = config.get("api_base_port") + i
+		request = tornado.httpclient.HTTPRequest("http://localhost:%s/api/%s?%s" % (port, url, query),
+			connect_timeout = config.get("sync_to_front_timeout"), request_timeout = config.get("sync_to_front_timeout"))
+		_get_client().fetch(request, functools.partial(_on_response, port, url, time.time()))
+
+def _on_response(port, url, started, response):
+	stats.record("sync_to_front_%s" % port, time.time() - started)
+	if response.error:
+		stats.record("sync_to_front_failures_%s" % port, 1, base = 1)
+		log.warn("sync_to_front", "%s to API port %s failed: %s" % (url, port, response.error))
+
+def sync_frontend_all(sid, station = None):
+	"""
+	station is station cache key -> value as just published, which the bus hands straight to the API.
+	"""
+	if config.get("bus_dir"):
+		bus.publish("station_updated", { "sid": sid }, station)
+	else:
+		_notify("sync_update_all", { "sid": sid })
 
 def sync_frontend_ip(ip_address):
-	headers = ({"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain text/html text/javascript application/json application/javascript" })
-	params = urllib.urlencode({ "sid": sid, "ip_address": ip_address })
-	for i in range(0, config.get("num_processes")):
-		conn = httplib.HTTPConnection('localhost', config.get("base_port") + i)
-		conn.request("GET", "/api/sync_update_ip", params, headers)
-
-def sync_frontend_user_id(user_id):
-	headers = ({"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain text/html text/javascript application/json application/javascript" })
-	params = urllib.urlencode({ "sid": sid })
-	for i in range(0, config.get("num_processes")):
-		conn = httplib.HTTPConnection('localhost', config.get("base_port") + i)
-		conn.request("GET", "/api/sync_update_user", params, headers)
+	if config.get("bus_dir"):
+		bus.publish("ip_updated", { "ip_address": ip_address })
+	else:
+		_notify("sync_update_ip", { "ip_address": ip_address })
+
+def sync_frontend_user_id(user_id, api_key = None):
+	"""
+	Also drops the user's cached authorizations in every API process, or just
+	those of api_key if one's given.
+	"""
+	payload = { "user_id": user_id }
+	if api_key:
+		payload['api_key'] = api_key
+	if config.get("bus_dir"):
+		bus.publish("user_updated", payload)
+	else:
+		_notify("sync_update_user", payload)
@@ -0,0 +1,70 @@
+import time
+
+import tornado.ioloop
+
+from backend import work_queue
+from libs import db
+from libs import log
+from libs import config
+from libs import stats
+from rainwave import listeners
+
+# Trims old rows out of the schedule, election, and song history tables.
+# This used to happen on every song change on every station, right in the
+# middle of post-processing.  Now it runs on its own worker on its own cadence,
+# deleting a bounded chunk at a time by primary key so no single DELETE (and its
+# cascades) holds locks for long.  It also ages the per-day vote counts behind
+# the listener list's 2 week vote totals, after rebuilding them from the vote
+# history once at startup.
+
+_periodic = None
+
+def start():
+	global _periodic
+	work_queue.add("trim", "backfill_vote_counts", listeners.backfill_vote_counts)
+	_periodic = tornado.ioloop.PeriodicCallback(queue_trim, config.get("trim_interval") * 1000)
+	_periodic.start()
+
+def stop():
+	if _periodic:
+		_periodic.stop()
+
+def queue_trim():
+	# Never stack up trims if one is still waiting or going
+	if work_queue.pending("trim") == 0:
+		work_queue.add("trim", "trim", trim_all)
+
+def trim_all():
+	removed = {}
+	removed['r4_schedule'] = _delete_chunked("r4_schedule", "sched_id", "sched_start_actual <= %s", (time.time() - config.get("trim_event_age"),))
+	removed['r4_elections'] = _delete_chunked("r4_elections", "elec_id", "elec_start_actual <= %s", (time.time() - config.get("trim_election_age"),))
+	removed['r4_song_history'] = 0
+	for sid in config.station_ids:
+		removed['r4_song_history'] += trim_history(sid)
+	removed['r4_vote_days'] = listeners.age_vote_counts()
+
+	for table, count in removed.iteritems():
+		stats.record("trim_%s" % table, count, base = 1)
+	log.info("trim", "Trimmed %s schedule, %s election, %s song history rows." % (removed['r4_schedule'], removed['r4_elections'], removed['r4_song_history']))
+	return removed
+
+def trim_history(sid):
+	# Keep the newest trim_history_length rows for the station, by songhist_id
+	oldest_kept = db.c.fetch_var("SELECT songhist_id FROM r4_song_history WHERE sid = %s ORDER BY songhist_id DESC LIMIT 1 OFFSET %s", (sid, config.get("trim_history_length") - 1))
+	if not oldest_kept:
+		return 0
+	return _delete_chunked("r4_song_history", "songhist_id", "sid = %s AND songhist_id < %s", (sid, oldest_kept))
+
+def _delete_chunked(table, key, where, params):
+	chunk_size = config.get("trim_chunk_size")
+	query = "DELETE FROM " + table + " WHERE " + key + " IN (SELECT " + key + " FROM " + table + " WHERE " + where + " ORDER BY " + key + " LIMIT %s)"
+	total = 0
+	for i in range(0, config.get("trim_max_chunks")):
+		deleted = db.c.update(query, params + (chunk_size,))
+		if deleted > 0:
+			total += deleted
+		if deleted < chunk_size:
+			break
+		# Give everything else waiting on these rows a chance to get in between chunks
+		time.sleep(config.get("trim_chunk_delay"))
+	return total
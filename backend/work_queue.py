@@ -0,0 +1,126 @@
+import functools
+import Queue
+import threading
+import time
+
+import tornado.ioloop
+
+from libs import log
+from libs import config
+from libs import stats
+
+# Ordered, per-station queues for work that doesn't have to happen before
+# Liquidsoap gets its next filename (elections, memcache, front-end sync, etc).
+#
+# Every station gets its own worker thread (and through db.PerThreadCursor its
+# own DB connection), so stations post-process in parallel and a slow station
+# never holds up another.  A station's jobs always run in order, one at a time,
+# so only that station's worker ever touches its entries in schedule.current,
+# schedule.next and schedule.history.
+
+_workers = {}
+_workers_lock = threading.Lock()
+
+class Worker(threading.Thread):
+	def __init__(self, key):
+		super(Worker, self).__init__(name = "worker_%s" % key)
+		self.daemon = True
+		self.key = key
+		self.jobs = Queue.Queue()
+		# Held while a job runs, so a job and run_now never overlap
+		self.busy = threading.Lock()
+		# Jobs added and not yet finished, including one that's been taken off the queue
+		# but not started yet, so run_now can't jump ahead of it.  Guarded by pending_lock.
+		self.pending = 0
+		self.pending_lock = threading.Lock()
+
+	def run(self):
+		while True:
+			job = self.jobs.get()
+			self.busy.acquire()
+			try:
+				_run_job(self.key, *job)
+			finally:
+				self.busy.release()
+				self.pending_lock.acquire()
+				self.pending -= 1
+				self.pending_lock.release()
+				self.jobs.task_done()
+
+def _get_worker(key):
+	_workers_lock.acquire()
+	try:
+		if not key in _workers:
+			_workers[key] = Worker(key)
+			_workers[key].start()
+		return _workers[key]
+	finally:
+		_workers_lock.release()
+
+def add(key, name, func, *args, **kwargs):
+	"""
+	Queues func(*args) to run on key's worker thread.  If a callback keyword
+	argument is given, it will be called on the IOLoop with the job's
+	result (None if the job failed).
+	"""
+	worker = _get_worker(key)
+	worker.pending_lock.acquire()
+	worker.pending += 1
+	worker.pending_lock.release()
+	worker.jobs.put((name, func, args, kwargs.get("callback"), time.time()))
+	stats.record("queue_depth_%s" % key, worker.jobs.qsize(), base = 1)
+
+def length(key):
+	if not key in _workers:
+		return 0
+	return _workers[key].jobs.qsize()
+
+def pending(key):
+	"""
+	Jobs added for key that haven't finished, counting the one running.
+	"""
+	if not key in _workers:
+		return 0
+	return _workers[key].pending
+
+def is_full(key):
+	return length(key) >= config.get("backend_queue_max_length")
+
+def run_now(key, func, *args):
+	"""
+	Runs func(*args) on the calling thread if key's worker is idle with
+	nothing queued.  Returns (True, result) if it ran, (False, None) if
+	the caller should add() the work instead.
+	"""
+	worker = _get_worker(key)
+	worker.pending_lock.acquire()
+	try:
+		if worker.pending > 0 or not worker.busy.acquire(False):
+			return (False, None)
+	finally:
+		worker.pending_lock.release()
+	try:
+		return (True, func(*args))
+	finally:
+		worker.busy.release()
+
+def wait(key):
+	"""
+	Blocks until everything queued for key has run.
+	"""
+	if key in _workers:
+		_workers[key].jobs.join()
+
+def _run_job(key, name, func, args, callback, queued_at):
+	started = time.time()
+	stats.record("queue_wait_%s_%s" % (name, key), started - queued_at)
+	result = None
+	try:
+		result = func(*args)
+	except Exception as e:
+		log.exception("queue", "%s failed for %s." % (name, key), e)
+	run_time = time.time() - started
+	stats.record("queue_run_%s_%s" % (name, key), run_time)
+	log.debug("queue", "%s for %s took %.3fs after waiting %.3fs." % (name, key, run_time, started - queued_at))
+	if callback:
+		tornado.ioloop.IOLoop.instance().add_callback(functools.partial(callback, result))
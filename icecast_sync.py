@@ -1,3 +0,0 @@
-#!/usr/bin/python
-
-# TODO LATER: Sync listeners table with Icecast servers here
@@ -0,0 +1,121 @@
+import os
+import time
+import errno
+import socket
+import cPickle as pickle
+
+import tornado.ioloop
+
+from libs import log
+from libs import config
+from libs import stats
+
+# A local message bus from the backend to the API processes on the same host.
+# Every API process binds a Unix datagram socket in bus_dir named after its
+# port, and publish() sends each event to all of them, so nothing sits between
+# the backend and the workers and a dead worker costs one failed sendto.
+#
+# Events are pickled (type, payload, bulk) tuples.  The types in use:
+#   station_updated     { "sid" }, station cache key -> value
+#   user_updated        { "user_id" }
+#   ip_updated          { "ip_address" }
+# Bulk that won't fit in bus_max_datagram goes out as None, and subscribers
+# fall back to fetching the same data from memcache.
+
+# event type -> [ handler, ... ]
+_handlers = {}
+_publish_socket = None
+_subscribe_socket = None
+
+def get_path(port):
+	return os.path.join(config.get("bus_dir"), "api_%s.sock" % port)
+
+def _get_paths():
+	return [ get_path(config.get("api_base_port") + i) for i in range(0, config.get("api_num_processes")) ]
+
+def _encode(event_type, payload, bulk):
+	message = pickle.dumps((event_type, payload, bulk), pickle.HIGHEST_PROTOCOL)
+	if bulk != None and len(message) > config.get("bus_max_datagram"):
+		stats.record("bus_oversize_%s" % event_type, len(message), base = 1024)
+		message = pickle.dumps((event_type, payload, None), pickle.HIGHEST_PROTOCOL)
+	return message
+
+def publish(event_type, payload, bulk = None):
+	"""
+	Sends an event to every API process, never blocking.  Returns how many got it.
+	"""
+	global _publish_socket
+	if not _publish_socket:
+		_publish_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		_publish_socket.setblocking(0)
+	message = _encode(event_type, payload, bulk)
+	delivered = 0
+	for path in _get_paths():
+		try:
+			_publish_socket.sendto(message, path)
+			delivered += 1
+		except socket.error as e:
+			# Not running (ENOENT, ECONNREFUSED) or too far behind to take more (EAGAIN)
+			stats.record("bus_failures_%s" % os.path.basename(path), 1, base = 1)
+			log.warn("bus", "Could not send %s to %s: %s" % (event_type, path, e))
+	stats.record("bus_publish_size", len(message), base = 1024)
+	return delivered
+
+def subscribe(event_type, handler):
+	"""
+	handler(payload, bulk) gets called on the IOLoop for every event of this type.
+	"""
+	if not event_type in _handlers:
+		_handlers[event_type] = []
+	_handlers[event_type].append(handler)
+
+def listen(port):
+	"""
+	Binds this API process's socket and starts handing events to the IOLoop.
+	"""
+	global _subscribe_socket
+	path = get_path(port)
+	if os.path.exists(path):
+		os.remove(path)
+	_subscribe_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+	# Anyone who can write to the socket can push data out to every client, so only
+	# the user and group the backend and API run as get to, from the moment it exists
+	old_umask = os.umask(0117)
+	try:
+		_subscribe_socket.bind(path)
+	finally:
+		os.umask(old_umask)
+	os.chmod(path, 0660)
+	_subscribe_socket.setblocking(0)
+	tornado.ioloop.IOLoop.instance().add_handler(_subscribe_socket.fileno(), _on_readable, tornado.ioloop.IOLoop.READ)
+
+def close():
+	global _subscribe_socket
+	if not _subscribe_socket:
+		return
+	path = _subscribe_socket.getsockname()
+	tornado.ioloop.IOLoop.instance().remove_handler(_subscribe_socket.fileno())
+	_subscribe_socket.close()
+	_subscribe_socket = None
+	if os.path.exists(path):
+		os.remove(path)
+
+def _on_readable(fd, events):
+	while True:
+		try:
+			message = _subscribe_socket.recv(config.get("bus_max_datagram"))
+		except socket.error as e:
+			if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return
+			raise
+		dispatch(message)
+
+def dispatch(message):
+	event_type, payload, bulk = pickle.loads(message)
+	started = time.time()
+	for handler in _handlers.get(event_type, []):
+		try:
+			handler(payload, bulk)
+		except Exception as e:
+			log.exception("bus", "Handler for %s failed." % event_type, e)
+	stats.record("bus_%s" % event_type, time.time() - started)
@@ -1,7 +1,13 @@
+import time
+import threading
+import collections
 import pylibmc
 from libs import config
+from libs import stats
 
 _memcache = None
+_per_thread = False
+_thread_clients = threading.local()
 local = {}
 
 class TestModeCache(object):
@@ -17,22 +23,82 @@ class TestModeCache(object):
 	def set(self, key, value):
 		self.vars[key] = value
 
-def open():
+	def clone(self):
+		return self
+
+class TTLCache(object):
+	"""
+	A small per-process cache that holds at most max_size items, dropping the least
+	recently used first, and forgets anything older than ttl seconds.
+	"""
+	def __init__(self, max_size, ttl):
+		self.max_size = max_size
+		self.ttl = ttl
+		self.items = collections.OrderedDict()
+
+	def get(self, key):
+		item = self.items.pop(key, None)
+		if not item or item[0] < time.time():
+			return None
+		self.items[key] = item
+		return item[1]
+
+	def set(self, key, value):
+		self.items.pop(key, None)
+		self.items[key] = (time.time() + self.ttl, value)
+		while len(self.items) > self.max_size:
+			self.items.popitem(last = False)
+
+	def delete(self, key):
+		self.items.pop(key, None)
+
+	def delete_where(self, func):
+		for key in [ key for key in self.items if func(key) ]:
+			del self.items[key]
+
+	def clear(self):
+		self.items.clear()
+
+def open(per_thread = False, timed = False):
+	"""
+	timed adds the time spent talking to memcache to stats' "cache" timer, for per-request accounting.
+	"""
 	global _memcache
+	global _per_thread
+	_per_thread = per_thread
 	if not config.test_mode or config.get("test_use_memcache"):
 		_memcache = pylibmc.Client(config.get("memcache_servers"), binary = True)
 		_memcache.behaviors = { "tcp_nodelay": True, "ketama": config.get("memcache_ketama") }
 	else:
 		_memcache = TestModeCache()
+	if timed:
+		_memcache = stats.Timed(_memcache, "cache", ("get", "set"))
+
+def _client():
+	# pylibmc clients can't be shared between threads, so threaded processes
+	# (the backend's station workers) each get their own clone.
+	if not _per_thread:
+		return _memcache
+	client = getattr(_thread_clients, "client", None)
+	if not client:
+		client = _memcache.clone()
+		_thread_clients.client = client
+	return client
 
 def set_user(user, key, value):
-	_memcache.set("u%s_%s" % (user.id, key), value)
+	set_user_id(user.id, key, value)
 	
 def get_user(user, key):
-	return _memcache.get("u%s_%s" % (user.id, key))
+	return get_user_id(user.id, key)
+
+def set_user_id(user_id, key, value):
+	_client().set("u%s_%s" % (user_id, key), value)
+
+def get_user_id(user_id, key):
+	return _client().get("u%s_%s" % (user_id, key))
 	
 def set_station(sid, key, value):
-	_memcache.set("sid%s_%s" % (sid, key), value)
+	_client().set("sid%s_%s" % (sid, key), value)
 	
 def get_local_station(sid, key):
 	return local["sid%s_%s" % (sid, key)]
@@ -41,13 +107,13 @@ def local_exists(sid, key):
 	return "sid%s_%s" % (sid, key) in local
 	
 def get_station(sid, key):
-	return _memcache.get("sid%s_%s" % (sid, key))
+	return _client().get("sid%s_%s" % (sid, key))
 	
 def set(key, value):
-	_memcache.set(key, value)
+	_client().set(key, value)
 
 def get(key):
-	return _memcache.get(key)
+	return _client().get(key)
 
 def refresh_local(key):
 	local[key] = get(key)
@@ -62,31 +128,47 @@ def push_local_station(sid, key):
 	key = "sid%s_%s" % (sid, key)
 	set(key, local[key])
 
+def bump_sync_versions(sid, sections):
+	"""
+	Marks Sync sections (as named in its output) as changed for a station.  Versions live in
+	memcache so every API process agrees on them, and start from the clock so a flushed
+	memcache can't hand out a version a client already holds for older content.
+	This reads, changes and writes back one key, so only ever call it from the
+	station's own work_queue worker, where nothing else can bump it at the same time.
+	"""
+	versions = dict(get_station(sid, "sync_versions") or {})
+	now = int(time.time())
+	for section in sections:
+		versions[section] = max(versions.get(section, 0) + 1, now)
+	set_station(sid, "sync_versions", versions)
+	return versions
+
 def prime_rating_cache_for_events(events):
-	key = 'song_ratings_%s' % event[0].sid
+	key = 'song_ratings_%s' % events[0].sid
 	local[key] = {}
 	for event in events:
 		for song in event.songs:
 			local[key][song.id] = song.get_all_ratings()
 	push_local_to_memcache(key)
 	
-def update_local_cache_for_sid(sid):
-	refresh_local_station(sid, "album_diff")
-	refresh_local_station(sid, "sched_next")
-	refresh_local_station(sid, "sched_history")
-	refresh_local_station(sid, "sched_current")
-	refresh_local_station(sid, "listeners_current")
-	refresh_local_station(sid, "listeners_internal")
-	refresh_local_station(sid, "request_line")
-	refresh_local_station(sid, "request_user_positions")
-	refresh_local_station(sid, "user_rating_acl")
-	refresh_local_station(sid, "user_rating_acl_song_index")
-	refresh_local("request_expire_times")
+def update_local_cache_for_sid(sid, known = None):
+	"""
+	Refreshes this process's copy of a station from memcache.  known is station key -> value
+	for anything the caller already has (off the bus, say), which skips fetching those.
+	"""
+	if not known:
+		known = {}
+	for key in ("album_diff", "sched_next", "sched_history", "sched_current", "listeners_current", "request_line",
+			"request_user_positions", "request_expiries", "sync_versions", "user_rating_acl", "user_rating_acl_song_index",
+			# The caches below should only be used on new-song refreshes
+			"song_ratings"):
+		if key in known:
+			local["sid%s_%s" % (sid, key)] = known[key]
+		else:
+			refresh_local_station(sid, key)
+	refresh_local("listeners_internal")
 	refresh_local("calendar")
 	
-	# The caches below should only be used on new-song refreshes
-	refresh_local_station(sid, "song_ratings")
-	
 def update_user_rating_acl(sid, song_id):
 	users = {}
 	if local_exists(sid, "user_rating_acl"):
@@ -2,9 +2,11 @@ import psycopg2
 from psycopg2 import extras
 import sqlite3
 import re
+import threading
 
 from libs import config
 from libs import log
+from libs import stats
 
 c = None
 connection = None
@@ -61,6 +63,22 @@ class PostgresCursor(psycopg2.extras.RealDictCursor):
 		self.execute(query, params)
 		return self.rowcount
 		
+	def update_many(self, query, params_list):
+		if len(params_list) == 0:
+			return 0
+		self.executemany(query, params_list)
+		return self.rowcount
+		
+	# The connection runs in autocommit, so these open and close an explicit block
+	def start_transaction(self):
+		self.execute("BEGIN")
+		
+	def commit(self):
+		self.execute("COMMIT")
+		
+	def rollback(self):
+		self.execute("ROLLBACK")
+		
 	def get_next_id(self, table, column):
 		return self.fetch_var("SELECT nextval('" + table + "_" + column + "_seq'::regclass)")
 		
@@ -79,13 +97,18 @@ class PostgresCursor(psycopg2.extras.RealDictCursor):
 		columns = ','.join(map(str, args))
 		self.execute("CREATE INDEX %s ON %s (%s)", (name, table, columns))
 		
+# Seconds a connection waits for another thread's connection to let go of the write lock
+_SQLITE_TIMEOUT = 30
+
 class SQLiteCursor(object):
 	def __init__(self, filename):
-		self.con = sqlite3.connect(filename, 0, sqlite3.PARSE_DECLTYPES)
+		# Each thread still gets its own connection (see PerThreadCursor), this only lets close() happen from anywhere
+		self.con = sqlite3.connect(filename, _SQLITE_TIMEOUT, sqlite3.PARSE_DECLTYPES, check_same_thread = False)
 		# self.con.isolation_level = None
 		self.con.row_factory = self._dict_factory
 		self.cur = self.con.cursor()
 		self.rowcount = 0
+		self.in_transaction = False
 		self.print_next = False
 		
 	def close(self):
@@ -142,10 +165,35 @@ class SQLiteCursor(object):
 			arr.append(row[row.keys()[0]])
 		return arr
 		
+	# Like Postgres' autocommit, a write outside start_transaction() is committed right
+	# away, so the write lock isn't held and every other thread's connection locked out
 	def update(self, query, params = None):
 		self.execute(query, params)
+		if not self.in_transaction:
+			self.con.commit()
 		return self.cur.rowcount
 		
+	def update_many(self, query, params_list):
+		if len(params_list) == 0:
+			return 0
+		self.cur.executemany(self._convert_pg_query(query), params_list)
+		self.rowcount = self.cur.rowcount
+		if not self.in_transaction:
+			self.con.commit()
+		return self.cur.rowcount
+		
+	# sqlite3 already opens a transaction before the first write on its own
+	def start_transaction(self):
+		self.in_transaction = True
+		
+	def commit(self):
+		self.in_transaction = False
+		self.con.commit()
+		
+	def rollback(self):
+		self.in_transaction = False
+		self.con.rollback()
+		
 	def execute(self, query, params = None):
 		if self.print_next:
 			self.print_next = False
@@ -185,13 +233,39 @@ class SQLiteCursor(object):
 	def create_idx(self, table, *args):
 		pass
 		
-def open():
-	global connection
-	global c
-	
-	if c:
-		close()
-	
+class PerThreadCursor(object):
+	"""
+	Hands each thread its own connection and cursor, opened the first time
+	that thread touches the DB.  Used by the backend, where every station
+	does its post-processing on its own worker thread.
+	"""
+	def __init__(self):
+		self._local = threading.local()
+		self._cursors = []
+		self._lock = threading.Lock()
+
+	def _get_cursor(self):
+		cursor = getattr(self._local, "cursor", None)
+		if not cursor:
+			cursor = _connect()
+			self._local.cursor = cursor
+			self._lock.acquire()
+			self._cursors.append(cursor)
+			self._lock.release()
+		return cursor
+
+	def __getattr__(self, name):
+		return getattr(self._get_cursor(), name)
+
+	def close(self):
+		self._lock.acquire()
+		for cursor in self._cursors:
+			_close_cursor(cursor)
+		self._cursors = []
+		self._lock.release()
+		self._local = threading.local()
+
+def _connect():
 	type = config.get("db_type")
 	name = config.get("db_name")
 	host = config.get("db_host")
@@ -202,7 +276,7 @@ def open():
 	if type == "postgres":
 		psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 		psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
-		connstr = "sslmode=disable dbname=%s" % name
+		connstr = "sslmode=disable dbname=%s " % name
 		if host:
 			connstr += "host=%s " % host
 		if port:
@@ -211,26 +285,61 @@ def open():
 			connstr += "user=%s " % user
 		if password:
 			connstr += "password=%s " % password
-		connection = psycopg2.connect(connstr)
-		connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-		connection.autocommit = True
-		c = self.con.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+		pg_connection = psycopg2.connect(connstr)
+		pg_connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+		pg_connection.autocommit = True
+		return pg_connection.cursor(cursor_factory=PostgresCursor)
 	elif type == "sqlite":
 		log.debug("dbopen", "Opening SQLite DB %s" % name)
-		c = SQLiteCursor(name)
+		return SQLiteCursor(name)
 	else:
 		log.critical("dbopen", "Invalid DB type %s!" % type)
-		return False
+		return None
+
+def _close_cursor(cursor):
+	if isinstance(cursor, PostgresCursor):
+		pg_connection = cursor.connection
+		cursor.close()
+		pg_connection.close()
+	else:
+		cursor.close()
+
+# Cursor calls that get timed when the DB is opened with timed = True
+_TIMED_METHODS = ("fetch_var", "fetch_row", "fetch_all", "fetch_list", "update", "update_many", "get_next_id")
 
+def open(per_thread = False, timed = False):
+	"""
+	timed adds the time spent in queries to stats' "db" timer, for per-request accounting.
+	"""
+	global connection
+	global c
+	
+	if c:
+		close()
+	
+	if per_thread:
+		c = PerThreadCursor()
+		return True
+
+	c = _connect()
+	if not c:
+		return False
+	if isinstance(c, PostgresCursor):
+		connection = c.connection
+	if timed:
+		c = stats.Timed(c, "db", _TIMED_METHODS)
 	return True
 		
 def close():
 	global connection
 	global c
 	
-	if connection:
-		connection.close()
-	c.close()
+	if isinstance(c, stats.Timed):
+		c = c.wrapped
+	if isinstance(c, PerThreadCursor):
+		c.close()
+	elif c:
+		_close_cursor(c)
 	
 	connection = False
 	c = False
@@ -563,6 +672,26 @@ def create_tables():
 	c.create_null_fk("r4_vote_history", "r4_songs", "song_id")
 	c.create_delete_fk("r4_vote_history", "phpbb_users", "user_id")
 	
+	# Per-user votes per day (days since the epoch), only kept for the last 2 weeks
+	c.update(" \
+		CREATE TABLE r4_vote_days ( \
+			user_id					INTEGER		NOT NULL, \
+			vote_day				INTEGER		NOT NULL, \
+			vote_count				INTEGER		DEFAULT 0, \
+			UNIQUE (user_id, vote_day) \
+		)")
+	# c.create_idx("r4_vote_days", "user_id")		# handled by create_delete_fk
+	c.create_idx("r4_vote_days", "vote_day")
+	c.create_delete_fk("r4_vote_days", "phpbb_users", "user_id")
+	
+	# Running sum of r4_vote_days per user
+	c.update(" \
+		CREATE TABLE r4_vote_totals ( \
+			user_id					INTEGER		PRIMARY KEY, \
+			vote_2wk				INTEGER		DEFAULT 0 \
+		)")
+	c.create_delete_fk("r4_vote_totals", "phpbb_users", "user_id", create_idx=False)
+	
 	c.update(" \
 		CREATE TABLE r4_api_keys ( \
 			api_id					SERIAL		PRIMARY KEY, \
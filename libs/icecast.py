@@ -0,0 +1,119 @@
+import time
+import base64
+import socket
+import httplib
+import threading
+import functools
+import xml.etree.cElementTree as ElementTree
+
+import tornado.ioloop
+
+from libs import log
+from libs import config
+from libs import stats
+
+# Polls Icecast relays' admin listclients pages for the backend's listener
+# registry to reconcile against.  Every relay gets its own thread and kept-alive
+# connection, so a relay that's slow or down only holds up its own results.
+
+class RelayError(Exception):
+	pass
+
+def parse_listclients(body):
+	"""
+	Returns Icecast client ID -> { "ip", "agent" } from an admin/listclients XML response.
+	"""
+	clients = {}
+	for listener in ElementTree.fromstring(body).iter("listener"):
+		icecast_id = listener.findtext("ID") or listener.get("id")
+		clients[int(icecast_id)] = { "ip": listener.findtext("IP"), "agent": listener.findtext("UserAgent") }
+	return clients
+
+def parse_hostname(body):
+	"""
+	Returns Icecast's <hostname> from an admin/stats XML response.
+	"""
+	return ElementTree.fromstring(body).findtext("host")
+
+class RelayPoller(threading.Thread):
+	def __init__(self, name, relay, mounts, callback):
+		"""
+		relay is a "relays" config entry, mounts is sid -> mount name, and
+		callback(relay key, sid -> clients) gets called on the IOLoop after every poll.
+		"""
+		super(RelayPoller, self).__init__(name = "icecast_%s" % name)
+		self.daemon = True
+		self.relay_name = name
+		self.relay = relay
+		self.key = None
+		self.mounts = mounts
+		self.callback = callback
+		self.auth = "Basic %s" % base64.b64encode("%s:%s" % (relay['user'], relay['password']))
+		self.connection = None
+		self.running = True
+
+	def _get(self, path):
+		# One retry, since the relay is free to drop a kept-alive connection between polls
+		for attempt in (0, 1):
+			if not self.connection:
+				self.connection = httplib.HTTPConnection(self.relay['host'], self.relay['port'], timeout = config.get("icecast_sync_timeout"))
+			try:
+				self.connection.request("GET", path, headers = { "Authorization": self.auth })
+				response = self.connection.getresponse()
+				body = response.read()
+			except (httplib.HTTPException, socket.error):
+				self.connection.close()
+				self.connection = None
+				if attempt == 1:
+					raise
+				continue
+			if response.status != 200:
+				raise RelayError("%s returned HTTP %s for %s." % (self.relay_name, response.status, path))
+			return body
+
+	def get_key(self):
+		"""
+		The relay as Icecast's listener_add and listener_remove callbacks name it: the server
+		and port they send are its own <hostname> and <port>, which needn't be the address
+		we poll it at, so the hostname comes from the relay.  None until it's answered.
+		"""
+		if not self.key:
+			try:
+				self.key = "%s:%s" % (parse_hostname(self._get("/admin/stats")), self.relay['port'])
+			except Exception as e:
+				log.exception("icecast_sync", "Could not get the hostname of %s." % self.relay_name, e)
+		return self.key
+
+	def poll(self):
+		"""
+		Returns sid -> clients for every mount the relay answered for.  Mounts that
+		failed are left out, so nobody gets purged because of a relay hiccup.
+		"""
+		result = {}
+		started = time.time()
+		for sid, mount in self.mounts.iteritems():
+			try:
+				result[sid] = parse_listclients(self._get("/admin/listclients?mount=/%s" % mount))
+			except Exception as e:
+				log.exception("icecast_sync", "Could not get listeners for /%s from %s." % (mount, self.relay_name), e)
+		stats.record("icecast_poll_%s" % self.relay_name, time.time() - started)
+		return result
+
+	def run(self):
+		while self.running:
+			started = time.time()
+			if self.get_key():
+				tornado.ioloop.IOLoop.instance().add_callback(functools.partial(self.callback, self.key, self.poll()))
+			time.sleep(max(0, config.get("icecast_sync_interval") - (time.time() - started)))
+
+def start(mounts, callback):
+	"""
+	Starts a poller for every configured relay.  callback(relay key, sid -> clients) gets
+	called on the IOLoop after every poll.
+	"""
+	pollers = []
+	for name, relay in config.get("relays").iteritems():
+		poller = RelayPoller(name, relay, mounts, callback)
+		poller.start()
+		pollers.append(poller)
+	return pollers
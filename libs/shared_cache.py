@@ -0,0 +1,101 @@
+import os
+import mmap
+import struct
+import cPickle as pickle
+
+from libs import log
+from libs import config
+from libs import stats
+
+# Per-station snapshots the backend writes into a memory-mapped file in
+# shared_cache_dir, for every API process on the host to read instead of
+# going to memcache.  Each file is shared_cache_size bytes: a header of
+# (sequence, payload length) followed by the pickled station.
+#
+# The sequence works as a seqlock.  The station's worker, its only writer,
+# makes it odd while writing and even again once done, so a reader that sees
+# the same even number before and after copying the payload has a whole
+# snapshot.  Checking for a new snapshot is an 8 byte read, and a process
+# only unpickles a snapshot once however often it asks for it.
+
+_HEADER = struct.Struct("<QQ")
+_SEQUENCE = struct.Struct("<Q")
+_READ_ATTEMPTS = 100
+
+# sid -> writable mmap, in the backend
+_writers = {}
+# sid -> read-only mmap, in API processes
+_readers = {}
+# sid -> (sequence, station) last read by this process
+_snapshots = {}
+
+def get_path(sid):
+	return os.path.join(config.get("shared_cache_dir"), "sid%s.shm" % sid)
+
+def _get_writer(sid):
+	if not sid in _writers:
+		size = config.get("shared_cache_size")
+		f = open(get_path(sid), "a+b")
+		if os.path.getsize(get_path(sid)) < size:
+			f.truncate(size)
+		_writers[sid] = mmap.mmap(f.fileno(), size, access = mmap.ACCESS_WRITE)
+		f.close()
+	return _writers[sid]
+
+def _get_reader(sid):
+	if not sid in _readers:
+		if not os.path.exists(get_path(sid)):
+			return None
+		f = open(get_path(sid), "rb")
+		_readers[sid] = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		f.close()
+	return _readers[sid]
+
+def publish(sid, station):
+	"""
+	Writes station key -> value for the API processes.  Returns False if it won't fit.
+	"""
+	data = pickle.dumps(station, pickle.HIGHEST_PROTOCOL)
+	region = _get_writer(sid)
+	if _HEADER.size + len(data) > len(region):
+		stats.record("shared_cache_oversize", len(data), base = 1024)
+		log.warn("shared_cache", "sid %s snapshot is %s bytes, more than shared_cache_size allows." % (sid, len(data)))
+		return False
+	sequence = _SEQUENCE.unpack_from(region, 0)[0]
+	# A writer that died mid-write leaves it odd
+	if sequence % 2:
+		sequence += 1
+	_SEQUENCE.pack_into(region, 0, sequence + 1)
+	region[_HEADER.size:_HEADER.size + len(data)] = data
+	_HEADER.pack_into(region, 0, sequence + 1, len(data))
+	_SEQUENCE.pack_into(region, 0, sequence + 2)
+	return True
+
+def get_version(sid):
+	region = _get_reader(sid)
+	if not region:
+		return 0
+	return _SEQUENCE.unpack_from(region, 0)[0]
+
+def read(sid):
+	"""
+	Returns the latest station key -> value snapshot, or None if there isn't one
+	or the writer held it for too long.
+	"""
+	region = _get_reader(sid)
+	if not region:
+		return None
+	for attempt in range(0, _READ_ATTEMPTS):
+		sequence, length = _HEADER.unpack_from(region, 0)
+		if sequence == 0:
+			return None
+		if sid in _snapshots and _snapshots[sid][0] == sequence:
+			return _snapshots[sid][1]
+		if sequence % 2:
+			continue
+		data = region[_HEADER.size:_HEADER.size + length]
+		if _SEQUENCE.unpack_from(region, 0)[0] == sequence:
+			_snapshots[sid] = (sequence, pickle.loads(data))
+			return _snapshots[sid][1]
+	stats.record("shared_cache_read_retries_exhausted", 1, base = 1)
+	return None
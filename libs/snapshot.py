@@ -0,0 +1,45 @@
+import os
+import cPickle as pickle
+
+from libs import log
+from libs import config
+
+# Small pickled snapshots of in-memory state, kept on local disk so a process
+# can come back up without rebuilding that state from the DB.
+
+def get_path(name):
+	return "%s/%s.snapshot" % (config.get("snapshot_dir"), name)
+
+def save(name, obj):
+	"""
+	Writes to a temporary file and renames it over the old snapshot, so a
+	reader (or a crash) never sees a half-written file.
+	"""
+	path = get_path(name)
+	temp_path = "%s.%s.tmp" % (path, os.getpid())
+	try:
+		f = open(temp_path, "wb")
+		pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+		f.flush()
+		os.fsync(f.fileno())
+		f.close()
+		os.rename(temp_path, path)
+		return True
+	except Exception as e:
+		log.exception("snapshot", "Could not save snapshot %s." % path, e)
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+		return False
+
+def load(name):
+	path = get_path(name)
+	if not os.path.exists(path):
+		return None
+	try:
+		f = open(path, "rb")
+		obj = pickle.load(f)
+		f.close()
+		return obj
+	except Exception as e:
+		log.exception("snapshot", "Could not load snapshot %s." % path, e)
+		return None
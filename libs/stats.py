@@ -0,0 +1,120 @@
+import time
+import threading
+
+# In-process timing and size metrics.  Each named series keeps a count, total,
+# maximum and a log-scale histogram, so percentiles can be estimated without
+# holding on to every sample.
+
+_NUM_BUCKETS = 24
+
+_series = {}
+_lock = threading.Lock()
+# name -> seconds spent in it so far, see Timed
+_timers = {}
+
+class Histogram(object):
+	def __init__(self, base = 0.001):
+		# Bucket i holds values up to base * 2^i, the last bucket catches everything else
+		self.base = base
+		self.count = 0
+		self.total = 0
+		self.max = 0
+		self.buckets = [0] * (_NUM_BUCKETS + 1)
+
+	def record(self, value):
+		self.count += 1
+		self.total += value
+		if value > self.max:
+			self.max = value
+		i = 0
+		limit = self.base
+		while i < _NUM_BUCKETS and value > limit:
+			i += 1
+			limit *= 2
+		self.buckets[i] += 1
+
+	def percentile(self, pct):
+		if self.count == 0:
+			return 0
+		target = self.count * pct / 100.0
+		seen = 0
+		for i in range(0, _NUM_BUCKETS):
+			seen += self.buckets[i]
+			if seen >= target:
+				return min(self.base * (2 ** i), self.max)
+		return self.max
+
+	def to_dict(self):
+		avg = 0
+		if self.count:
+			avg = float(self.total) / self.count
+		return { "count": self.count, "total": self.total, "avg": avg, "max": self.max,
+			"p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99) }
+
+def record(name, value, base = 0.001):
+	_lock.acquire()
+	try:
+		if not name in _series:
+			_series[name] = Histogram(base)
+		_series[name].record(value)
+	finally:
+		_lock.release()
+
+def get(name):
+	if name in _series:
+		return _series[name]
+	return None
+
+def reset():
+	_lock.acquire()
+	try:
+		_series.clear()
+	finally:
+		_lock.release()
+
+def to_dict(prefix = None):
+	_lock.acquire()
+	try:
+		d = {}
+		for name, histogram in _series.iteritems():
+			if not prefix or name.startswith(prefix):
+				d[name] = histogram.to_dict()
+		return d
+	finally:
+		_lock.release()
+
+def add_time(name, seconds):
+	_lock.acquire()
+	try:
+		_timers[name] = _timers.get(name, 0) + seconds
+	finally:
+		_lock.release()
+
+def get_times():
+	_lock.acquire()
+	try:
+		return dict(_timers)
+	finally:
+		_lock.release()
+
+class Timed(object):
+	"""
+	Wraps an object (a DB cursor, a memcache client) and adds the time spent in the
+	named methods to a running timer.  Everything else passes straight through.
+	"""
+	def __init__(self, wrapped, timer, methods):
+		self.wrapped = wrapped
+		for method in methods:
+			setattr(self, method, self._time(timer, getattr(wrapped, method)))
+
+	def _time(self, timer, method):
+		def timed(*args, **kwargs):
+			started = time.time()
+			try:
+				return method(*args, **kwargs)
+			finally:
+				add_time(timer, time.time() - started)
+		return timed
+
+	def __getattr__(self, name):
+		return getattr(self.wrapped, name)
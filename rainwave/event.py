@@ -7,6 +7,7 @@ from libs import config
 from libs import cache
 from rainwave import playlist
 from rainwave import request
+from rainwave import timeline
 
 """
 These are the test scenarios I thought of that should be written that apply to this module:
@@ -93,8 +94,10 @@ class Event(object):
 		evt.dj_user_id = None
 		db.c.update("INSERT INTO r4_schedule "
 					"(sched_id, sched_start, sched_end, sched_type, sched_name, sid, sched_public, sched_timed, sched_url, sched_in_progress) VALUES "
-					"(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s",
+					"(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
 					(evt.id, evt.start, evt.end, evt.type, evt.name, evt.sid, evt.public, evt.timed, evt.url, evt.in_progress))
+		timeline.add_row(evt.sid, { "sched_id": evt.id, "sched_type": evt.type, "sched_start": evt.start, "sched_end": evt.end })
+		return evt
 
 	def __init__(self):
 		self.id = None
@@ -148,6 +151,20 @@ class Event(object):
 		
 	def get_dj_user_id(self):
 		return self.dj_user_id
+
+	def to_dict(self):
+		# Elections don't carry schedule columns like end and name, hence the getattrs
+		return {
+			"id": self.id,
+			"type": self.type,
+			"sid": self.sid,
+			"start": self.start,
+			"start_actual": getattr(self, "start_actual", None),
+			"end": getattr(self, "end", None),
+			"name": getattr(self, "name", None),
+			"in_progress": getattr(self, "in_progress", False),
+			"songs": [ song.to_dict() for song in getattr(self, "songs", []) ]
+		}
 		
 class ElectionScheduler(Event):
 	def __init__(self):
@@ -319,10 +336,13 @@ class Election(Event):
 	def _add_requests(self):
 		# ONLY RUN IS_REQUEST_NEEDED ONCE
 		if self.is_request_needed() and len(self.songs) < self._num_songs:
-			for i in range(1, self._num_requests):
-				self.add_song(self.get_request())
-			if len(self.songs) > 0:
-				request.update_all_list()
+			request.start_dispatch(self.sid)
+			try:
+				for i in range(1, self._num_requests):
+					self.add_song(self.get_request())
+			finally:
+				# Hand-outs made before a failure still get written, and the line doesn't stay mid-dispatch
+				request.finish_dispatch(self.sid)
 		
 	def is_request_needed(self):
 		global _request_interval
@@ -1,14 +1,99 @@
+import time
+
 from libs import db
+from libs import cache
 
 def get_listeners_dict(sid):
 	guests = db.c.fetch_var("SELECT COUNT(*) FROM r4_listeners WHERE sid = %s AND user_id = 1 AND listener_purge = FALSE", (sid,))
-	# SLOW QUERY
-	clist = db.fetch_all(
-		"SELECT r4_listeners.user_id, username, COUNT(vote_time) AS radio_2wkvotes "
+	clist = db.c.fetch_all(
+		"SELECT r4_listeners.user_id, username, COALESCE(vote_2wk, 0) AS radio_2wkvotes "
 		"FROM r4_listeners JOIN phpbb_users USING (user_id) "
-		"LEFT JOIN r4_vote_history ON (phpbb_users.user_id == r4_vote_history.user_id AND vote_time < %s) "
-		"WHERE r4_listeners.sid = %s AND r4_listeners.user_id > 1 "
-		"GROUP BY r4_listeners.user_id, username "
+		"LEFT JOIN r4_vote_totals ON (r4_listeners.user_id = r4_vote_totals.user_id) "
+		"WHERE r4_listeners.sid = %s AND r4_listeners.user_id > 1 AND listener_purge = FALSE "
 		"ORDER BY radio_2wkvotes DESC, username",
-		((time.time() - 1209600), sid))	# 1209600 is 2 weeks in seconds
-	return { "guests": guests, "users": clist })
+		(sid,))
+	return { "guests": guests, "users": clist or [] }
+
+def age_vote_counts(days = 14):
+	"""
+	Takes day buckets older than the window out of the per-user 2 week vote totals.
+	Returns the number of buckets aged out.
+	"""
+	oldest_day = int(time.time() / 86400) - days + 1
+	db.c.start_transaction()
+	try:
+		db.c.update("UPDATE r4_vote_totals "
+			"SET vote_2wk = vote_2wk - (SELECT SUM(vote_count) FROM r4_vote_days WHERE r4_vote_days.user_id = r4_vote_totals.user_id AND vote_day < %s) "
+			"WHERE user_id IN (SELECT user_id FROM r4_vote_days WHERE vote_day < %s)",
+			(oldest_day, oldest_day))
+		aged = db.c.update("DELETE FROM r4_vote_days WHERE vote_day < %s", (oldest_day,))
+		db.c.update("DELETE FROM r4_vote_totals WHERE vote_2wk <= 0")
+		db.c.commit()
+	except:
+		db.c.rollback()
+		raise
+	return aged
+
+def backfill_vote_counts(days = 14):
+	"""
+	Rebuilds the day buckets and 2 week totals from r4_vote_history, for databases that
+	had votes before the buckets existed or whose buckets have drifted.  Returns the
+	number of buckets written.
+	"""
+	oldest_day = int(time.time() / 86400) - days + 1
+	db.c.start_transaction()
+	try:
+		db.c.update("DELETE FROM r4_vote_days")
+		db.c.update("DELETE FROM r4_vote_totals")
+		filled = db.c.update("INSERT INTO r4_vote_days (user_id, vote_day, vote_count) "
+			"SELECT user_id, CAST(vote_time / 86400 AS INTEGER) AS vote_day, COUNT(*) FROM r4_vote_history "
+			"WHERE vote_time >= %s GROUP BY user_id, CAST(vote_time / 86400 AS INTEGER)",
+			(oldest_day * 86400,))
+		db.c.update("INSERT INTO r4_vote_totals (user_id, vote_2wk) SELECT user_id, SUM(vote_count) FROM r4_vote_days GROUP BY user_id")
+		db.c.commit()
+	except:
+		db.c.rollback()
+		raise
+	return filled
+
+def get_listener_counts(sid):
+	"""
+	Counts guests, users, and those of each that have voted, in one pass over r4_listeners.
+	"""
+	counts = db.c.fetch_row("SELECT "
+		"SUM(CASE WHEN user_id = 1 THEN 1 ELSE 0 END) AS lc_guests, "
+		"SUM(CASE WHEN user_id > 1 THEN 1 ELSE 0 END) AS lc_users, "
+		"SUM(CASE WHEN user_id = 1 AND listener_voted_entry IS NOT NULL THEN 1 ELSE 0 END) AS lc_guests_active, "
+		"SUM(CASE WHEN user_id > 1 AND listener_voted_entry IS NOT NULL THEN 1 ELSE 0 END) AS lc_users_active "
+		"FROM r4_listeners WHERE sid = %s AND listener_purge = FALSE",
+		(sid,))
+	# SUM() over no rows comes back NULL
+	for key in ("lc_guests", "lc_users", "lc_guests_active", "lc_users_active"):
+		if not counts[key]:
+			counts[key] = 0
+	return counts
+
+def count_listeners(listeners):
+	"""
+	Same counts as get_listener_counts, from listener rows already held in memory.
+	"""
+	counts = { "lc_guests": 0, "lc_users": 0, "lc_guests_active": 0, "lc_users_active": 0 }
+	for listener in listeners:
+		if listener['listener_purge']:
+			continue
+		if listener['user_id'] > 1:
+			counts['lc_users'] += 1
+			if listener['listener_voted_entry'] != None:
+				counts['lc_users_active'] += 1
+		else:
+			counts['lc_guests'] += 1
+			if listener['listener_voted_entry'] != None:
+				counts['lc_guests_active'] += 1
+	return counts
+
+def get_registry_listener_counts(sid):
+	"""
+	Counts as published by whatever keeps the in-memory listener registry,
+	or None if nothing has published any for this station.
+	"""
+	return cache.get_station(sid, "listener_counts")
@@ -552,7 +552,7 @@ class Song(object):
 		group_list = []
 		if self.albums:
 			for metadata in self.albums:
-				albums_list.append(metadata.to_dict())
+				album_list.append(metadata.to_dict())
 			self.data['albums'] = album_list
 		if self.artists:
 			for metadata in self.artists:
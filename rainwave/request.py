@@ -1,101 +1,420 @@
 import time
+import heapq
+import threading
+
 from libs import db
 from libs import cache
+from libs import config
+from backend import work_queue
 from rainwave import playlist
-from rainwave.user import User
 
-def update_cache(sid):
-	update_expire_times()
-	update_line(sid)
-	
-def update_line(sid):
-	# TODO: This needs code review
-	# Get everyone in the line
-	line = db.c.fetch_all("SELECT username, user_id, line_expiry_tune_in, line_expiry_election FROM r4_request_line JOIN phpbb_users USING (user_id) WHERE sid = %s ORDER BY line_wait_start", (sid,))
-	new_line = []
-	user_positions = {}
-	t = time.time()
-	position = 1
-	# For each person
-	for row in line:
-		add_to_line = False
-		u = User(row['user_id'])
-		row['song_id'] = None
-		# If their time is up, remove them and don't add them to the new line
-		if row['line_expiry_tune_in'] <= t:
-			u.remove_from_request_line()
-		else:
-			# refresh the user to get their data, using local cache only - speed things up here
-			u.refresh(True)
-			# If they're not tuned in and haven't been marked as expiring yet, mark them, add to line, move on
-			if not u.data['radio_tuned_in'] and not u.data['radio_tuned_in']:
-				row['line_expiry_tune_in'] = t + 600
-				add_to_line = True
-			# do nothing if they're not tuned in
-			elif not u.data['radio_tuned_in']:
-				pass
+# The request lines live here in the backend, one RequestLine per station.
+# Recomputing a line (positions, expiries, top songs) is a pass over memory;
+# anything that has to reach the DB is journaled and written in one go
+# after the pass.
+
+# RequestLine objects by sid
+_lines = {}
+# Every loaded user's request store, user_id -> list of requests in the order they get played
+_stores = {}
+# (query, params) tuples waiting to be written
+_journal = []
+# Cross-station moves touch more than one line, and each station post-processes on its own thread
+_lock = threading.RLock()
+
+class ExpiryTimer(object):
+	"""
+	Tracks the time each user's place in line expires.  A heap gives up the users whose time
+	has passed without looking at anyone else; entries superseded by set() are left in the heap
+	and skipped when they come off it.
+	"""
+	def __init__(self):
+		# user_id -> (sid, expires_at)
+		self.times = {}
+		self.heap = []
+
+	def get(self, user_id):
+		if user_id in self.times:
+			return self.times[user_id][1]
+		return None
+
+	def get_sid(self, user_id):
+		if user_id in self.times:
+			return self.times[user_id][0]
+		return None
+
+	def set(self, user_id, sid, expires_at):
+		"""
+		Returns True if that changed the user's expiry time.
+		"""
+		old = self.get(user_id)
+		if not expires_at:
+			if user_id in self.times:
+				del self.times[user_id]
+			return old != None
+		self.times[user_id] = (sid, expires_at)
+		if old != expires_at:
+			heapq.heappush(self.heap, (expires_at, user_id))
+			return True
+		return False
+
+	def pop_expired(self, t):
+		"""
+		Returns (user_id, sid) for every user whose expiry has passed since the last call.
+		"""
+		expired = []
+		while self.heap and self.heap[0][0] <= t:
+			expires_at, user_id = heapq.heappop(self.heap)
+			if self.get(user_id) == expires_at:
+				expired.append((user_id, self.times[user_id][0]))
+		return expired
+
+# When each lined-up user's tune-in or election grace runs out
+_expiry_timer = ExpiryTimer()
+
+def _wait_order(entry):
+	return (entry['line_wait_start'], entry['user_id'])
+
+class RequestLine(object):
+	def __init__(self, sid):
+		self.sid = sid
+		# user_id -> line row
+		self.entries = {}
+		# user_ids of registered users tuned in to this station
+		self.tuned_in = set()
+		# user_id -> first requestable song in their store for this station, as of the last load
+		self.top_song_ids = {}
+		# song_ids from the request stores for this station that are requestable right now, only loaded to dispatch
+		self.available = set()
+		# What gets published: line rows in order, user_id -> position (1-based), and user_id -> when their place expires
+		self.line = []
+		self.positions = {}
+		self.expiries = {}
+		# user_ids this line last published an expiry time for
+		self.expiry_user_ids = set()
+		# The line as it was last pushed to memcache, so Sync's version only moves when it changes
+		self.published_line = None
+		# (line_wait_start, user_id) of everyone who can be handed a request, only while an election is being filled
+		self.dispatch_heap = None
+
+	def load(self):
+		"""
+		Brings the line, who's tuned in and everyone's top song up to date in three queries.
+		API processes add people and requests straight to the DB, so this runs ahead of every recompute.
+		"""
+		self.entries = {}
+		for row in db.c.fetch_all("SELECT user_id, username, line_wait_start, line_expiry_tune_in, line_expiry_election, line_top_song_id FROM r4_request_line JOIN phpbb_users USING (user_id) WHERE sid = %s", (self.sid,)) or []:
+			self.entries[row['user_id']] = row
+		self.tuned_in = set(db.c.fetch_list("SELECT user_id FROM r4_listeners WHERE sid = %s AND user_id > 1 AND listener_purge = FALSE", (self.sid,)))
+		self.top_song_ids = get_top_request_song_ids(self.sid)
+		# Stores are only pulled in whole when they're needed, see load_stores
+		for user_id in self.entries:
+			if user_id in _stores:
+				del _stores[user_id]
+
+	def load_stores(self):
+		"""
+		Loads the full request store of everyone in line and which of their songs can be played,
+		for handing out requests.
+		"""
+		_load_stores(self.entries.keys(), "user_id IN (SELECT user_id FROM r4_request_line WHERE sid = %s)", (self.sid,))
+		self.available = set(db.c.fetch_list(
+			"SELECT song_id FROM r4_song_sid "
+			"WHERE sid = %s AND song_exists = TRUE AND song_cool = FALSE AND song_elec_blocked = FALSE "
+			"AND song_id IN (SELECT song_id FROM r4_request_store WHERE sid = %s)",
+			(self.sid, self.sid)))
+
+	def add(self, user_id, username, t):
+		if user_id in self.entries:
+			return
+		for line in _lines.itervalues():
+			if line != self and user_id in line.entries:
+				line.remove(user_id)
+		self.entries[user_id] = { "user_id": user_id, "username": username, "line_wait_start": t, "line_expiry_tune_in": None, "line_expiry_election": None, "line_top_song_id": None }
+		# They may still be sitting in the line of a station this process hasn't loaded
+		_journal.append(("DELETE FROM r4_request_line WHERE user_id = %s", (user_id,)))
+		_journal.append(("INSERT INTO r4_request_line (user_id, sid, line_wait_start) VALUES (%s, %s, %s)", (user_id, self.sid, t)))
+
+	def remove(self, user_id):
+		if not user_id in self.entries:
+			return
+		del self.entries[user_id]
+		_journal.append(("DELETE FROM r4_request_line WHERE user_id = %s", (user_id,)))
+
+	def _set(self, entry, column, value):
+		if entry[column] != value:
+			entry[column] = value
+			_journal.append(("UPDATE r4_request_line SET " + column + " = %s WHERE user_id = %s", (value, entry['user_id'])))
+
+	def get_top_song_id(self, user_id):
+		for request in _stores.get(user_id, []):
+			if request['sid'] == self.sid and request['song_id'] in self.available:
+				return request['song_id']
+		return None
+
+	def recompute(self, t):
+		"""
+		Works out who's in line, in what order, and with which song.  Only touches the DB to
+		load the store of somebody being bumped to another station's line.
+		"""
+		line = []
+		positions = {}
+		for entry in sorted(self.entries.values(), key=_wait_order):
+			user_id = entry['user_id']
+			entry['song_id'] = None
+			# If their time is up, remove them and don't add them to the new line
+			if entry['line_expiry_tune_in'] and entry['line_expiry_tune_in'] <= t:
+				self.remove(user_id)
+				continue
+			if not user_id in self.tuned_in:
+				# If they haven't been marked as expiring yet, mark them and keep their place for now
+				if not entry['line_expiry_tune_in']:
+					self._set(entry, "line_expiry_tune_in", t + 600)
+				# Otherwise they're out of the published line until they come back
+				else:
+					continue
 			else:
-				# Get their top song ID
-				song_id = u.get_top_request_song_id(sid)
+				self._set(entry, "line_expiry_tune_in", None)
+				song_id = self.top_song_ids.get(user_id)
 				# If they have no song and their line expiry has arrived, boot 'em
-				if not song_id and (row['line_expiry_election'] <= t):
-					u.remove_from_request_line()
+				if not song_id and entry['line_expiry_election'] and entry['line_expiry_election'] <= t:
+					self.remove(user_id)
 					# Give them a second chance if they still have requests, this is SID-indiscriminate
 					# they'll get added to whatever line is their top request
-					if u.has_requests():
-						u.put_in_request_line(u.get_top_request_sid())
+					top_sid = get_top_request_sid(user_id)
+					if top_sid:
+						get_line(top_sid).add(user_id, entry['username'], t)
+					continue
 				# If they have no song, start the expiry countdown
 				elif not song_id:
-					row['line_expiry_election'] = t + 600
-					add_to_line = True
-				# Keep 'em in line
+					if not entry['line_expiry_election']:
+						self._set(entry, "line_expiry_election", t + 600)
 				else:
-					row['song_id'] = song_id
-					add_to_line = True
-		if add_to_line:
-			new_line.append(row)
-			user_positions[u.id] = position
-			position = position + 1
-	
-	cache.set_station(sid, "request_line", new_line)
-	cache.set_station(sid, "request_user_positions", user_positions)
-
-def update_expire_times():
-	expiries = db.c.fetch_all("SELECT * FROM r4_request_line")
-	expiry_times = {}
-	for row in expiries:
-		expiry_times[row['user_id']] = None
-		if not row['line_expiry_tune_in'] and not row['line_expiry_election']:
-			pass
-		elif row['line_expiry_tune_in'] and not row['line_expiry_election']:
-			expiry_times[row['user_id']] = row['line_expiry_tune_in']
-		elif row['line_expiry_election'] and not row['line_expiry_tune_in']:
-			expiry_times[row['user_id']] = row['line_expiry_election']
-		elif row['line_expiry_election'] <= row['line_expiry_tune_in']:
-			expiry_times[row['user_id']] = row['line_expiry_election']
-		else:
-			expiry_times[row['user_id']] = row['line_expiry_tune_in']
-	cache.set("request_expire_times", expiry_times)
+					self._set(entry, "line_expiry_election", None)
+				self._set(entry, "line_top_song_id", song_id)
+				entry['song_id'] = song_id
+			line.append(dict(entry))
+			positions[user_id] = len(line)
+		self.line = line
+		self.positions = positions
+
+	def start_dispatch(self):
+		self.dispatch_heap = [ (entry['line_wait_start'], entry['user_id']) for entry in self.line if entry['song_id'] ]
+		heapq.heapify(self.dispatch_heap)
+
+	def pop_next(self):
+		"""
+		Returns (user_id, song_id) for whoever has waited longest and still has a song that can be played,
+		or (None, None).  People whose songs all went unavailable are passed over for the rest of this election.
+		"""
+		while self.dispatch_heap:
+			wait_start, user_id = heapq.heappop(self.dispatch_heap)
+			if not user_id in self.entries:
+				continue
+			song_id = self.get_top_song_id(user_id)
+			if song_id:
+				return (user_id, song_id)
+		return (None, None)
+
+	def fulfill(self, user_id, song_id):
+		store = _stores.get(user_id, [])
+		for request in store:
+			if request['song_id'] == song_id and request['sid'] == self.sid:
+				store.remove(request)
+				break
+		_journal.append(("DELETE FROM r4_request_store WHERE user_id = %s AND song_id = %s AND sid = %s", (user_id, song_id, self.sid)))
+		# It's about to be in an election, so nobody else can have it
+		self.available.discard(song_id)
+		username = self.entries[user_id]['username']
+		self.remove(user_id)
+		# Back of the line for whatever station their next request is on
+		top_sid = get_top_request_sid(user_id)
+		if top_sid:
+			get_line(top_sid).add(user_id, username, time.time())
+
+def _load_stores(user_ids, where, params):
+	"""
+	Replaces the request stores of user_ids, picked out in SQL by the where clause, with one query.
+	"""
+	stores = {}
+	for row in db.c.fetch_all("SELECT reqstor_id, reqstor_order, user_id, song_id, sid FROM r4_request_store WHERE " + where + " ORDER BY reqstor_order, reqstor_id", params) or []:
+		if not row['user_id'] in stores:
+			stores[row['user_id']] = []
+		stores[row['user_id']].append(row)
+	for user_id in user_ids:
+		_stores[user_id] = stores.get(user_id, [])
+
+def get_top_request_song_ids(sid):
+	"""
+	Returns user_id -> the first song that can be played from their requests,
+	for everyone in the station's line that has one, in one query.
+	"""
+	query = ("FROM r4_request_line "
+		"JOIN r4_request_store ON (r4_request_line.user_id = r4_request_store.user_id AND r4_request_line.sid = r4_request_store.sid) "
+		"JOIN r4_song_sid ON (r4_request_store.song_id = r4_song_sid.song_id AND r4_request_store.sid = r4_song_sid.sid) "
+		"WHERE r4_request_line.sid = %s AND song_exists = TRUE AND song_cool = FALSE AND song_elec_blocked = FALSE ")
+	top_song_ids = {}
+	if config.get("db_type") == "postgres":
+		for row in db.c.fetch_all("SELECT DISTINCT ON (r4_request_line.user_id) r4_request_line.user_id, r4_request_store.song_id " + query + "ORDER BY r4_request_line.user_id, reqstor_order, reqstor_id", (sid,)) or []:
+			top_song_ids[row['user_id']] = row['song_id']
+	else:
+		# SQLite has no DISTINCT ON, so take the first row per user from the ordered result
+		for row in db.c.fetch_all("SELECT r4_request_line.user_id AS user_id, r4_request_store.song_id AS song_id " + query + "ORDER BY r4_request_line.user_id, reqstor_order, reqstor_id", (sid,)) or []:
+			if not row['user_id'] in top_song_ids:
+				top_song_ids[row['user_id']] = row['song_id']
+	return top_song_ids
+
+def get_top_request_sid(user_id):
+	if not user_id in _stores:
+		_load_stores([ user_id ], "user_id = %s", (user_id,))
+	if len(_stores[user_id]) > 0:
+		return _stores[user_id][0]['sid']
+	return None
+
+def get_line(sid):
+	if not sid in _lines:
+		_lines[sid] = RequestLine(sid)
+	return _lines[sid]
+
+def flush_journal():
+	global _journal
+	if len(_journal) == 0:
+		return 0
+	journal = _journal
+	_journal = []
+	db.c.start_transaction()
+	try:
+		for query, params in journal:
+			db.c.update(query, params)
+		db.c.commit()
+	except:
+		db.c.rollback()
+		raise
+	_evict_stores()
+	return len(journal)
+
+def _evict_stores():
+	# Anyone who's left every line has had their store written out by now and doesn't need it in memory
+	in_line = set()
+	for line in _lines.itervalues():
+		in_line.update(line.entries.keys())
+	for user_id in _stores.keys():
+		if not user_id in in_line:
+			del _stores[user_id]
+
+def update_cache(sid):
+	update_line(sid)
+
+def _refresh_line(sid, t):
+	line = get_line(sid)
+	line.load()
+	line.recompute(t)
+	return line
+
+def _start_dispatch(sid):
+	line = _refresh_line(sid, time.time())
+	line.load_stores()
+	line.start_dispatch()
+
+def _get_expiry(entry):
+	if entry['line_expiry_tune_in'] and entry['line_expiry_election']:
+		return min(entry['line_expiry_tune_in'], entry['line_expiry_election'])
+	elif entry['line_expiry_tune_in']:
+		return entry['line_expiry_tune_in']
+	return entry['line_expiry_election']
+
+def _update_expiries(line):
+	"""
+	Hands the line's expiry times to the timer and keeps them to be published with the line.
+	Returns user_id -> new expiry time for the users whose time changed, None where it was cleared.
+	"""
+	user_ids = set(line.entries.keys())
+	changed = {}
+	for user_id in user_ids:
+		expires_at = _get_expiry(line.entries[user_id])
+		# The timer is shared between lines, so someone who just moved here may not change it
+		if _expiry_timer.set(user_id, line.sid, expires_at) or line.expiries.get(user_id) != expires_at:
+			changed[user_id] = expires_at
+	for user_id in line.expiry_user_ids - user_ids:
+		# Leave alone anyone who's moved on to another station's line since
+		if _expiry_timer.get_sid(user_id) == line.sid:
+			_expiry_timer.set(user_id, line.sid, None)
+		if user_id in line.expiries:
+			changed[user_id] = None
+	line.expiry_user_ids = user_ids
+	for user_id, expires_at in changed.iteritems():
+		if expires_at:
+			line.expiries[user_id] = expires_at
+		elif user_id in line.expiries:
+			del line.expiries[user_id]
+	return changed
+
+def update_line(sid):
+	t = time.time()
+	_lock.acquire()
+	try:
+		lines = [ _refresh_line(sid, t) ]
+		# Other stations with somebody whose time ran out get recomputed from what's already in memory
+		for expired_sid in set([ expired[1] for expired in _expiry_timer.pop_expired(t) ]):
+			if expired_sid != sid:
+				get_line(expired_sid).recompute(t)
+				lines.append(get_line(expired_sid))
+		flush_journal()
+		expiries_changed = []
+		for line in lines:
+			if _update_expiries(line):
+				expiries_changed.append(line.sid)
+	finally:
+		_lock.release()
+	for line in lines:
+		cache.set_station(line.sid, "request_line", line.line)
+		cache.set_station(line.sid, "request_user_positions", line.positions)
+		if line.sid in expiries_changed:
+			cache.set_station(line.sid, "request_expiries", dict(line.expiries))
+		if line.line != line.published_line:
+			if line.sid == sid:
+				cache.bump_sync_versions(sid, [ "requests_all" ])
+			else:
+				# Only a station's own worker may bump its versions, see cache.bump_sync_versions
+				work_queue.add(line.sid, "bump_sync_versions", cache.bump_sync_versions, line.sid, [ "requests_all" ])
+			line.published_line = line.line
+
+def start_dispatch(sid):
+	"""
+	Gets a station's line ready to hand out requests for one election.
+	"""
+	_lock.acquire()
+	try:
+		_start_dispatch(sid)
+	finally:
+		_lock.release()
 
 def get_next(sid):
-	# TODO: Code review
-	line = cache.get_station(sid, "request_line")
-	song = None
-	for pos in range(0, len(line)):
-		if not line['song_id']:
-			pass
-		else:
-			entry = line.pop(pos)
-			song = playlist.Song.load_from_id(entry['song_id'], sid)
-			song.data['elec_request_user_id'] = entry['user_id']
-			song.data['elec_request_username'] = entry['username']
-			
-			db.c.update("DELETE FROM r4_request_store WHERE user_id = %s AND song_id = %s", (u.id, request['song_id']))
-			u = User(entry['user_id'])
-			u.remove_from_request_line()
-			if u.has_requests():
-				u.put_in_request_line(u.get_top_request_sid())
-			cache.set_station(sid, "request_line", line)
-			break
+	_lock.acquire()
+	try:
+		line = get_line(sid)
+		if line.dispatch_heap == None:
+			_start_dispatch(sid)
+		user_id, song_id = line.pop_next()
+		if not user_id:
+			return None
+		username = line.entries[user_id]['username']
+		line.fulfill(user_id, song_id)
+	finally:
+		_lock.release()
 
+	song = playlist.Song.load_from_id(song_id, sid)
+	song.data['elec_request_user_id'] = user_id
+	song.data['elec_request_username'] = username
 	return song
+
+def finish_dispatch(sid):
+	"""
+	Writes everything the election's requests changed in one transaction.
+	"""
+	_lock.acquire()
+	try:
+		get_line(sid).dispatch_heap = None
+		flush_journal()
+	finally:
+		_lock.release()
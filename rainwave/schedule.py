@@ -1,60 +1,141 @@
 import time
+import collections
 
 from backend import sync_to_front
 from rainwave import event
 from rainwave import playlist
 from rainwave import listeners
 from rainwave import request
-from rainwave import user
+from rainwave import timeline
 from libs import db
+from libs import log
 from libs import config
 from libs import cache
+from libs import snapshot
+from libs import shared_cache
 
 # TODO: This enture module needs to have its unit tests written
 
 # Events for each station
 current = {}
 next = {}
+# Recently played songs, newest first, in a fixed-size ring buffer (collections.deque with maxlen)
 history = {}
+# Events that have been advanced past but haven't had their finishing work done yet
+_finishing = {}
+# Stations restored from a snapshot that haven't been checked against the DB yet
+_restored = set()
+
+# Bump this whenever what goes into a schedule snapshot changes, older snapshots will be ignored
+_SNAPSHOT_VERSION = 1
 
 class ScheduleIsEmpty(Exception):
 	pass
 
 def load():
 	for sid in config.station_ids:
+		timeline.refresh(sid)
+		# A snapshot from our last run gets us going in milliseconds, reconcile() checks it against the DB later
+		if _restore_snapshot(sid):
+			_restored.add(sid)
+		else:
+			_load_station(sid)
+
+def _load_station(sid, from_cache = True):
+	"""
+	from_cache = False skips memcache and loads everything from the DB, for when
+	memcache could be holding the same bad state we're trying to get away from.
+	"""
+	current[sid] = None
+	if from_cache:
 		current[sid] = cache.get_station(sid, "sched_current")
-		# If our cache is empty, pull from the DB
-		if not current[sid]:
-			try:
-				current[sid] = get_event_in_progress(sid)
-			except ElectionDoesNotExist:
-				current[sid] = event.Election(sid)
-		if not current[sid]:
-			raise ScheduleIsEmpty("Could not load or create any election for a current event.")
-			
-		next[sid] = cache.get_station(sid, "sched_next")
-		if not next[sid]:
-			future_time = time.time() + current[sid].get_length()
-			next_elecs = event.Election.load_unused(sid)
-			next_event = True
-			next[sid] = []
-			while len(next) < 2 and next_event:
-				next_event = get_event_at_time(sid, future_time)
-				if not next_event:
-					if length(next_elecs) > 0:
-						next_event = next_elecs.pop(0)
-					else:
-						next_event = event.Election.create(sid)
-				if next_event:
-					future_time += next_event.get_length()
-					next.append(next_event)
+	# If our cache is empty, pull from the DB
+	if not current[sid]:
+		try:
+			current[sid] = get_event_in_progress(sid)
+		except event.ElectionDoesNotExist:
+			current[sid] = event.Election(sid)
+	if not current[sid]:
+		raise ScheduleIsEmpty("Could not load or create any election for a current event.")
 		
-		history[sid] = cache.get_station(sid, "sched_history")
-		if not history[sid]:
-			history[sid] = []
-			song_ids = db.c.fetch_list("SELECT song_id FROM r4_song_history WHERE sid = %s ORDER BY songhist_id DESC")
-			for id in song_ids:
-				history[sid].append(playlist.Song.load_by_id(id, sid))
+	next[sid] = None
+	if from_cache:
+		next[sid] = cache.get_station(sid, "sched_next")
+	if not next[sid]:
+		future_time = time.time() + current[sid].length()
+		next_elecs = event.Election.load_unused(sid)
+		next_event = True
+		next[sid] = []
+		while len(next[sid]) < 2 and next_event:
+			next_event = get_event_at_time(sid, future_time)
+			if not next_event:
+				if len(next_elecs) > 0:
+					next_event = next_elecs.pop(0)
+				else:
+					next_event = event.Election.create(sid)
+			if next_event:
+				future_time += next_event.length()
+				next[sid].append(next_event)
+	
+	history[sid] = _load_history(sid, from_cache)
+
+def _load_history(sid, from_cache = True):
+	songs = None
+	if from_cache:
+		songs = cache.get_station(sid, "sched_history")
+	if not songs:
+		songs = []
+		song_ids = db.c.fetch_list("SELECT song_id FROM r4_song_history WHERE sid = %s ORDER BY songhist_id DESC LIMIT %s", (sid, config.get("history_length")))
+		for id in song_ids:
+			songs.append(playlist.Song.load_from_id(id, sid))
+	return collections.deque(songs, config.get("history_length"))
+
+def _save_snapshot(sid):
+	snapshot.save("schedule_sid%s" % sid, {
+		"version": _SNAPSHOT_VERSION,
+		"saved_at": time.time(),
+		"current": current[sid],
+		"next": next[sid],
+		"history": list(history[sid])
+	})
+
+def _restore_snapshot(sid):
+	state = snapshot.load("schedule_sid%s" % sid)
+	if not state or state.get("version") != _SNAPSHOT_VERSION:
+		return False
+	current[sid] = state['current']
+	next[sid] = state['next']
+	history[sid] = collections.deque(state['history'], config.get("history_length"))
+	return True
+
+def reconcile(sid):
+	"""
+	Checks a station restored from a snapshot against the DB.  If the snapshot
+	is out of step (e.g. we died between an advance and its post-processing)
+	the station gets reloaded the slow way.
+	"""
+	if not sid in _restored:
+		return True
+	_restored.discard(sid)
+	in_step = _event_in_db_state(current[sid], True)
+	for evt in next[sid]:
+		in_step = in_step and _event_in_db_state(evt, False)
+	if not in_step:
+		log.warn("schedule", "Snapshot for station %s doesn't match the DB, reloading." % sid)
+		# Memcache was written from the same state the snapshot was, so it can't be trusted either
+		_load_station(sid, from_cache = False)
+		cache.set_station(sid, "sched_current", current[sid])
+		cache.set_station(sid, "sched_next", next[sid])
+		cache.set_station(sid, "sched_history", list(history[sid]))
+		cache.bump_sync_versions(sid, [ "sched_current", "sched_next", "sched_history" ])
+	return in_step
+
+def _event_in_db_state(evt, in_progress):
+	if getattr(evt, "is_election", False):
+		row = db.c.fetch_row("SELECT elec_in_progress AS in_progress, elec_used AS used FROM r4_elections WHERE elec_id = %s", (evt.id,))
+	else:
+		row = db.c.fetch_row("SELECT sched_in_progress AS in_progress, sched_used AS used FROM r4_schedule WHERE sched_id = %s", (evt.id,))
+	return row != None and bool(row['in_progress']) == in_progress and not row['used']
 		
 def get_event_in_progress(sid):
 	in_progress = db.c.fetch_row("SELECT sched_id, sched_type FROM r4_schedule WHERE sid = %s AND sched_in_progress = TRUE ORDER BY sched_start DESC LIMIT 1", (sid,))
@@ -64,63 +145,86 @@ def get_event_in_progress(sid):
 		return get_event_at_time(sid, time.time())
 		
 def get_event_at_time(sid, epoch_time):
-	at_time = db.c.fetch_row("SELECT sched_id, sched_type FROM r4_schedule WHERE sid = %s AND sched_start <= %s AND sched_end > %s ORDER BY (%s - sched_start) LIMIT 1", (sid, epoch_time, epoch_time))
+	if timeline.get(sid).covers(epoch_time):
+		at_time = timeline.get_row_at_time(sid, epoch_time)
+	else:
+		at_time = db.c.fetch_row("SELECT sched_id, sched_type FROM r4_schedule WHERE sid = %s AND sched_start <= %s AND sched_end > %s ORDER BY (%s - sched_start) LIMIT 1", (sid, epoch_time, epoch_time, epoch_time))
 	if at_time:
 		return event.load_by_id_and_type(at_time['sched_id'], at_time['sched_type'])
 	elif epoch_time >= time.time():
 		return None
 	else:
 		# We add 5 seconds here in order to make up for any crossfading and buffering times that can screw up the radio timing
-		elec_id = db.c.fetch_var("SELECT elec_id FROM r4_elections WHERE r4_elections.sid = %s AND elec_played_at <= %s ORDER BY elec_played_at DESC LIMIT 1", (sid, epoch_time - 5))
+		elec_id = db.c.fetch_var("SELECT elec_id FROM r4_elections WHERE r4_elections.sid = %s AND elec_start_actual <= %s ORDER BY elec_start_actual DESC LIMIT 1", (sid, epoch_time - 5))
 		if elec_id:
-			return event.Election.load_by_id(load_by_id_and_type(at_time['sched_id'], at_time['sched_type'])
+			return event.Election.load_by_id(elec_id)
 		else:
 			return None
 
 def get_current_file(sid):
 	return current[sid].get_filename()
 
+def is_prepared(sid):
+	return sid in next and len(next[sid]) > 0
+
 def advance_station(sid):
-	playlist.prepare_cooldown_algorithm(sid)
-	playlist.clear_updated_albums(sid)
-	
+	# Liquidsoap is waiting on us here, so only the bare minimum happens: swap in the
+	# already-prepared next event and hand back its filename.  Finishing the old event
+	# and everything else waits for post_process.
+
 	# TODO LATER: Make sure we can "pause" the station here to handle DJ interruptions
 	# Requires controlling the streamer itself to some degree and will take more
 	# work on the API than the back-end.
 
-	current[sid].finish()
-	
-	last_song = current[sid].get_song()
-	history.insert(0, last_song)
-	db.c.update("INSERT INTO r4_song_history (sid, song_id) VALUES (%s, %s)", (sid, last_song.id))
-	
-	current[sid] = next.pop(0)
+	if not sid in _finishing:
+		_finishing[sid] = []
+	_finishing[sid].append(current[sid])
+	current[sid] = next[sid].pop(0)
 	current[sid].start_event()
+	return current[sid].get_filename()
 
 def post_process(sid):
+	playlist.prepare_cooldown_algorithm(sid)
+	playlist.clear_updated_albums(sid)
+	_finish_events(sid)
+
 	_create_elections(sid)
-	_update_memcache(sid)
+	station = _update_memcache(sid)
 	
 	if not config.test_mode:
-		sync_to_front.sync_frontend_all(sid)
+		sync_to_front.sync_frontend_all(sid, station)
 		
 	_add_listener_count_record(sid)
 	cache.update_user_rating_acl(sid, current[sid].get_song().id)
-	_trim(sid)
-	user.trim_listeners(sid)
+	_save_snapshot(sid)
+
+def _finish_events(sid):
+	if not sid in _finishing:
+		return
+	while len(_finishing[sid]) > 0:
+		finished = _finishing[sid].pop(0)
+		finished.finish()
+		last_song = finished.get_song()
+		history[sid].appendleft(last_song)
+		db.c.update("INSERT INTO r4_song_history (sid, song_id) VALUES (%s, %s)", (sid, last_song.id))
 	
 def _add_listener_count_record(sid):
-	lc_guests = db.c.fetch_var("SELECT COUNT(*) FROM r4_listeners WHERE sid = %s AND listener_purge = FALSE AND user_id = 1", (sid,))
-	lc_users = db.c.fetch_var("SELECT COUNT(*) FROM r4_listeners WHERE sid = %s AND listener_purge = FALSE AND user_id > 1", (sid,))
-	lc_guests_active = db.c.fetch_var("SELECT COUNT(*) FROM r4_listeners WHERE sid = %s AND listener_purge = FALSE AND user_id = 1 AND listener_voted_entry IS NOT NULL", (sid,))
-	lc_users_active = db.c.fetch_var("SELECT COUNT(*) FROM r4_listeners WHERE sid = %s AND listener_purge = FALSE AND user_id > 1 AND listener_voted_entry IS NOT NULL", (sid,))
-	return db.c.update("INSERT INTO r4_listener_counts (sid, lc_guests, lc_users, lc_guests_active, lc_users_active) VALUES (%s, %s, %s, %s, %s)", (sid, lc_guests, lc_users, lc_guests_active, lc_users_active))
+	counts = None
+	if config.get("listener_counts_from_registry"):
+		counts = listeners.get_registry_listener_counts(sid)
+	if not counts:
+		counts = listeners.get_listener_counts(sid)
+	return db.c.update("INSERT INTO r4_listener_counts (sid, lc_guests, lc_users, lc_guests_active, lc_users_active) VALUES (%s, %s, %s, %s, %s)", (sid, counts['lc_guests'], counts['lc_users'], counts['lc_guests_active'], counts['lc_users_active']))
 	
 def _create_elections(sid):
 	# Step, er, 0: Update the request cache first, so elections have the most recent data to work with
 	# (the entire requests module depends on its caches)
 	request.update_cache(sid)
 
+	# Step 0.5: Rows may have been added to the schedule by other processes, so refresh our timeline
+	# once here - every get_event_at_time call made while walking forward below is then memory-only
+	timeline.refresh(sid)
+
 	# Step 1: See if any new events are in the schedule that apply to this station, that haven't been used, and aren't in our next list
 	max_sched_id = 0
 	max_elec_id = 0
@@ -215,28 +319,37 @@ def _create_elections(sid):
 		running_time += next_elec.length()
 		next[sid].append(next_elec)
 	
-def _create_election(sid, start_time = None, target_length = None)
+def _create_election(sid, start_time = None, target_length = None):
+	if not start_time:
+		start_time = time.time()
 	# Check to see if there are any events during this time
-	elec_scheduler = get_event_at_time(start_time)
+	elec_scheduler = get_event_at_time(sid, start_time)
 	# If there are, and it makes elections (e.g. PVP Hours), get it from there
 	if elec_scheduler and elec_scheduler.produces_elections:
-		elec_scheduler.create_election(sid)
+		elec = elec_scheduler.create_election(sid)
 	else:
-		elec = Event.Election.create(sid)
+		elec = event.Election.create(sid)
 	elec.fill(target_length)
 	return elec
 
-def _trim(sid):
-	# Deletes any events in the schedule and elections tables that are old, according to the config
-	db.c.update("DELETE FROM r4_schedule WHERE sched_start_actual <= %s", (time.time() - config.get("trim_event_age")))
-	db.c.update("DELETE FROM r4_elections WHERE elec_start_actual <= %s", (time.time() - config.get("trim_election_age")))
-	max_history_id = db.c.fetch_var("SELECT MAX(songhist_id) FROM r4_song_history")
-	db.c.update("DELETE FROM r4_song_history WHERE songhist_id <= %s", (max_history_id - config.get("trim_history_length")))
-	
 def _update_memcache(sid):
-	cache.set_station(sid, "sched_current", current[sid])
-	cache.set_station(sid, "sched_next", next[sid])
-	cache.set_station(sid, "sched_history", history[sid])
-	cache.prime_rating_cache_for_events([ sched_current[sid] ] + sched_next[sid] + sched_history[sid])	
-	cache.set_station(sid, "current_listeners", listeners.get_listeners_dict())
-	cache.set_station(sid, "album_diff", playlist.get_updated_albums_dict(sid))
+	"""
+	Publishes the station to memcache and returns what was published, station key -> value.
+	"""
+	station = {
+		"sched_current": current[sid],
+		"sched_next": next[sid],
+		"sched_history": list(history[sid]),
+		"listeners_current": listeners.get_listeners_dict(sid),
+		"album_diff": playlist.get_updated_albums_dict(sid)
+	}
+	cache.prime_rating_cache_for_events([ current[sid] ] + next[sid] + list(history[sid]))
+	changed = [ "sched_current", "sched_next", "sched_history", "album_diff" ]
+	if station['listeners_current'] != cache.get_station(sid, "listeners_current"):
+		changed.append("listeners_current")
+	for key, value in station.iteritems():
+		cache.set_station(sid, key, value)
+	station['sync_versions'] = cache.bump_sync_versions(sid, changed)
+	if config.get("shared_cache_dir"):
+		shared_cache.publish(sid, station)
+	return station
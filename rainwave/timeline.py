@@ -0,0 +1,109 @@
+import bisect
+import time
+
+from libs import db
+
+# In-memory timelines of upcoming r4_schedule rows, one per station.
+# Walking forward through time (schedule.load, election creation) used to cost
+# a query per step - these answer the same questions with a binary search.
+
+_timelines = {}
+
+class Timeline(object):
+	def __init__(self, sid):
+		self.sid = sid
+		# Anything ending before the floor isn't held here, lookups before it must go to the DB
+		self.floor = None
+		self._rows = []
+		self._starts = []
+		# _max_ends[i] is the latest sched_end of rows 0..i, so it never decreases.
+		# This lets us stop walking backwards as soon as nothing earlier can overlap.
+		self._max_ends = []
+
+	def load(self, floor = None):
+		if floor == None:
+			floor = time.time()
+		rows = db.c.fetch_all("SELECT sched_id, sched_type, sched_start, sched_end FROM r4_schedule WHERE sid = %s AND sched_end > %s ORDER BY sched_start, sched_id", (self.sid, floor))
+		self.floor = floor
+		self._rows = []
+		self._starts = []
+		if rows:
+			for row in rows:
+				self._rows.append(row)
+				self._starts.append(row['sched_start'])
+		self._rebuild_max_ends(0)
+
+	def _rebuild_max_ends(self, from_index):
+		del self._max_ends[from_index:]
+		max_end = None
+		if from_index > 0:
+			max_end = self._max_ends[from_index - 1]
+		for row in self._rows[from_index:]:
+			if max_end == None or row['sched_end'] > max_end:
+				max_end = row['sched_end']
+			self._max_ends.append(max_end)
+
+	def covers(self, epoch_time):
+		return self.floor != None and epoch_time >= self.floor
+
+	def add(self, row):
+		self.remove(row['sched_id'])
+		i = bisect.bisect_right(self._starts, row['sched_start'])
+		self._starts.insert(i, row['sched_start'])
+		self._rows.insert(i, row)
+		self._rebuild_max_ends(i)
+
+	def remove(self, sched_id):
+		for i in range(0, len(self._rows)):
+			if self._rows[i]['sched_id'] == sched_id:
+				del self._rows[i]
+				del self._starts[i]
+				self._rebuild_max_ends(i)
+				return True
+		return False
+
+	def at(self, epoch_time):
+		"""
+		Returns the row running at epoch_time with the latest start, same as
+		"sched_start <= t AND sched_end > t ORDER BY (t - sched_start)".
+		"""
+		i = bisect.bisect_right(self._starts, epoch_time) - 1
+		while i >= 0 and self._max_ends[i] > epoch_time:
+			if self._rows[i]['sched_end'] > epoch_time:
+				return self._rows[i]
+			i -= 1
+		return None
+
+	def between(self, start, end):
+		"""
+		Returns all rows overlapping [start, end), ordered by start time.
+		"""
+		first = bisect.bisect_right(self._max_ends, start)
+		last = bisect.bisect_left(self._starts, end)
+		rows = []
+		for row in self._rows[first:last]:
+			if row['sched_end'] > start:
+				rows.append(row)
+		return rows
+
+def get(sid):
+	if not sid in _timelines:
+		_timelines[sid] = Timeline(sid)
+		_timelines[sid].load()
+	return _timelines[sid]
+
+def refresh(sid):
+	if not sid in _timelines:
+		_timelines[sid] = Timeline(sid)
+	_timelines[sid].load()
+
+def add_row(sid, row):
+	# Stations that haven't been loaded yet will pick the row up when they are
+	if sid in _timelines:
+		_timelines[sid].add(row)
+
+def get_row_at_time(sid, epoch_time):
+	return get(sid).at(epoch_time)
+
+def get_rows_between(sid, start, end):
+	return get(sid).between(start, end)
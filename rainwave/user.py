@@ -5,11 +5,28 @@ import re
 from libs import log
 from libs import cache
 from libs import db
+from libs import config
 
 _AVATAR_PATH = "/forums/download/file.php?avatar=%s"
+_API_KEY_RE = re.compile('^[\w\d]+$')
 
-def trim_listeners(sid):
-	db.c.update("DELETE FROM r4_listeners WHERE sid = %s AND listener_purge = TRUE", (sid,))
+# (user_id, api_key, ip_address) -> what a successful authorization found, so
+# clients that keep coming back (e.g. sync) don't hit r4_api_keys every time
+_auth_cache = None
+
+def _get_auth_cache():
+	global _auth_cache
+	if not _auth_cache:
+		_auth_cache = cache.TTLCache(config.get("auth_cache_size"), config.get("auth_cache_ttl"))
+	return _auth_cache
+
+def invalidate_auth(user_id, api_key = None):
+	"""
+	Forgets cached authorizations for the user, or just for one of their keys.
+	API processes call this for every user_updated they hear about, see
+	backend.sync_to_front.sync_frontend_user_id.
+	"""
+	_get_auth_cache().delete_where(lambda key: key[0] == user_id and (not api_key or key[1] == api_key))
 
 class User(object):
 	def __init__(self, user_id):
@@ -45,7 +62,7 @@ class User(object):
 		self.ip_address = ip_address
 		self.api_key = api_key
 				
-		if not bypass and not re.match('^[\w\d]+$', api_key):
+		if not bypass and not _API_KEY_RE.match(api_key):
 			return
 		
 		if self.id > 1:
@@ -56,23 +73,33 @@ class User(object):
 			self.refresh()
 
 	def _auth_registered_user(self, ip_address, api_key, bypass = False):
+		auth = None
 		if not bypass:
-			r = db.c.fetch_row("SELECT api_key, api_is_rainwave FROM r4_api_keys WHERE user_id = %s AND api_key = %s", (self.id, api_key))
-			if not r:
-				log.debug("auth", "Invalid user ID %s and/or API key %s." % (self.id, api_key))
-				return
-			if r['api_is_rainwave']:
-				self._official_ui = True
+			auth = _get_auth_cache().get((self.id, api_key, ip_address))
+		if auth:
+			self.official_ui = auth['official_ui']
+			user_data = auth['user_data']
+		else:
+			if not bypass:
+				r = db.c.fetch_row("SELECT api_key, api_is_rainwave FROM r4_api_keys WHERE user_id = %s AND api_key = %s", (self.id, api_key))
+				if not r:
+					log.debug("auth", "Invalid user ID %s and/or API key %s." % (self.id, api_key))
+					return
+				if r['api_is_rainwave']:
+					self.official_ui = True
+
+			# Pay attention to the "AS _variable" names in the SQL fields, they won't get exported to private JSONable dict
+			user_data = cache.get_user(self, "db_data")
+			if not user_data:
+				user_data = db.c.fetch_row("SELECT user_id, username, user_new_privmsg, user_avatar, user_avatar_type AS _user_avatar_type, radio_listen_key, group_id AS _group_id "
+						"FROM phpbb_users WHERE user_id = %s",
+						(self.id,))
+				cache.set_user(self, "db_data", user_data)
+			if not bypass:
+				_get_auth_cache().set((self.id, api_key, ip_address), { "official_ui": self.official_ui, "user_data": user_data })
 
 		# Set as authorized and begin populating information
-		# Pay attention to the "AS _variable" names in the SQL fields, they won't get exported to private JSONable dict
 		self.authorized = True
-		user_data = cache.get_user(self, "db_data")
-		if not user_data:
-			user_data = db.c.fetch_row("SELECT user_id, username, user_new_privmsg, user_avatar, user_avatar_type AS _user_avatar_type, radio_listen_key, group_id AS _group_id "
-					"FROM phpbb_users WHERE user_id = %s",
-					(self.id,))
-			cache.set_user(self, "db_data", user_data)
 		self.data.update(user_data)
 			
 		if self.data['_user_avatar_type'] == 1:
@@ -95,7 +122,7 @@ class User(object):
 			self.data['radio_admin'] = True
 
 	def _auth_anon_user(self, ip_address, api_key, bypass = False):
-		if not bypass:
+		if not bypass and not _get_auth_cache().get((self.id, api_key, ip_address)):
 			auth_against = db.c.fetch_var("SELECT api_key FROM r4_api_keys WHERE api_ip = %s AND user_id = 1", (ip_address,))
 			if not auth_against:
 				log.debug("user", "Anonymous user key %s not found." % api_key)
@@ -103,6 +130,7 @@ class User(object):
 			if auth_against != api_key:
 				log.debug("user", "Anonymous user key %s does not match DB key %s." % (api_key, auth_against))
 				return
+			_get_auth_cache().set((self.id, api_key, ip_address), { "official_ui": False })
 		self.authorized = True
 
 	def refresh(self, use_local_cache = False):
@@ -137,7 +165,7 @@ class User(object):
 				self.data['radio_dj'] = True
 			
 			self.data['radio_request_position'] = self.get_request_line_position(self.data['sid'])
-			self.data['radio_request_expires_at'] = self.get_request_expiry()
+			self.data['radio_request_expires_at'] = self.get_request_expiry(self.data['sid'])
 		
 			if self.data['radio_tuned_in'] and not self.is_in_request_line() and self.has_requests():
 				self.put_in_request_line(self.data['sid'])
@@ -215,8 +243,29 @@ class User(object):
 		if self.id in cache.get_local_station(sid, "request_user_positions"):
 			return cache.get_local_station(sid, "request_user_positions")[self.id]
 						
-	def get_request_expiry(self):
+	def get_request_expiry(self, sid):
 		if self.id <= 1:
 			return None
-		if self.id in cache.local['request_expire_times']:
-			return cache.local['request_expire_times'][self.id]
+		# Published with the station's request line, so this never leaves the process
+		expiries = cache.get_local_station(sid, "request_expiries")
+		if expiries:
+			return expiries.get(self.id)
+		return None
+
+	def record_vote(self, elec_id, entry_id, song_id, vote_at_rank = None, vote_at_count = None):
+		if self.id <= 1:
+			return False
+		# Keep the rolling 2 week count for listener lists up to date, see listeners.age_vote_counts
+		vote_day = int(time.time() / 86400)
+		db.c.start_transaction()
+		try:
+			db.c.update("INSERT INTO r4_vote_history (elec_id, entry_id, user_id, song_id, vote_at_rank, vote_at_count) VALUES (%s, %s, %s, %s, %s, %s)", (elec_id, entry_id, self.id, song_id, vote_at_rank, vote_at_count))
+			if db.c.update("UPDATE r4_vote_days SET vote_count = vote_count + 1 WHERE user_id = %s AND vote_day = %s", (self.id, vote_day)) == 0:
+				db.c.update("INSERT INTO r4_vote_days (user_id, vote_day, vote_count) VALUES (%s, %s, 1)", (self.id, vote_day))
+			if db.c.update("UPDATE r4_vote_totals SET vote_2wk = vote_2wk + 1 WHERE user_id = %s", (self.id,)) == 0:
+				db.c.update("INSERT INTO r4_vote_totals (user_id, vote_2wk) VALUES (%s, 1)", (self.id,))
+			db.c.commit()
+		except:
+			db.c.rollback()
+			raise
+		return True
@@ -100,21 +100,22 @@ STATION_CONFIG_TEMPLATE = """
     </mount>
 """
 
-print 'ICECAST MOUNT INFO - Paste into icecast.xml'
-print '------------------------------------------------------------'
-for s in STATIONS:
-	print STATION_CONFIG_TEMPLATE % STATIONS[s]
-print '------------------------------------------------------------'
-print
-print 'ALIAS INFO - Paste into icecast.xml, <path> section'
-print '------------------------------------------------------------'
-for s in STATIONS:
-	if STATIONS[s]['station_alias']:
-		print "      <alias source=\"/%s\" dest=\"/%s\"/>" % (STATIONS[s]['station_alias'], STATIONS[s]['station_mount'])
-print '------------------------------------------------------------'
-print 'Make sure you talk to LR and give him:'
-print '  1. The IP address of your Icecast server.'
-print '  2. The admin login to your Icecast relay.'
-print 
-print 'Make sure your Icecast config has <burst-on-connect> set to 0.'
-print 'No other special attention is required.'
+if __name__ == "__main__":
+	print 'ICECAST MOUNT INFO - Paste into icecast.xml'
+	print '------------------------------------------------------------'
+	for s in STATIONS:
+		print STATION_CONFIG_TEMPLATE % STATIONS[s]
+	print '------------------------------------------------------------'
+	print
+	print 'ALIAS INFO - Paste into icecast.xml, <path> section'
+	print '------------------------------------------------------------'
+	for s in STATIONS:
+		if STATIONS[s]['station_alias']:
+			print "      <alias source=\"/%s\" dest=\"/%s\"/>" % (STATIONS[s]['station_alias'], STATIONS[s]['station_mount'])
+	print '------------------------------------------------------------'
+	print 'Make sure you talk to LR and give him:'
+	print '  1. The IP address of your Icecast server.'
+	print '  2. The admin login to your Icecast relay.'
+	print 
+	print 'Make sure your Icecast config has <burst-on-connect> set to 0.'
+	print 'No other special attention is required.'
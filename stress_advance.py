@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+# Fires concurrent /advance/<sid> calls at a running backend and reports
+# latency percentiles, to see how stations hold up when they all change
+# songs at once.
+#
+# WARNING: this really does advance the stations.  Point it at a test backend.
+
+import argparse
+import httplib
+import threading
+import time
+
+parser = argparse.ArgumentParser(description="Rainwave backend advance stress test.")
+parser.add_argument("--host", default="localhost")
+parser.add_argument("--port", "-p", type=int, default=9999)
+parser.add_argument("--sids", "-s", default="1,2,3,4,5", help="Comma separated station IDs to advance.")
+parser.add_argument("--rounds", "-r", type=int, default=20, help="How many times to advance every station.")
+parser.add_argument("--interval", "-i", type=float, default=0.5, help="Seconds between rounds.")
+args = parser.parse_args()
+
+sids = [ int(sid) for sid in args.sids.split(",") ]
+latencies = {}
+failures = {}
+for sid in sids:
+	latencies[sid] = []
+	failures[sid] = 0
+results_lock = threading.Lock()
+
+def advance(sid, start_barrier):
+	start_barrier.wait()
+	started = time.time()
+	try:
+		conn = httplib.HTTPConnection(args.host, args.port, timeout = 60)
+		conn.request("GET", "/advance/%s" % sid)
+		response = conn.getresponse()
+		response.read()
+		ok = response.status == 200
+		conn.close()
+	except Exception:
+		ok = False
+	elapsed = time.time() - started
+	results_lock.acquire()
+	if ok:
+		latencies[sid].append(elapsed)
+	else:
+		failures[sid] += 1
+	results_lock.release()
+
+class Barrier(object):
+	# Python 2 has no threading.Barrier - releases everyone once all parties arrive
+	def __init__(self, parties):
+		self.parties = parties
+		self.count = 0
+		self.condition = threading.Condition()
+
+	def wait(self):
+		self.condition.acquire()
+		self.count += 1
+		if self.count >= self.parties:
+			self.condition.notify_all()
+		else:
+			while self.count < self.parties:
+				self.condition.wait()
+		self.condition.release()
+
+def percentile(samples, pct):
+	if not samples:
+		return 0
+	samples = sorted(samples)
+	index = int(round((len(samples) - 1) * pct / 100.0))
+	return samples[index]
+
+for i in range(0, args.rounds):
+	barrier = Barrier(len(sids))
+	threads = []
+	for sid in sids:
+		t = threading.Thread(target=advance, args=(sid, barrier))
+		t.start()
+		threads.append(t)
+	for t in threads:
+		t.join()
+	time.sleep(args.interval)
+
+print "%-6s %6s %6s %9s %9s %9s %9s" % ("sid", "ok", "fail", "p50 ms", "p95 ms", "p99 ms", "max ms")
+everything = []
+for sid in sids:
+	everything.extend(latencies[sid])
+	print "%-6s %6s %6s %9.1f %9.1f %9.1f %9.1f" % (sid, len(latencies[sid]), failures[sid],
+		percentile(latencies[sid], 50) * 1000, percentile(latencies[sid], 95) * 1000,
+		percentile(latencies[sid], 99) * 1000, percentile(latencies[sid], 100) * 1000)
+print "%-6s %6s %6s %9.1f %9.1f %9.1f %9.1f" % ("all", len(everything), sum(failures.values()),
+	percentile(everything, 50) * 1000, percentile(everything, 95) * 1000,
+	percentile(everything, 99) * 1000, percentile(everything, 100) * 1000)
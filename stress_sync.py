@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+# Parks a crowd of simulated clients on a running API process, either as
+# long-poll /api/sync requests or as /api/sync_push event streams, then
+# triggers song changes and reports how much CPU the API process spent
+# getting each one out to everybody.
+#
+# Run it on the API host: sync_update_all only answers to 127.0.0.1, and the
+# CPU figures come from /proc/<pid>/stat.  Raise the open file limit first
+# (ulimit -n) when simulating thousands of clients.
+
+import argparse
+import functools
+import os
+import time
+import urllib
+
+import tornado.ioloop
+import tornado.httpclient
+
+parser = argparse.ArgumentParser(description="Rainwave sync transport stress test.")
+parser.add_argument("--host", default="localhost")
+parser.add_argument("--port", "-p", type=int, default=20000, help="Port of the API process to test.")
+parser.add_argument("--pid", type=int, required=True, help="PID of the API process on that port.")
+parser.add_argument("--transport", "-t", choices=("longpoll", "push"), default="longpoll")
+parser.add_argument("--clients", "-c", type=int, default=10000)
+parser.add_argument("--rounds", "-r", type=int, default=10, help="How many song changes to trigger.")
+parser.add_argument("--sid", "-s", type=int, default=1)
+parser.add_argument("--user-id", type=int, default=2)
+parser.add_argument("--key", default="TESTKEY")
+parser.add_argument("--settle", type=float, default=5, help="Seconds to give clients to park before the first song change.")
+parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for every client to hear about a song change.")
+args = parser.parse_args()
+
+tornado.httpclient.AsyncHTTPClient.configure(None, max_clients = args.clients + 10)
+http_client = tornado.httpclient.AsyncHTTPClient()
+ioloop = tornado.ioloop.IOLoop.instance()
+auth = urllib.urlencode({ "sid": args.sid, "user_id": args.user_id, "key": args.key })
+base_url = "http://%s:%s/api" % (args.host, args.port)
+clock_ticks = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+
+# How many updates each client has received
+received = [ 0 ] * args.clients
+failures = [ 0 ]
+results = []
+
+def get_cpu_seconds():
+	# utime and stime, fields 14 and 15
+	fields = open("/proc/%s/stat" % args.pid).read().rsplit(")", 1)[1].split()
+	return (int(fields[11]) + int(fields[12])) / float(clock_ticks)
+
+def longpoll(client):
+	request = tornado.httpclient.HTTPRequest("%s/sync" % base_url, method = "POST", body = auth, request_timeout = 3600)
+	http_client.fetch(request, functools.partial(on_longpoll, client))
+
+def on_longpoll(client, response):
+	if response.error:
+		failures[0] += 1
+	else:
+		received[client] += 1
+	longpoll(client)
+
+def push(client):
+	request = tornado.httpclient.HTTPRequest("%s/sync_push?%s" % (base_url, auth), request_timeout = 3600,
+		streaming_callback = functools.partial(on_push_data, client))
+	http_client.fetch(request, functools.partial(on_push_closed, client))
+
+def on_push_data(client, data):
+	# Chunks can split events, but every station event starts with this line
+	received[client] += data.count("event: station\n")
+
+def on_push_closed(client, response):
+	failures[0] += 1
+	push(client)
+
+def song_change(round_num):
+	if round_num >= args.rounds:
+		ioloop.stop()
+		return
+	# Push streams get the current station as soon as they connect
+	target = round_num + 1
+	if args.transport == "push":
+		target += 1
+	cpu_started = get_cpu_seconds()
+	started = time.time()
+	http_client.fetch("%s/sync_update_all?sid=%s" % (base_url, args.sid), lambda response: None)
+
+	def check():
+		done = len([ count for count in received if count >= target ])
+		if done < args.clients and time.time() - started < args.timeout:
+			ioloop.add_timeout(time.time() + 0.05, check)
+			return
+		results.append({ "cpu": get_cpu_seconds() - cpu_started, "wall": time.time() - started, "reached": done })
+		# Let the long-poll clients re-park before the next change
+		ioloop.add_timeout(time.time() + 1, functools.partial(song_change, round_num + 1))
+	check()
+
+for client in range(0, args.clients):
+	if args.transport == "push":
+		push(client)
+	else:
+		longpoll(client)
+ioloop.add_timeout(time.time() + args.settle, functools.partial(song_change, 0))
+ioloop.start()
+
+print "%s clients over %s, %s failed or dropped connections" % (args.clients, args.transport, failures[0])
+print "%-6s %9s %9s %9s" % ("round", "cpu ms", "wall ms", "reached")
+for i, result in enumerate(results):
+	print "%-6s %9.1f %9.1f %9s" % (i + 1, result['cpu'] * 1000, result['wall'] * 1000, result['reached'])
+if results:
+	print "%-6s %9.1f %9.1f" % ("avg", sum(result['cpu'] for result in results) * 1000 / len(results),
+		sum(result['wall'] for result in results) * 1000 / len(results))
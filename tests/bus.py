@@ -0,0 +1,59 @@
+import os
+import time
+import tempfile
+import unittest
+import tornado.ioloop
+from libs import bus
+from libs import config
+from libs import stats
+
+class BusTest(unittest.TestCase):
+	def setUp(self):
+		self.old = dict((key, config.get(key)) for key in ("bus_dir", "bus_max_datagram", "api_base_port", "api_num_processes"))
+		config.override("bus_dir", tempfile.gettempdir())
+		config.override("bus_max_datagram", 2048)
+		config.override("api_base_port", 10460)
+		config.override("api_num_processes", 2)
+		self.received = []
+		bus.subscribe("test_event", self.handler)
+		# Only the first API process is up
+		bus.listen(10460)
+
+	def tearDown(self):
+		bus.close()
+		del bus._handlers["test_event"]
+		for key, value in self.old.iteritems():
+			config.override(key, value)
+
+	def handler(self, payload, bulk):
+		self.received.append((payload, bulk))
+
+	def _run_ioloop(self):
+		ioloop = tornado.ioloop.IOLoop.instance()
+		ioloop.add_timeout(time.time() + 0.1, ioloop.stop)
+		ioloop.start()
+
+	def test_permissions(self):
+		self.assertEqual(0660, os.stat(bus.get_path(10460)).st_mode & 0777)
+
+	def _count(self, name):
+		if stats.get(name):
+			return stats.get(name).count
+		return 0
+
+	def test_publish(self):
+		failures = self._count("bus_failures_api_10461.sock")
+		self.assertEqual(1, bus.publish("test_event", { "sid": 1 }, [ 1, 2, 3 ]))
+		# Too big to send, so the subscriber gets told to go look for itself
+		self.assertEqual(1, bus.publish("test_event", { "sid": 2 }, "x" * 4096))
+		self._run_ioloop()
+		self.assertEqual([ ({ "sid": 1 }, [ 1, 2, 3 ]), ({ "sid": 2 }, None) ], self.received)
+		self.assertEqual(failures + 2, self._count("bus_failures_api_10461.sock"))
+		self.assertEqual(1, self._count("bus_oversize_test_event"))
+
+	def test_close(self):
+		path = bus.get_path(10460)
+		self.assertTrue(os.path.exists(path))
+		bus.close()
+		self.assertFalse(os.path.exists(path))
+		self.assertEqual(0, bus.publish("test_event", { "sid": 1 }))
@@ -0,0 +1,20 @@
+import gzip
+import unittest
+import cStringIO
+from libs import stats
+from api import compression
+
+class CompressionTest(unittest.TestCase):
+	def test_shared_body(self):
+		body = '{"sync_station": %s}' % ", ".join([ '{"song_title": "Song %s"}' % i for i in range(0, 200) ])
+		gzipped = compression.get_gzipped("test_sid1", body)
+		self.assertEqual(body, gzip.GzipFile(fileobj = cStringIO.StringIO(gzipped)).read())
+		# Compressed once for however many responses it goes into
+		self.assertTrue(compression.get_gzipped("test_sid1", body + "ignored") is gzipped)
+		self.assertEqual(2, compression._bodies["test_sid1"]['served'])
+
+		compression.clear("test_sid1")
+		self.assertFalse("test_sid1" in compression._bodies)
+		self.assertEqual((len(body) - len(gzipped)) * 2, stats.get("gzip_broadcast_saved").total)
+		self.assertEqual(1, stats.get("gzip_broadcast_cpu").count)
+		compression.clear("test_sid1")
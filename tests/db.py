@@ -0,0 +1,40 @@
+import threading
+import unittest
+from libs import db
+from libs import config
+
+class SQLiteThreadsTest(unittest.TestCase):
+	def setUp(self):
+		self.cursors = []
+
+	def tearDown(self):
+		for cursor in self.cursors:
+			cursor.close()
+		db.c.update("DELETE FROM r4_vote_totals WHERE user_id IN (2, 3)")
+
+	def _cursor(self):
+		# What PerThreadCursor hands each station worker
+		cursor = db.SQLiteCursor(config.get("db_name"))
+		self.cursors.append(cursor)
+		return cursor
+
+	def test_writes_from_two_connections(self):
+		first = self._cursor()
+		second = self._cursor()
+		first.update("INSERT INTO r4_vote_totals (user_id, vote_2wk) VALUES (2, 1)")
+		# Would be "database is locked" if the first connection were still holding its write
+		second.update("INSERT INTO r4_vote_totals (user_id, vote_2wk) VALUES (3, 1)")
+		self.assertEqual(2, db.c.fetch_var("SELECT COUNT(*) FROM r4_vote_totals WHERE user_id IN (2, 3)"))
+
+	def test_transaction_waits(self):
+		first = self._cursor()
+		second = self._cursor()
+		first.start_transaction()
+		first.update("INSERT INTO r4_vote_totals (user_id, vote_2wk) VALUES (2, 1)")
+		thread = threading.Thread(target = second.update, args = ("INSERT INTO r4_vote_totals (user_id, vote_2wk) VALUES (3, 1)",))
+		thread.start()
+		# Holds the write lock until commit, and the other connection waits for it instead of failing
+		self.assertEqual(0, db.c.fetch_var("SELECT COUNT(*) FROM r4_vote_totals WHERE user_id = 3"))
+		first.commit()
+		thread.join(5)
+		self.assertEqual(2, db.c.fetch_var("SELECT COUNT(*) FROM r4_vote_totals WHERE user_id IN (2, 3)"))
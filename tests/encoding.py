@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import glob
+import json
+import unittest
+import collections
+import tornado.escape
+from api import encoding
+
+class Counted(object):
+	def __init__(self):
+		self.calls = 0
+
+	def to_dict(self):
+		self.calls += 1
+		return { "id": 5, "title": u"Sørvis </script>" }
+
+class EncodingTest(unittest.TestCase):
+	def tearDown(self):
+		encoding.clear_fragments()
+
+	def test_matches_tornado(self):
+		Point = collections.namedtuple("Point", [ "x", "y" ])
+		output = {
+			"user": { "username": u"Ünïcode \"quoted\"", "user_id": 2, "radio_perks": True, "avatar": None },
+			"sched_next": [ { "id": 1, "songs": [ { "title": "</script>", "length": 180.5 } ] }, [], {} ],
+			"listeners_current": { 1: [ "ints as keys" ] },
+			"point": Point(1, 2),
+			"error": { "code": -1000, "text": "Missing user_id argument.\n\t" },
+			"api_info": { "time": 1371234567.0 }
+		}
+		self.assertEqual(tornado.escape.json_encode(output), encoding.dumps(output))
+		self.assertEqual(tornado.escape.json_encode(output), encoding.encode(output))
+		self.assertEqual(tornado.escape.json_encode([ output, 1, "2" ]), encoding.encode([ output, 1, "2" ]))
+
+	def test_api_tests(self):
+		# The reference output api/server.py compares responses against
+		paths = glob.glob("api_tests/*.json")
+		self.assertTrue(len(paths) > 0)
+		for path in paths:
+			ref_file = open(path)
+			ref_data = json.load(ref_file)
+			ref_file.close()
+			self.assertEqual(tornado.escape.json_encode(ref_data), encoding.encode(ref_data))
+			self.assertEqual(ref_data, json.loads(encoding.encode(ref_data)))
+
+	def test_fragments(self):
+		song = Counted()
+		shared = [ { "user_id": 2 } ]
+		expected = tornado.escape.json_encode({ "song": song.to_dict(), "shared": shared, "songs": [ song.to_dict() ] })
+		song.calls = 0
+		shared_song = encoding.Shared(song)
+		for i in range(0, 3):
+			self.assertEqual(expected, encoding.encode({ "song": shared_song, "shared": encoding.Shared(shared), "songs": [ shared_song ] }))
+		self.assertEqual(1, song.calls)
+		encoding.clear_fragments()
+		encoding.encode({ "song": shared_song })
+		self.assertEqual(2, song.calls)
+
+	def test_unshared_not_cached(self):
+		song = Counted()
+		encoding.encode({ "song": song })
+		encoding.encode({ "song": song })
+		self.assertEqual(2, song.calls)
+		self.assertEqual({}, encoding._fragments)
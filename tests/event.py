@@ -84,6 +84,16 @@ class ElectionTest(unittest.TestCase):
 		self.assertNotEqual(None, req)
 		self.assertEqual(self.song1.id, req.id)
 		
+	def test_add_requests_failure(self):
+		e = Election.create(1)
+		e.is_request_needed = lambda: True
+		e._num_requests = 2
+		def get_request():
+			raise Exception("get_request failed")
+		e.get_request = get_request
+		self.assertRaises(Exception, e._add_requests)
+		self.assertEqual(None, request.get_line(1).dispatch_heap)
+
 	def test_add_from_queue(self):
 		db.c.update("DELETE FROM r4_election_queue")
 		event.add_to_election_queue(1, self.song1)
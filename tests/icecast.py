@@ -0,0 +1,124 @@
+import time
+import socket
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+import tornado.ioloop
+from libs import db
+from libs import config
+from libs import icecast
+from backend import registry
+from backend import work_queue
+
+class StubIcecastHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def setup(self):
+		self.server.connections += 1
+		BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+	def do_GET(self):
+		if self.server.delay:
+			time.sleep(self.server.delay)
+		body = self.server.body
+		if self.path == "/admin/stats":
+			body = "<?xml version=\"1.0\"?><icestats><host>relay.example</host></icestats>"
+		self.send_response(200)
+		self.send_header("Content-Type", "text/xml")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+class StubIcecastServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def __init__(self):
+		BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StubIcecastHandler)
+		self.connections = 0
+		self.delay = 0
+		self.set_clients(0)
+
+	def set_clients(self, start, end = None):
+		listeners = []
+		for i in range(start, end or start):
+			listeners.append("<listener id=\"%s\"><IP>10.0.%s.%s</IP><UserAgent>Winamp</UserAgent><Connected>%s</Connected><ID>%s</ID></listener>" % (i, i / 256 % 256, i % 256, i, i))
+		self.body = "<?xml version=\"1.0\"?><icestats><source mount=\"/game.mp3\"><Listeners>%s</Listeners>%s</source></icestats>" % (len(listeners), "".join(listeners))
+
+class IcecastSyncTest(unittest.TestCase):
+	def setUp(self):
+		db.c.update("DELETE FROM r4_listeners")
+		registry._listeners.clear()
+		registry._by_icecast.clear()
+		registry._by_user.clear()
+		registry._by_ip.clear()
+		registry._pending = []
+		self.old_timeout = config.get("icecast_sync_timeout")
+		self.server = StubIcecastServer()
+		thread = threading.Thread(target = self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		self.relay = { "host": "127.0.0.1", "port": self.server.server_address[1], "user": "admin", "password": "hackme" }
+		self.poller = icecast.RelayPoller("test", self.relay, { 1: "game.mp3" }, None)
+
+	def tearDown(self):
+		config.override("icecast_sync_timeout", self.old_timeout)
+		self.server.shutdown()
+		self.server.server_close()
+		db.c.update("DELETE FROM r4_listeners")
+		registry._listeners.clear()
+		registry._by_icecast.clear()
+		registry._by_user.clear()
+		registry._by_ip.clear()
+		registry._pending = []
+
+	def test_parse_listclients(self):
+		self.server.set_clients(0, 2)
+		clients = icecast.parse_listclients(self.server.body)
+		self.assertEqual([ 0, 1 ], sorted(clients.keys()))
+		self.assertEqual("10.0.0.1", clients[1]['ip'])
+		self.assertEqual("Winamp", clients[1]['agent'])
+
+	def _settle(self):
+		# Registers whatever reconcile queued, then writes it all out
+		work_queue.wait("registry")
+		ioloop = tornado.ioloop.IOLoop.instance()
+		ioloop.add_callback(ioloop.stop)
+		ioloop.start()
+		registry.flush()
+
+	def test_relay_key(self):
+		# What the listener_add and listener_remove callbacks send as server and port
+		self.assertEqual("relay.example:%s" % self.relay['port'], self.poller.get_key())
+
+	def test_sync_10k(self):
+		key = self.poller.get_key()
+		self.server.set_clients(0, 10000)
+		clients = self.poller.poll()[1]
+		self.assertEqual(10000, len(clients))
+		self.assertEqual({ "added": 10000, "purged": 0, "returned": 0, "deleted": 0 }, registry.reconcile(key, 1, clients))
+		self._settle()
+		self.assertEqual(10000, db.c.fetch_var("SELECT COUNT(*) FROM r4_listeners WHERE listener_purge = FALSE AND user_id = 1"))
+
+		# 1,000 leave and 500 join
+		self.server.set_clients(1000, 10500)
+		self.assertEqual({ "added": 500, "purged": 1000, "returned": 0, "deleted": 0 }, registry.reconcile(key, 1, self.poller.poll()[1]))
+		self._settle()
+		# Half of those come back, the others are gone for good
+		self.server.set_clients(500, 10500)
+		self.assertEqual({ "added": 0, "purged": 0, "returned": 500, "deleted": 500 }, registry.reconcile(key, 1, self.poller.poll()[1]))
+		self._settle()
+		self.assertEqual(10000, db.c.fetch_var("SELECT COUNT(*) FROM r4_listeners"))
+		self.assertEqual(10000, len(registry._listeners))
+		# All of that over one kept-alive connection
+		self.assertEqual(1, self.server.connections)
+
+	def test_slow_relay(self):
+		config.override("icecast_sync_timeout", 0.2)
+		self.server.delay = 1
+		started = time.time()
+		self.assertEqual({}, self.poller.poll())
+		self.assertTrue(time.time() - started < 1)
@@ -0,0 +1,69 @@
+import time
+import unittest
+from libs import db
+from rainwave import listeners
+from rainwave import user
+
+class ListenerCountTest(unittest.TestCase):
+	def setUp(self):
+		db.c.update("DELETE FROM r4_listeners")
+		db.c.update("INSERT INTO r4_listeners (sid, user_id, listener_icecast_id) VALUES (1, 1, 1)")
+		db.c.update("INSERT INTO r4_listeners (sid, user_id, listener_icecast_id, listener_voted_entry) VALUES (1, 1, 2, 5)")
+		db.c.update("INSERT INTO r4_listeners (sid, user_id, listener_icecast_id, listener_voted_entry) VALUES (1, 2, 3, 5)")
+		db.c.update("INSERT INTO r4_listeners (sid, user_id, listener_icecast_id, listener_purge) VALUES (1, 1, 4, TRUE)")
+		db.c.update("INSERT INTO r4_listeners (sid, user_id, listener_icecast_id) VALUES (2, 2, 5)")
+
+	def tearDown(self):
+		db.c.update("DELETE FROM r4_listeners")
+
+	def test_get_listener_counts(self):
+		counts = listeners.get_listener_counts(1)
+		self.assertEqual(2, counts['lc_guests'])
+		self.assertEqual(1, counts['lc_users'])
+		self.assertEqual(1, counts['lc_guests_active'])
+		self.assertEqual(1, counts['lc_users_active'])
+		self.assertEqual(0, listeners.get_listener_counts(3)['lc_guests'])
+
+	def test_count_listeners(self):
+		rows = db.c.fetch_all("SELECT * FROM r4_listeners WHERE sid = 1")
+		self.assertEqual(listeners.get_listener_counts(1), listeners.count_listeners(rows))
+
+class VoteCountTest(unittest.TestCase):
+	def setUp(self):
+		db.c.update("DELETE FROM r4_listeners")
+		db.c.update("DELETE FROM r4_vote_days")
+		db.c.update("DELETE FROM r4_vote_totals")
+		db.c.update("INSERT INTO r4_listeners (sid, user_id, listener_icecast_id) VALUES (1, 2, 1)")
+
+	def tearDown(self):
+		db.c.update("DELETE FROM r4_listeners")
+		db.c.update("DELETE FROM r4_vote_days")
+		db.c.update("DELETE FROM r4_vote_totals")
+		db.c.update("DELETE FROM r4_vote_history")
+
+	def test_rolling_count(self):
+		u = user.User(2)
+		self.assertEqual(True, u.record_vote(1, 1, 1))
+		self.assertEqual(True, u.record_vote(2, 2, 2))
+		self.assertEqual(False, user.User(1).record_vote(2, 2, 2))
+		self.assertEqual(2, listeners.get_listeners_dict(1)['users'][0]['radio_2wkvotes'])
+
+		# Votes from 3 weeks ago fall out of the total once aged
+		db.c.update("INSERT INTO r4_vote_days (user_id, vote_day, vote_count) VALUES (2, %s, 5)", (int(time.time() / 86400) - 21,))
+		db.c.update("UPDATE r4_vote_totals SET vote_2wk = 7 WHERE user_id = 2")
+		self.assertEqual(1, listeners.age_vote_counts())
+		self.assertEqual(2, listeners.get_listeners_dict(1)['users'][0]['radio_2wkvotes'])
+		self.assertEqual(0, listeners.age_vote_counts())
+
+	def test_backfill(self):
+		t = time.time()
+		db.c.update("INSERT INTO r4_vote_history (vote_time, user_id, song_id) VALUES (%s, 2, 1)", (t,))
+		db.c.update("INSERT INTO r4_vote_history (vote_time, user_id, song_id) VALUES (%s, 2, 2)", (t - 86400,))
+		db.c.update("INSERT INTO r4_vote_history (vote_time, user_id, song_id) VALUES (%s, 2, 3)", (t - 86400 * 21,))
+		db.c.update("INSERT INTO r4_vote_days (user_id, vote_day, vote_count) VALUES (2, 1, 50)")
+		self.assertEqual(2, listeners.backfill_vote_counts())
+		self.assertEqual(2, listeners.get_listeners_dict(1)['users'][0]['radio_2wkvotes'])
+		# And votes after that carry on from there
+		user.User(2).record_vote(1, 1, 1)
+		self.assertEqual(3, listeners.get_listeners_dict(1)['users'][0]['radio_2wkvotes'])
+		self.assertEqual(2, db.c.fetch_var("SELECT COUNT(*) FROM r4_vote_days"))
@@ -0,0 +1,126 @@
+import time
+import base64
+import unittest
+import tornado.web
+import tornado.ioloop
+import tornado.httpserver
+import tornado.httpclient
+from libs import db
+from libs import cache
+from backend import registry
+from backend import server
+
+class RegistryTest(unittest.TestCase):
+	def setUp(self):
+		db.c.update("DELETE FROM r4_listeners")
+		registry._listeners.clear()
+		registry._by_icecast.clear()
+		registry._by_user.clear()
+		registry._by_ip.clear()
+		registry._pending = []
+
+	def tearDown(self):
+		db.c.update("DELETE FROM r4_listeners")
+
+	def test_add_remove(self):
+		guest = registry.add(1, "relay:8000", 10, "1.2.3.4", "agent", 1, 1)
+		user = registry.add(1, "relay:8000", 11, "1.2.3.4", "agent", 2, 2)
+		# Same client ID from another relay is another listener
+		other = registry.add(2, "relay2:8000", 10, "5.6.7.8", "agent", 2, 3)
+		self.assertEqual(other, registry.get(3))
+		self.assertEqual(2, len(registry.get_by_ip("1.2.3.4")))
+		self.assertEqual(2, len(registry.get_by_user(2)))
+		# Guests all share user ID 1, so they aren't indexed by it
+		self.assertEqual([], registry.get_by_user(1))
+		self.assertEqual(user, registry.remove("relay:8000", 11))
+		self.assertEqual(None, registry.remove("relay:8000", 11))
+		self.assertEqual(None, registry.get(2))
+		self.assertEqual([ other ], registry.get_by_user(2))
+		self.assertEqual([ guest ], registry.get_by_ip("1.2.3.4"))
+
+		self.assertEqual({}, registry.flush())
+		self.assertEqual(2, db.c.fetch_var("SELECT COUNT(*) FROM r4_listeners"))
+		self.assertEqual([], registry._pending)
+
+	def test_publish(self):
+		registry.add(1, "relay:8000", 10, "1.2.3.4", "agent", 1, 1)
+		user = registry.add(1, "relay:8000", 11, "1.2.3.4", "agent", 2, 2)
+		registry.flush()
+		db.c.update("UPDATE r4_listeners SET listener_voted_entry = 5 WHERE listener_id = %s", (user['listener_id'],))
+		registry._publish(registry.flush())
+		counts = cache.get_station(1, "listener_counts")
+		self.assertEqual(1, counts['lc_guests'])
+		self.assertEqual(1, counts['lc_users_active'])
+		self.assertEqual(1, cache.get("listeners_internal")[2]['sid'])
+		self.assertEqual(5, cache.get("listeners_internal")[2]['listener_voted_entry'])
+
+	def test_get_user_id_for_mount(self):
+		self.assertEqual(1, registry.get_user_id_for_mount("/game.mp3"))
+		self.assertEqual(2, registry.get_user_id_for_mount("/game.mp3?2:TESTKEY"))
+		self.assertEqual(1, registry.get_user_id_for_mount("/game.mp3?2:BADKEY"))
+		self.assertEqual(1, registry.get_user_id_for_mount("/game.mp3?x:TESTKEY"))
+
+	def test_queue_add_remove(self):
+		added = []
+		removed = []
+		ioloop = tornado.ioloop.IOLoop.instance()
+		registry.queue_add(1, "relay:8000", 10, "1.2.3.4", "agent", "/game.mp3?2:TESTKEY", callback = added.append)
+		registry.queue_add(1, "relay:8000", 11, "1.2.3.4", "agent", "/game.mp3", callback = added.append)
+		# Arrives before either add is registered, but can't get ahead of them
+		registry.queue_remove("relay:8000", 10, callback = removed.append)
+		registry.queue_remove("relay:8000", 99, callback = lambda row: ioloop.stop())
+		timeout = ioloop.add_timeout(time.time() + 5, ioloop.stop)
+		ioloop.start()
+		ioloop.remove_timeout(timeout)
+
+		self.assertEqual([ 2, 1 ], [ row['user_id'] for row in added ])
+		self.assertNotEqual(added[0]['listener_id'], added[1]['listener_id'])
+		self.assertEqual([ added[0] ], removed)
+		self.assertEqual([ added[1]['listener_id'] ], registry._listeners.keys())
+
+class IcecastCallbackTest(unittest.TestCase):
+	def setUp(self):
+		registry._listeners.clear()
+		registry._by_icecast.clear()
+		registry._by_user.clear()
+		registry._by_ip.clear()
+		self.http_server = tornado.httpserver.HTTPServer(tornado.web.Application([
+			(r"/sync/([0-9]+)/listener_add", server.ListenerAddRequest),
+			(r"/sync/([0-9]+)/listener_remove", server.ListenerRemoveRequest) ]))
+		self.http_server.listen(10471)
+
+	def tearDown(self):
+		self.http_server.stop()
+		registry._listeners.clear()
+		registry._by_icecast.clear()
+		registry._by_user.clear()
+		registry._by_ip.clear()
+		registry._pending = []
+
+	def _post(self, url, password):
+		responses = []
+		ioloop = tornado.ioloop.IOLoop.instance()
+		def on_response(response):
+			responses.append(response)
+			ioloop.stop()
+		headers = { "Authorization": "Basic %s" % base64.b64encode("user:%s" % password) }
+		tornado.httpclient.AsyncHTTPClient().fetch("http://localhost:10471/sync/1/%s" % url, on_response, method = "POST", headers = headers,
+			body = "server=relay&port=8000&client=10&mount=/game.mp3&ip=1.2.3.4&agent=test")
+		timeout = ioloop.add_timeout(time.time() + 5, ioloop.stop)
+		ioloop.start()
+		ioloop.remove_timeout(timeout)
+		return responses[0]
+
+	def test_auth(self):
+		response = self._post("listener_add", "wrong")
+		self.assertEqual(403, response.code)
+		self.assertEqual(None, response.headers.get("icecast-auth-user"))
+		self.assertEqual({}, registry._listeners)
+
+		response = self._post("listener_add", "pass")
+		self.assertEqual(200, response.code)
+		self.assertEqual("1", response.headers.get("icecast-auth-user"))
+		self.assertEqual([ "relay:8000" ], [ row['listener_relay'] for row in registry._listeners.values() ])
+
+		self.assertEqual(403, self._post("listener_remove", "wrong").code)
+		self.assertEqual(1, len(registry._listeners))
@@ -0,0 +1,212 @@
+import time
+import threading
+import unittest
+from libs import db
+from libs import cache
+from rainwave import request
+from backend import work_queue
+
+class RequestLineTest(unittest.TestCase):
+	def setUp(self):
+		request._lines = {}
+		request._stores = {}
+		request._journal = []
+		request._expiry_timer = request.ExpiryTimer()
+
+	def tearDown(self):
+		request._lines = {}
+		request._stores = {}
+		request._journal = []
+		request._expiry_timer = request.ExpiryTimer()
+		db.c.update("DELETE FROM r4_request_line")
+
+	def _fill_line(self, line, num_users, t):
+		for user_id in range(2, num_users + 2):
+			line.entries[user_id] = { "user_id": user_id, "username": "user%s" % user_id, "line_wait_start": t - user_id, "line_expiry_tune_in": None, "line_expiry_election": None, "line_top_song_id": None }
+			line.tuned_in.add(user_id)
+			request._stores[user_id] = [ { "reqstor_id": user_id, "reqstor_order": 0, "user_id": user_id, "song_id": user_id, "sid": line.sid } ]
+			line.available.add(user_id)
+			line.top_song_ids[user_id] = user_id
+
+	def test_recompute_large_line(self):
+		t = time.time()
+		line = request.get_line(1)
+		self._fill_line(line, 2000, t)
+		start = time.time()
+		line.recompute(t)
+		self.assertTrue(time.time() - start < 1)
+		self.assertEqual(2000, len(line.line))
+		# Longest wait (largest user_id here) goes first
+		self.assertEqual(2001, line.line[0]['user_id'])
+		self.assertEqual(1, line.positions[2001])
+		self.assertEqual(2000, line.positions[2])
+		self.assertEqual(2, line.line[-1]['song_id'])
+
+	def test_recompute_expiries(self):
+		t = time.time()
+		line = request.get_line(1)
+		self._fill_line(line, 4, t)
+		# 2 tunes out, 3 has no available song, 4's tune-in grace is up
+		line.tuned_in.remove(2)
+		del line.top_song_ids[3]
+		line.entries[4]['line_expiry_tune_in'] = t - 1
+		line.recompute(t)
+		self.assertEqual(t + 600, line.entries[2]['line_expiry_tune_in'])
+		self.assertEqual(t + 600, line.entries[3]['line_expiry_election'])
+		self.assertEqual(None, line.line[line.positions[3] - 1]['song_id'])
+		self.assertFalse(4 in line.entries)
+		self.assertEqual([5, 3, 2], [ entry['user_id'] for entry in line.line ])
+
+		# 3's countdown runs out and their only request is on station 2
+		line.entries[3]['line_expiry_election'] = t - 1
+		request._stores[3][0]['sid'] = 2
+		line.recompute(t)
+		self.assertFalse(3 in line.entries)
+		self.assertTrue(3 in request.get_line(2).entries)
+		# 2 is marked and still gone, so drops out of the published line but keeps their row
+		self.assertEqual([5], [ entry['user_id'] for entry in line.line ])
+
+	def test_flush_journal(self):
+		t = time.time()
+		line = request.get_line(1)
+		line.add(2, "user2", t)
+		line.add(3, "user3", t)
+		request.get_line(2).add(3, "user3", t)
+		self.assertEqual(7, request.flush_journal())
+		self.assertEqual(0, request.flush_journal())
+		self.assertEqual(1, db.c.fetch_var("SELECT sid FROM r4_request_line WHERE user_id = 2"))
+		self.assertEqual(2, db.c.fetch_var("SELECT sid FROM r4_request_line WHERE user_id = 3"))
+		self.assertFalse(3 in line.entries)
+
+	def test_flush_journal_evicts_stores(self):
+		t = time.time()
+		line = request.get_line(1)
+		self._fill_line(line, 2, t)
+		request._stores[9] = []
+		line.remove(2)
+		request.flush_journal()
+		self.assertEqual([3], request._stores.keys())
+
+	def test_dispatch(self):
+		t = time.time()
+		line = request.get_line(1)
+		self._fill_line(line, 3, t)
+		# 4 has waited longest, but their song gets used up by 3's second request
+		request._stores[3].append({ "reqstor_id": 100, "reqstor_order": 1, "user_id": 3, "song_id": 4, "sid": 1 })
+		request._stores[2].append({ "reqstor_id": 101, "reqstor_order": 1, "user_id": 2, "song_id": 50, "sid": 2 })
+		line.recompute(t)
+		line.start_dispatch()
+		request._journal = []
+
+		self.assertEqual((4, 4), line.pop_next())
+		line.fulfill(4, 4)
+		self.assertFalse(4 in line.entries)
+		self.assertEqual((3, 3), line.pop_next())
+		line.fulfill(3, 3)
+		# 3's next request was the song 4 just got, so they're back in line but have nothing to give
+		self.assertTrue(3 in line.entries)
+		self.assertEqual((2, 2), line.pop_next())
+		line.fulfill(2, 2)
+		self.assertEqual((None, None), line.pop_next())
+		self.assertTrue(2 in request.get_line(2).entries)
+		self.assertEqual(3, len([ query for query, params in request._journal if query.startswith("DELETE FROM r4_request_store") ]))
+
+	def test_get_top_request_song_ids(self):
+		db.c.update("DELETE FROM r4_request_store")
+		db.c.update("INSERT INTO r4_request_line (user_id, sid) VALUES (2, 1)")
+		db.c.update("INSERT INTO r4_request_line (user_id, sid) VALUES (3, 1)")
+		# 9001 is cool, 9002 plays on station 1, 9003 only on station 2
+		db.c.update("INSERT INTO r4_song_sid (song_id, sid, song_cool) VALUES (9001, 1, TRUE)")
+		db.c.update("INSERT INTO r4_song_sid (song_id, sid) VALUES (9002, 1)")
+		db.c.update("INSERT INTO r4_song_sid (song_id, sid) VALUES (9003, 2)")
+		db.c.update("INSERT INTO r4_request_store (user_id, song_id, sid, reqstor_order) VALUES (2, 9001, 1, 0)")
+		db.c.update("INSERT INTO r4_request_store (user_id, song_id, sid, reqstor_order) VALUES (2, 9002, 1, 1)")
+		db.c.update("INSERT INTO r4_request_store (user_id, song_id, sid, reqstor_order) VALUES (3, 9003, 2, 0)")
+		self.assertEqual({ 2: 9002 }, request.get_top_request_song_ids(1))
+		self.assertEqual({}, request.get_top_request_song_ids(2))
+		db.c.update("DELETE FROM r4_request_store")
+		db.c.update("DELETE FROM r4_song_sid WHERE song_id > 9000")
+
+	def test_update_line_expiry(self):
+		db.c.update("DELETE FROM r4_listeners")
+		db.c.update("INSERT INTO r4_request_line (user_id, sid) VALUES (2, 1)")
+		request.update_line(1)
+		cache.update_local_cache_for_sid(1)
+		expires_at = cache.get_local_station(1, "request_expiries").get(2)
+		self.assertNotEqual(None, expires_at)
+		self.assertEqual(expires_at, db.c.fetch_var("SELECT line_expiry_tune_in FROM r4_request_line WHERE user_id = 2"))
+		db.c.update("DELETE FROM r4_request_line")
+		request.update_line(1)
+		cache.update_local_cache_for_sid(1)
+		self.assertEqual({}, cache.get_local_station(1, "request_expiries"))
+
+	def test_expiries_published_on_change(self):
+		t = time.time()
+		line = request.get_line(1)
+		self._fill_line(line, 2, t)
+		line.recompute(t)
+		self.assertEqual({}, request._update_expiries(line))
+		line.tuned_in.remove(2)
+		line.recompute(t)
+		self.assertEqual({ 2: t + 600 }, request._update_expiries(line))
+		self.assertEqual({}, request._update_expiries(line))
+		self.assertEqual({ 2: t + 600 }, line.expiries)
+		del line.entries[2]
+		self.assertEqual({ 2: None }, request._update_expiries(line))
+		self.assertEqual({}, line.expiries)
+
+	def test_update_line_publishes_changed_expiries(self):
+		db.c.update("DELETE FROM r4_listeners")
+		db.c.update("INSERT INTO r4_request_line (user_id, sid) VALUES (2, 1)")
+		published = []
+		old_set_station = cache.set_station
+		def set_station(sid, key, value):
+			if key == "request_expiries":
+				published.append(value)
+			return old_set_station(sid, key, value)
+		cache.set_station = set_station
+		try:
+			request.update_line(1)
+			# Nothing about the line changed, so the expiries aren't pushed again
+			request.update_line(1)
+		finally:
+			cache.set_station = old_set_station
+		self.assertEqual(1, len(published))
+		self.assertTrue(2 in published[0])
+
+	def test_update_line_bumps_on_owner(self):
+		t = time.time()
+		db.c.update("DELETE FROM r4_listeners")
+		# Station 2's only listener is past their expiry, so updating station 1 recomputes 2's line too
+		line = request.get_line(2)
+		line.entries[3] = { "user_id": 3, "username": "user3", "line_wait_start": t - 10, "line_expiry_tune_in": t - 1, "line_expiry_election": None, "line_top_song_id": None }
+		request._expiry_timer.set(3, 2, t - 1)
+		bumped = []
+		old_bump = cache.bump_sync_versions
+		def bump(sid, sections):
+			bumped.append((sid, threading.current_thread().name))
+			return old_bump(sid, sections)
+		cache.bump_sync_versions = bump
+		try:
+			request.update_line(1)
+			work_queue.wait(2)
+		finally:
+			cache.bump_sync_versions = old_bump
+		self.assertTrue((2, "worker_2") in bumped)
+		self.assertEqual([], [ entry for entry in bumped if entry[0] == 2 and entry[1] != "worker_2" ])
+
+class ExpiryTimerTest(unittest.TestCase):
+	def test_pop_expired(self):
+		timer = request.ExpiryTimer()
+		self.assertTrue(timer.set(2, 1, 100))
+		self.assertFalse(timer.set(2, 1, 100))
+		self.assertTrue(timer.set(3, 1, 200))
+		self.assertTrue(timer.set(4, 2, 150))
+		# 3 got more time and 4 left the line, so their old entries are dead
+		self.assertTrue(timer.set(3, 1, 300))
+		self.assertTrue(timer.set(4, 2, None))
+		self.assertEqual(None, timer.get(4))
+		self.assertEqual([ (2, 1) ], timer.pop_expired(250))
+		self.assertEqual([], timer.pop_expired(250))
+		self.assertEqual([ (3, 1) ], timer.pop_expired(300))
+		self.assertEqual(300, timer.get(3))
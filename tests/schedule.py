@@ -0,0 +1,46 @@
+import time
+import unittest
+from libs import db
+from libs import cache
+from rainwave import playlist
+from rainwave import schedule
+from rainwave.event import Election
+
+class ReconcileTest(unittest.TestCase):
+	def setUp(self):
+		self.song1 = playlist.Song.load_from_file("tests/test1.mp3", [1])
+		db.c.update("DELETE FROM r4_elections WHERE elec_used = FALSE")
+
+	def tearDown(self):
+		self.song1.disable()
+		playlist.remove_all_locks(1)
+		for station in (schedule.current, schedule.next, schedule.history):
+			station.pop(1, None)
+		schedule._restored.discard(1)
+		for key in ("sched_current", "sched_next", "sched_history"):
+			cache.set_station(1, key, None)
+
+	def _filled_election(self):
+		elec = Election.create(1)
+		elec.fill()
+		playlist.remove_all_locks(1)
+		return elec
+
+	def test_bad_snapshot(self):
+		playing = self._filled_election()
+		db.c.update("UPDATE r4_elections SET elec_used = TRUE, elec_in_progress = TRUE, elec_start_actual = %s WHERE elec_id = %s", (time.time() - 10, playing.id))
+		next1 = self._filled_election()
+		next2 = self._filled_election()
+
+		# We died between advancing to next2 and post-processing it, and memcache got the same state
+		schedule.current[1] = next2
+		schedule.next[1] = [ next1 ]
+		schedule._restored.add(1)
+		cache.set_station(1, "sched_current", next2)
+		cache.set_station(1, "sched_next", [ next1 ])
+
+		self.assertEqual(False, schedule.reconcile(1))
+		self.assertEqual(playing.id, schedule.current[1].id)
+		self.assertEqual([ next1.id, next2.id ], [ evt.id for evt in schedule.next[1] ])
+		self.assertEqual(playing.id, cache.get_station(1, "sched_current").id)
+		self.assertEqual([ next1.id, next2.id ], [ evt.id for evt in cache.get_station(1, "sched_next") ])
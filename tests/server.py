@@ -0,0 +1,43 @@
+import time
+import unittest
+import tornado.web
+import tornado.ioloop
+import tornado.httpserver
+import tornado.httpclient
+from libs import db
+from libs import stats
+from api import server
+
+class TimedRequest(tornado.web.RequestHandler):
+	url = "test_timed"
+
+	def get(self):
+		db.c.fetch_var("SELECT COUNT(*) FROM r4_listeners")
+		self.write("x" * 100)
+
+class LogRequestTest(unittest.TestCase):
+	def test_timed(self):
+		cursor = stats.Timed(db.c, "test_db", ("fetch_var",))
+		before = stats.get_times().get("test_db", 0)
+		self.assertEqual(db.c.fetch_var("SELECT COUNT(*) FROM r4_listeners"), cursor.fetch_var("SELECT COUNT(*) FROM r4_listeners"))
+		self.assertTrue(stats.get_times()['test_db'] > before)
+		# Untimed methods go straight to the cursor
+		self.assertEqual(db.c.fetch_row, cursor.fetch_row)
+
+	def test_log_request(self):
+		old_c = db.c
+		db.c = stats.Timed(db.c, "db", db._TIMED_METHODS)
+		http_server = tornado.httpserver.HTTPServer(server.Application([ (r"/api/test_timed", TimedRequest) ], log_function = server.log_request))
+		http_server.listen(10470)
+		ioloop = tornado.ioloop.IOLoop.instance()
+		try:
+			tornado.httpclient.AsyncHTTPClient().fetch("http://localhost:10470/api/test_timed", lambda response: ioloop.stop())
+			ioloop.add_timeout(time.time() + 5, ioloop.stop)
+			ioloop.start()
+		finally:
+			http_server.stop()
+			db.c = old_c
+		self.assertEqual(1, stats.get("api_test_timed").count)
+		self.assertEqual(100, stats.get("api_test_timed_size").total)
+		self.assertTrue(stats.get("api_test_timed_db").total > 0)
+		self.assertEqual(1, stats.get("api_test_timed_cache").count)
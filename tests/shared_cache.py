@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+from libs import config
+from libs import shared_cache
+
+class SharedCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.old_dir = config.get("shared_cache_dir")
+		self.old_size = config.get("shared_cache_size")
+		config.override("shared_cache_dir", tempfile.gettempdir())
+		config.override("shared_cache_size", 4096)
+		if os.path.exists(shared_cache.get_path(1)):
+			os.remove(shared_cache.get_path(1))
+
+	def tearDown(self):
+		shared_cache._writers = {}
+		shared_cache._readers = {}
+		shared_cache._snapshots = {}
+		os.remove(shared_cache.get_path(1))
+		config.override("shared_cache_dir", self.old_dir)
+		config.override("shared_cache_size", self.old_size)
+
+	def test_publish_read(self):
+		self.assertEqual(None, shared_cache.read(1))
+		self.assertTrue(shared_cache.publish(1, { "sched_current": None, "listeners_current": [ 2 ] }))
+		self.assertEqual(2, shared_cache.get_version(1))
+		station = shared_cache.read(1)
+		self.assertEqual([ 2 ], station['listeners_current'])
+		# Unpickled once per version
+		self.assertTrue(shared_cache.read(1) is station)
+		self.assertTrue(shared_cache.publish(1, { "listeners_current": [ 3 ] }))
+		self.assertEqual(4, shared_cache.get_version(1))
+		self.assertEqual({ "listeners_current": [ 3 ] }, shared_cache.read(1))
+		# Too big for the region leaves the last snapshot alone
+		self.assertFalse(shared_cache.publish(1, { "listeners_current": "x" * 8192 }))
+		self.assertEqual({ "listeners_current": [ 3 ] }, shared_cache.read(1))
+
+	def test_torn_read(self):
+		shared_cache.publish(1, { "listeners_current": [ 2 ] })
+		shared_cache.read(1)
+		# A write in progress, readers wait it out and then give up
+		shared_cache._SEQUENCE.pack_into(shared_cache._writers[1], 0, 3)
+		self.assertEqual(None, shared_cache.read(1))
+		# The next write gets past a writer that died halfway
+		shared_cache.publish(1, { "listeners_current": [ 4 ] })
+		self.assertEqual(6, shared_cache.get_version(1))
+		self.assertEqual([ 4 ], shared_cache.read(1)['listeners_current'])
@@ -0,0 +1,165 @@
+import os
+import json
+import tempfile
+import unittest
+import tornado.web
+import tornado.ioloop
+import tornado.testing
+from libs import cache
+from libs import config
+from libs import stats
+from libs import shared_cache
+from api_requests import sync
+from api_requests.sync import SessionRegistry
+
+class SessionRegistryTest(unittest.TestCase):
+	def test_indexes(self):
+		registry = SessionRegistry()
+		guest1, guest2, user2, user2_tab, user3 = object(), object(), object(), object(), object()
+		registry.add(guest1, 1, 1, "10.0.0.1")
+		registry.add(guest2, 1, 1, "10.0.0.1")
+		registry.add(user2, 1, 2, "10.0.0.2")
+		registry.add(user2_tab, 2, 2, "10.0.0.2")
+		registry.add(user3, 2, 3, "10.0.0.3")
+		self.assertEqual(5, registry.count())
+		self.assertEqual(3, registry.count(1))
+
+		self.assertEqual(set([ user2, user2_tab ]), set(registry.pop_user(2)))
+		self.assertEqual([], registry.pop_user(2))
+		self.assertEqual([], registry.pop_user(1))
+		self.assertEqual(set([ guest1, guest2 ]), set(registry.pop_ip("10.0.0.1")))
+		self.assertEqual(0, registry.count(1))
+
+		# A client going away takes itself out of every index
+		self.assertEqual(True, registry.remove(user3))
+		self.assertEqual(False, registry.remove(user3))
+		self.assertEqual([], registry.pop_sid(2))
+		self.assertEqual({}, registry.by_ip)
+		self.assertEqual({}, registry.by_user)
+
+class FakeSession(object):
+	closed = False
+
+	def __init__(self, updated):
+		self.updated = updated
+
+	def update(self, use_local_cache = False):
+		self.updated.append(self)
+
+class FanOutTest(unittest.TestCase):
+	def setUp(self):
+		self.old_chunk_size = config.get("sync_fanout_chunk_size")
+		config.override("sync_fanout_chunk_size", 2)
+
+	def tearDown(self):
+		config.override("sync_fanout_chunk_size", self.old_chunk_size)
+
+	def test_chunks(self):
+		updated = []
+		pending = [ FakeSession(updated) for i in range(0, 5) ]
+		pending[0].closed = True
+		everyone = list(pending)
+		ioloop = tornado.ioloop.IOLoop.instance()
+		sync.fan_out(1, pending)
+		# Only the first chunk runs before the IOLoop gets a turn
+		self.assertEqual(2, len(updated))
+		ioloop.add_callback(ioloop.stop)
+		ioloop.start()
+		ioloop.add_callback(ioloop.stop)
+		ioloop.start()
+		self.assertEqual(set(everyone[1:]), set(updated))
+		self.assertEqual(1, stats.get("sync_fanout_sid1").count)
+
+class SyncUpdateAllTest(tornado.testing.AsyncHTTPTestCase):
+	def get_app(self):
+		return tornado.web.Application([ (r"/api/sync_update_all", sync.SyncUpdateAll) ])
+
+	def setUp(self):
+		super(SyncUpdateAllTest, self).setUp()
+		self.old_local = dict(cache.local)
+		self.updated = []
+		self.session = FakeSession(self.updated)
+		sync.sessions.add(self.session, 1, 1, "10.0.0.1")
+
+	def tearDown(self):
+		sync.sessions.remove(self.session)
+		cache.local.clear()
+		cache.local.update(self.old_local)
+		super(SyncUpdateAllTest, self).tearDown()
+
+	def test_update_all(self):
+		response = self.fetch("/api/sync_update_all?sid=1")
+		self.assertEqual(200, response.code)
+		self.assertEqual([ self.session ], self.updated)
+
+	def test_bad_sid(self):
+		self.assertEqual(400, self.fetch("/api/sync_update_all").code)
+		self.assertEqual(400, self.fetch("/api/sync_update_all?sid=x").code)
+		self.assertEqual([], self.updated)
+
+class PushEventTest(unittest.TestCase):
+	keys = ("sid1_album_diff", "sid1_listeners_current", "sid1_sched_current", "sid1_sched_next", "sid1_sched_history", "sid1_sync_versions")
+
+	def setUp(self):
+		self.old_local = dict((key, cache.local.get(key)) for key in self.keys)
+		for key in self.keys:
+			cache.local[key] = None
+
+	def tearDown(self):
+		cache.local.update(self.old_local)
+		sync._station_events.pop(1, None)
+
+	def test_station_event_cache(self):
+		event = sync.get_station_event(1)
+		self.assertTrue(event.startswith("event: station\ndata: {"))
+		self.assertTrue(event.endswith("}\n\n"))
+		self.assertEqual(None, json.loads(event.split("data: ", 1)[1])['sched_current'])
+		# Encoded once per update, however many streams ask for it
+		cache.local["sid1_listeners_current"] = { "user_id": 2 }
+		self.assertTrue(sync.get_station_event(1) is event)
+		sync._station_events.pop(1, None)
+		self.assertNotEqual(event, sync.get_station_event(1))
+
+class SharedCacheUpdateTest(unittest.TestCase):
+	def setUp(self):
+		self.old_dir = config.get("shared_cache_dir")
+		config.override("shared_cache_dir", tempfile.gettempdir())
+		if os.path.exists(shared_cache.get_path(1)):
+			os.remove(shared_cache.get_path(1))
+		self.old_listeners = cache.get_station(1, "listeners_current")
+		self.old_local = dict(cache.local)
+
+	def tearDown(self):
+		shared_cache._writers = {}
+		shared_cache._readers = {}
+		shared_cache._snapshots = {}
+		sync._shared_versions.pop(1, None)
+		os.remove(shared_cache.get_path(1))
+		config.override("shared_cache_dir", self.old_dir)
+		cache.set_station(1, "listeners_current", self.old_listeners)
+		cache.local.clear()
+		cache.local.update(self.old_local)
+
+	def test_version_check(self):
+		cache.set_station(1, "listeners_current", { "users": [ 2 ] })
+		shared_cache.publish(1, { "listeners_current": { "users": [ 3 ] } })
+		sync.update_station(1)
+		self.assertEqual({ "users": [ 3 ] }, cache.get_local_station(1, "listeners_current"))
+		# Only memcache has this one, the snapshot we already took mustn't win over it
+		cache.set_station(1, "listeners_current", { "users": [ 4 ] })
+		sync.update_station(1)
+		self.assertEqual({ "users": [ 4 ] }, cache.get_local_station(1, "listeners_current"))
+
+class SyncVersionsTest(unittest.TestCase):
+	def test_held_versions(self):
+		self.assertEqual({}, sync.get_held_versions(""))
+		self.assertEqual({ "sched_current": 5, "requests_all": 7 }, sync.get_held_versions("sched_current:5,requests_all:7,calendar:x,junk"))
+
+	def test_bump(self):
+		cache.set_station(1, "sync_versions", None)
+		first = cache.bump_sync_versions(1, [ "sched_current", "listeners_current" ])
+		second = cache.bump_sync_versions(1, [ "sched_current" ])
+		self.assertTrue(second['sched_current'] > first['sched_current'])
+		self.assertEqual(first['listeners_current'], second['listeners_current'])
+		self.assertEqual(second, cache.get_station(1, "sync_versions"))
+		cache.set_station(1, "sync_versions", None)
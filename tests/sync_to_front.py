@@ -0,0 +1,46 @@
+import time
+import unittest
+import tornado.web
+import tornado.ioloop
+import tornado.httpserver
+from libs import config
+from libs import stats
+from backend import sync_to_front
+
+class FakeAPI(tornado.web.RequestHandler):
+	received = []
+
+	def get(self):
+		FakeAPI.received.append(self.get_argument("user_id"))
+		self.write("Processing.")
+
+class SyncToFrontTest(unittest.TestCase):
+	def setUp(self):
+		self.old_port = config.get("api_base_port")
+		self.old_processes = config.get("api_num_processes")
+		config.override("api_base_port", 10450)
+		config.override("api_num_processes", 2)
+		self.server = tornado.httpserver.HTTPServer(tornado.web.Application([ (r"/api/sync_update_user", FakeAPI) ]))
+		# Only the first API process answers, the second port has nobody listening
+		self.server.listen(10450)
+
+	def tearDown(self):
+		self.server.stop()
+		config.override("api_base_port", self.old_port)
+		config.override("api_num_processes", self.old_processes)
+
+	def test_notify(self):
+		ioloop = tornado.ioloop.IOLoop.instance()
+		sync_to_front.sync_frontend_user_id(2)
+		started = time.time()
+		def check():
+			if (stats.get("sync_to_front_10450") and stats.get("sync_to_front_10451")) or time.time() - started > 5:
+				ioloop.stop()
+			else:
+				ioloop.add_timeout(time.time() + 0.05, check)
+		ioloop.add_callback(check)
+		ioloop.start()
+		self.assertEqual([ "2" ], FakeAPI.received)
+		self.assertEqual(1, stats.get("sync_to_front_10450").count)
+		self.assertEqual(1, stats.get("sync_to_front_failures_10451").count)
+		self.assertEqual(None, stats.get("sync_to_front_failures_10450"))
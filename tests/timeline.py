@@ -0,0 +1,33 @@
+import unittest
+from rainwave import timeline
+
+class TimelineTest(unittest.TestCase):
+	def setUp(self):
+		self.t = timeline.Timeline(1)
+		self.t.floor = 0
+		self.t.add({ "sched_id": 1, "sched_type": "Election", "sched_start": 100, "sched_end": 500 })
+		self.t.add({ "sched_id": 2, "sched_type": "Election", "sched_start": 200, "sched_end": 300 })
+		self.t.add({ "sched_id": 3, "sched_type": "Election", "sched_start": 600, "sched_end": 700 })
+
+	def test_at(self):
+		self.assertEqual(None, self.t.at(50))
+		self.assertEqual(1, self.t.at(150)['sched_id'])
+		# Overlaps pick the event that started most recently
+		self.assertEqual(2, self.t.at(250)['sched_id'])
+		self.assertEqual(1, self.t.at(300)['sched_id'])
+		self.assertEqual(None, self.t.at(550))
+		self.assertEqual(3, self.t.at(600)['sched_id'])
+		self.assertEqual(None, self.t.at(700))
+
+	def test_between(self):
+		self.assertEqual([1, 2], [ row['sched_id'] for row in self.t.between(250, 550) ])
+		self.assertEqual([1, 3], [ row['sched_id'] for row in self.t.between(350, 650) ])
+		self.assertEqual([], self.t.between(700, 800))
+
+	def test_add_remove(self):
+		self.t.add({ "sched_id": 2, "sched_type": "Election", "sched_start": 520, "sched_end": 580 })
+		self.assertEqual(1, self.t.at(250)['sched_id'])
+		self.assertEqual(2, self.t.at(550)['sched_id'])
+		self.assertEqual(True, self.t.remove(1))
+		self.assertEqual(None, self.t.at(250))
+		self.assertEqual(False, self.t.remove(1))
@@ -0,0 +1,57 @@
+import time
+import threading
+import unittest
+from libs import db
+from libs import config
+from backend import trim
+from backend import work_queue
+
+class TrimTest(unittest.TestCase):
+	def setUp(self):
+		self.old_chunk_size = config.get("trim_chunk_size")
+		self.old_history_length = config.get("trim_history_length")
+		self.old_chunk_delay = config.get("trim_chunk_delay")
+		config.override("trim_chunk_size", 3)
+		config.override("trim_history_length", 4)
+		config.override("trim_chunk_delay", 0)
+		db.c.update("DELETE FROM r4_song_history")
+		db.c.update("DELETE FROM r4_elections")
+		for i in range(0, 10):
+			db.c.update("INSERT INTO r4_song_history (sid, song_id) VALUES (1, %s)", (i,))
+		db.c.update("INSERT INTO r4_song_history (sid, song_id) VALUES (2, 1)")
+		for i in range(0, 7):
+			db.c.update("INSERT INTO r4_elections (elec_id, sid, elec_start_actual) VALUES (%s, 1, %s)", (i + 1, time.time() - config.get("trim_election_age") - 10))
+		db.c.update("INSERT INTO r4_elections (elec_id, sid, elec_start_actual) VALUES (8, 1, %s)", (time.time(),))
+
+	def tearDown(self):
+		config.override("trim_chunk_size", self.old_chunk_size)
+		config.override("trim_history_length", self.old_history_length)
+		config.override("trim_chunk_delay", self.old_chunk_delay)
+		db.c.update("DELETE FROM r4_song_history")
+		db.c.update("DELETE FROM r4_elections")
+
+	def test_trim_history(self):
+		self.assertEqual(6, trim.trim_history(1))
+		self.assertEqual([9, 8, 7, 6], db.c.fetch_list("SELECT song_id FROM r4_song_history WHERE sid = 1 ORDER BY songhist_id DESC"))
+		self.assertEqual(0, trim.trim_history(2))
+
+	def test_trim_all(self):
+		removed = trim.trim_all()
+		self.assertEqual(7, removed['r4_elections'])
+		self.assertEqual(6, removed['r4_song_history'])
+		self.assertEqual([8], db.c.fetch_list("SELECT elec_id FROM r4_elections"))
+
+	def test_queue_trim_while_running(self):
+		release = threading.Event()
+		started = threading.Event()
+		def running():
+			started.set()
+			release.wait(5)
+		work_queue.add("trim", "trim", running)
+		started.wait(5)
+		# Off the queue and running, which still counts
+		trim.queue_trim()
+		self.assertEqual(1, work_queue.pending("trim"))
+		release.set()
+		work_queue.wait("trim")
+		self.assertEqual(0, work_queue.pending("trim"))
@@ -1,6 +1,15 @@
+import time
 import unittest
+import tornado.web
+import tornado.ioloop
+import tornado.httpserver
+import tornado.httpclient
 from rainwave import user
 from libs import db
+from libs import cache
+from libs import config
+from api_requests import sync
+from backend import server
 
 class AnonymousUserAuth(unittest.TestCase):
 	def setUp(self):
@@ -45,6 +54,98 @@ class RegisteredUserAuth(unittest.TestCase):
 		self.assertEqual(self.user.put_in_request_line(2), True)
 		self.assertEqual(self.user.remove_from_request_line(), True)
 		
+class AuthCache(unittest.TestCase):
+	def setUp(self):
+		user._get_auth_cache().clear()
+		db.c.update("INSERT INTO r4_api_keys (user_id, api_key, api_is_rainwave) VALUES (2, 'REVOKEME', TRUE)")
+
+	def tearDown(self):
+		db.c.update("DELETE FROM r4_api_keys WHERE api_key = 'REVOKEME'")
+		user._get_auth_cache().clear()
+
+	def test_cached_until_invalidated(self):
+		u = user.User(2)
+		u.authorize(1, "127.0.0.1", "REVOKEME")
+		self.assertEqual(True, u.authorized)
+		self.assertEqual(True, u.official_ui)
+		db.c.update("DELETE FROM r4_api_keys WHERE api_key = 'REVOKEME'")
+		# The key is gone from the DB but the cache still vouches for it
+		u = user.User(2)
+		u.authorize(1, "127.0.0.1", "REVOKEME")
+		self.assertEqual(True, u.authorized)
+		self.assertEqual(True, u.official_ui)
+		self.assertEqual("Test", u.data['username'])
+		user.invalidate_auth(2, "REVOKEME")
+		u = user.User(2)
+		u.authorize(1, "127.0.0.1", "REVOKEME")
+		self.assertEqual(False, u.authorized)
+
+	def test_cached_refresh(self):
+		old_internal = cache.local.get("listeners_internal")
+		try:
+			u = user.User(2)
+			u.authorize(1, "127.0.0.1", "REVOKEME")
+			# Only the local cache says they're tuned in, but a cached authorization still reads r4_listeners
+			cache.local['listeners_internal'] = { 2: { "listener_id": 1, "sid": 1, "listener_lock": False, "listener_lock_sid": None, "listener_lock_counter": 0, "listener_voted_entry": None } }
+			u = user.User(2)
+			u.authorize(1, "127.0.0.1", "REVOKEME")
+			self.assertEqual(False, u.data['radio_tuned_in'])
+			db.c.update("INSERT INTO r4_listeners (sid, user_id, listener_icecast_id) VALUES (1, 2, 1)")
+			u = user.User(2)
+			u.authorize(1, "127.0.0.1", "REVOKEME")
+			self.assertEqual(True, u.data['radio_tuned_in'])
+		finally:
+			cache.local['listeners_internal'] = old_internal
+			db.c.update("DELETE FROM r4_listeners WHERE user_id = 2")
+
+	def test_invalidated_from_backend(self):
+		old_port = config.get("api_base_port")
+		old_processes = config.get("api_num_processes")
+		config.override("api_base_port", 10452)
+		config.override("api_num_processes", 1)
+		api_server = tornado.httpserver.HTTPServer(tornado.web.Application([ (r"/api/sync_update_user", sync.SyncUpdateUser) ]))
+		api_server.listen(10452)
+		backend_server = tornado.httpserver.HTTPServer(tornado.web.Application([ (r"/sync/user_updated", server.UserUpdatedRequest) ]))
+		backend_server.listen(10453)
+		ioloop = tornado.ioloop.IOLoop.instance()
+		try:
+			u = user.User(2)
+			u.authorize(1, "127.0.0.1", "REVOKEME")
+			self.assertEqual(True, u.authorized)
+			db.c.update("DELETE FROM r4_api_keys WHERE api_key = 'REVOKEME'")
+			# The site revokes the key and tells the backend, which tells the API
+			tornado.httpclient.AsyncHTTPClient().fetch("http://localhost:10453/sync/user_updated", lambda response: None, method = "POST", body = "user_id=2&api_key=REVOKEME")
+			started = time.time()
+			def check():
+				if not user._get_auth_cache().get((2, "REVOKEME", "127.0.0.1")) or time.time() - started > 5:
+					ioloop.stop()
+				else:
+					ioloop.add_timeout(time.time() + 0.05, check)
+			ioloop.add_callback(check)
+			ioloop.start()
+			u = user.User(2)
+			u.authorize(1, "127.0.0.1", "REVOKEME")
+			self.assertEqual(False, u.authorized)
+		finally:
+			api_server.stop()
+			backend_server.stop()
+			config.override("api_base_port", old_port)
+			config.override("api_num_processes", old_processes)
+
+	def test_ttl(self):
+		c = cache.TTLCache(2, 0)
+		c.set("a", 1)
+		self.assertEqual(None, c.get("a"))
+		c = cache.TTLCache(2, 60)
+		c.set("a", 1)
+		c.set("b", 2)
+		c.get("a")
+		c.set("c", 3)
+		# b was the least recently used
+		self.assertEqual(None, c.get("b"))
+		self.assertEqual(1, c.get("a"))
+		self.assertEqual(3, c.get("c"))
+
 class AnonymousUserRefresh(unittest.TestCase):
 	def setUp(self):
 		self.user = user.User(1)
@@ -0,0 +1,60 @@
+import time
+import unittest
+import tornado.web
+import tornado.ioloop
+import tornado.httpserver
+import tornado.httpclient
+from libs import config
+from backend import work_queue
+from backend import server
+
+class RunNowTest(unittest.TestCase):
+	def test_no_jumping_a_dequeued_job(self):
+		ran = []
+		worker = work_queue._get_worker("test_run_now")
+		# Hold the worker between taking a job off the queue and starting it
+		worker.busy.acquire()
+		work_queue.add("test_run_now", "post_process", ran.append, "post_process")
+		started = time.time()
+		while worker.jobs.qsize() > 0 and time.time() - started < 5:
+			time.sleep(0.01)
+		# Off the queue but still owed, so run_now has to wait its turn
+		self.assertEqual(0, worker.jobs.qsize())
+		self.assertEqual(1, worker.pending)
+		worker.busy.release()
+		work_queue.wait("test_run_now")
+		self.assertEqual([ "post_process" ], ran)
+		self.assertEqual(0, worker.pending)
+		# Idle with nothing queued, so it runs right here
+		self.assertEqual((True, None), work_queue.run_now("test_run_now", ran.append, "advance"))
+		self.assertEqual([ "post_process", "advance" ], ran)
+
+class AdvanceFullTest(unittest.TestCase):
+	def test_refused_when_full(self):
+		http_server = tornado.httpserver.HTTPServer(tornado.web.Application([ (r"/advance/([0-9]+)", server.AdvanceScheduleRequest) ]))
+		http_server.listen(10472)
+		worker = work_queue._get_worker(1)
+		responses = []
+		ioloop = tornado.ioloop.IOLoop.instance()
+		def on_response(response):
+			responses.append(response)
+			ioloop.stop()
+		# One job held off by the busy worker, the rest filling its queue
+		worker.busy.acquire()
+		try:
+			for i in range(0, config.get("backend_queue_max_length") + 1):
+				work_queue.add(1, "noop", time.time)
+			started = time.time()
+			while not work_queue.is_full(1) and time.time() - started < 5:
+				time.sleep(0.01)
+			tornado.httpclient.AsyncHTTPClient().fetch("http://localhost:10472/advance/1", on_response)
+			timeout = ioloop.add_timeout(time.time() + 5, ioloop.stop)
+			ioloop.start()
+			ioloop.remove_timeout(timeout)
+			# Neither an advance nor a post_process went on the queue
+			self.assertEqual(config.get("backend_queue_max_length") + 1, work_queue.pending(1))
+		finally:
+			worker.busy.release()
+			http_server.stop()
+		work_queue.wait(1)
+		self.assertEqual(503, responses[0].code)